@@ -19,21 +19,15 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys
-import os.path
-from Crypto import Random
+# The built-in collector ("mimix collector --start") replaces this handler.
+# It remains for remailers that prefer to run behind mod_python.
+from mimix import collector
 
 def msg(req, base64):
     if base64 is None:
         return "Invalid submission\n";
-    if '-----BEGIN MIMIX MESSAGE-----' in base64:
-        while True:
-            fn = os.path.join('/home/crooks/mimix/inbound_pool',
-                             'm' + Random.new().read(4).encode('hex'))
-            if not os.path.isfile(fn):
-                break
-        with open(fn, 'w') as f:
-            f.write(base64)
-        return "Mimix message submitted";
-    else:
+    try:
+        collector.store(base64)
+    except collector.CollectorError:
         return "Invalid submission\n";
+    return "Mimix message submitted";
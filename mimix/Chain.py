@@ -2,7 +2,7 @@ import os.path
 import sqlite3
 import libmimix
 import logging
-from Config import config
+from Config import config, snapshot
 from Crypto.Random import random
 
 class ChainError(Exception):
@@ -12,21 +12,28 @@ class ChainError(Exception):
 class Chain(object):
     """
     """
-    def __init__(self, conn):
+    def __init__(self, conn, settings=None):
         self.conn = conn
+        if settings is None:
+            settings = snapshot()
+        self.settings = settings
 
-    def create(self, chainstr=None):
+    def create(self, chainstr=None, fmt=None, avoid=()):
         """
         This function generates a remailer chain.  The first link in the chain
         being the entry-remailer and the last link, the exit-remailer.  As the
         exit node must meet specific criteria, it is selected first to ensure
         the availability of suitable exit-nodes isn't exhausted during chain
         creation (see 'distance' parameter).  From that point, the chain is
-        constructed in reverse.
+        constructed in reverse.  If fmt is given, randomly selected links
+        are restricted to remailers that support that packet format.  A
+        randomly selected entry remailer will not be one of those in avoid,
+        unless there's no alternative.
         """
+        settings = self.settings
         if chainstr is None:
-            chainstr = config.get('chain', 'chain')
-        distance = config.getint('chain', 'distance')
+            chainstr = settings.chain
+        distance = settings.distance
         # nodes is a list of each link in the chain.  Each link can either be
         # randomly selected (depicted by an '*') or hardcoded (by remailer
         # address).
@@ -35,7 +42,9 @@ class Chain(object):
             raise ChainError("Maximum chain length exceeded")
         exit = nodes.pop()
         if exit == "*":
-            exits = libmimix.contenders(self.conn, smtp=True)
+            exits = libmimix.contenders(self.conn, settings.uptime,
+                                        settings.maxlat, settings.minlat,
+                                        smtp=True, fmt=fmt)
             # contenders is a list of exit remailers that don't conflict with
             # any hardcoded remailers within the proximity of "distance".
             # Without this check, the exit remailer would be selected prior to
@@ -65,7 +74,9 @@ class Chain(object):
         # All remailers is used to check that hardcoded links are all known
         # remailers.
         all_remailers = libmimix.all_remailers_by_name(self.conn)
-        remailers = libmimix.contenders(self.conn)
+        remailers = libmimix.contenders(self.conn, settings.uptime,
+                                        settings.maxlat, settings.minlat,
+                                        fmt=fmt)
         # If processing reaches this point, at least one remailer (besides an
         # exit) is required.  If we have none to choose from, raise an error.
         if len(remailers) == 0:
@@ -83,6 +94,12 @@ class Chain(object):
                 if num_contenders == 0:
                     raise ChainError("Insufficient remailers to comply with "
                                      "distance criteria")
+                if not nodes:
+                    # This is the entry remailer.
+                    preferred = list(set(contenders).difference(avoid))
+                    if preferred:
+                        contenders = preferred
+                        num_contenders = len(contenders)
                 # Pick a random remailer from the list of potential contenders
                 remailer = contenders[random.randint(0, num_contenders - 1)]
             elif remailer not in all_remailers:
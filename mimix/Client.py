@@ -24,27 +24,87 @@ import sys
 import os.path
 import math
 import sqlite3
-import requests
+import stat
+import shutil
+import tempfile
 import libmimix
-import mix
-import server
-from Crypto import Random
-from email.parser import Parser
-from Config import config
+from cStringIO import StringIO
+from Config import config, make_dirs
+# Client commands are run frequently (for example by monitoring scripts), so
+# startup is kept short.  Modules that are slow to import, such as those
+# using PyCrypto or requests, are imported by the commands that need them.
+
+
+class MessageReader(object):
+    """
+    A file-like view of a message whose headers have been parsed (and
+    perhaps modified) but whose body is still to be read from its source.
+    """
+    def __init__(self, headers, body):
+        self.headers = StringIO(headers)
+        self.body = body
+        self.body_start = body.tell()
+
+    def seek(self, offset):
+        """Only rewinding to the start of the message is supported."""
+        assert offset == 0
+        self.headers.seek(0)
+        self.body.seek(self.body_start)
+
+    def read(self, size):
+        data = self.headers.read(size)
+        if len(data) < size:
+            data += self.body.read(size - len(data))
+        return data
+
+
+def read_headers(f):
+    """
+    Parse the header block of the message in f.  The blank line that ends
+    the headers is consumed, leaving f positioned at the start of the body.
+    """
+    lines = []
+    while True:
+        line = f.readline()
+        if line in ('', '\n', '\r\n'):
+            break
+        lines.append(line)
+    from email.parser import Parser
+    return Parser().parsestr(''.join(lines), headersonly=True)
+
+
+def body_file(f):
+    """
+    Return a tuple of (file, size) for the remainder of f.  Sources that
+    can't be measured, such as a pipe, are spooled to a temporary file so
+    the body is never held in memory.
+    """
+    if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(f, spool)
+        spool.seek(0)
+        f = spool
+    return f, os.fstat(f.fileno()).st_size - f.tell()
 
 
 def send_msg(args):
+    import mix
+    import Chain
+    import sender
     # The Database needs to be open to build Chains and for Mix to encode
     # messages.
     with sqlite3.connect(dbkeys()) as conn:
         conn.text_factory = str
-        # Create a message object, either from file or stdin.
+        libmimix.upgrade_keyring(conn)
+        # Only the message headers are parsed.  The body is read from the
+        # file (or stdin) one chunk at a time as it's encoded.
         if args.filename:
-            with open(args.filename, 'r') as f:
-                msg = Parser().parse(f)
+            f = open(args.filename, 'r')
         else:
-            sys.stdout.write("Type message here.  Finish with Ctrl-D.\n")
-            msg = Parser().parsestr(sys.stdin.read())
+            if sys.stdin.isatty():
+                sys.stdout.write("Type message here.  Finish with Ctrl-D.\n")
+            f = sys.stdin
+        msg = read_headers(f)
 
         # Create or override important headers
         if args.recipient:
@@ -61,26 +121,46 @@ def send_msg(args):
         if 'From' not in msg:
             msg['From'] = config.get('general', 'sender')
 
-        m = mix.send(conn, msg.as_string(), args.chainstr)
+        headers = msg.as_string()
+        body, size = body_file(f)
+        # Exit type 0 is SMTP delivery.  Each chunk of the message is sent
+        # as soon as it's encoded.
+        packets = mix.encode_stream(conn, MessageReader(headers, body),
+                                    args.chainstr, 0, args.format,
+                                    args.workers, len(headers) + size)
+        try:
+            if args.stdout:
+                for m in packets:
+                    sys.stdout.write(m.text)
+                return
+            s = sender.ParallelSender(conn, args.threads, args.retries,
+                                      progress=send_progress)
+            failed = [c for c in s.send(packets) if c.state != sender.SENT]
+        except (mix.PacketError, Chain.ChainError), e:
+            sys.stderr.write("%s\n" % e)
+            sys.exit(1)
+        finally:
+            body.close()
+        if failed:
+            sys.stderr.write("%s chunk(s) could not be delivered: %s\n"
+                             % (len(failed),
+                                ",".join([str(c.chunknum) for c in failed])))
+            sys.exit(1)
 
-        if args.stdout:
-            sys.stdout.write(m.text)
-        else:
-            payload = {'base64': m.text}
-            url = '%s/collector.py/msg' % m.send_to_address
-            try:
-                # Send the message to the first hop.
-                r = requests.post(url, data=payload)
-                if r.status_code == requests.codes.ok:
-                    sys.stdout.write("Message delivered to %s\n"
-                                     % m.send_to_address)
-                else:
-                    sys.stderr.write("Delivery to %s failed with status "
-                                     "code: %s.\n" % (url, r.status_code))
-            except requests.exceptions.ConnectionError:
-                #TODO Mark down remailer statistics.
-                sys.stderr.write("Unable to connect to %s.\n"
-                                 % m.send_to_address)
+
+def send_progress(status, sent):
+    """Report the outcome of each attempt to deliver a chunk."""
+    import sender
+    chunk = "Chunk %s/%s" % (status.chunknum, status.numchunks)
+    if status.state == sender.SENT:
+        sys.stdout.write("%s delivered to %s (%s/%s sent)\n"
+                         % (chunk, status.entries[-1], sent,
+                            status.numchunks))
+    elif status.state == sender.PENDING:
+        sys.stderr.write("%s: %s.  Retrying.\n" % (chunk, status.error))
+    else:
+        sys.stderr.write("%s: %s.  Giving up after %s attempt(s).\n"
+                         % (chunk, status.error, status.attempts))
 
 
 def keyring_update(args):
@@ -89,6 +169,7 @@ def keyring_update(args):
         if 'keyring' not in libmimix.list_tables(conn):
             libmimix.create_keyring(conn)
             sys.stdout.write("Created \"keyring\" table in %s\n" % dbkeys())
+        libmimix.upgrade_keyring(conn)
         cursor = conn.cursor()
         exe = cursor.execute
         if args.setexit:
@@ -191,6 +272,7 @@ def remailer_delete(args):
 
 
 def server_mode(args):
+    import server
     pidfile = os.path.join(config.get('general', 'piddir'),
                            config.get('general', 'pidfile'))
     errlog = os.path.join(config.get('logging', 'dir'), 'err.log')
@@ -203,6 +285,19 @@ def server_mode(args):
         s.run(conlog=True)
 
 
+def collector_mode(args):
+    import collector
+    pidfile = os.path.join(config.get('general', 'piddir'), 'collector.pid')
+    errlog = os.path.join(config.get('logging', 'dir'), 'collector_err.log')
+    c = collector.CollectorServer(pidfile, stderr=errlog)
+    if args.start:
+        c.start()
+    elif args.stop:
+        c.stop()
+    elif args.run:
+        c.run(conlog=True)
+
+
 def dbkeys():
     """Shortcut that simply returns the fully-qualified DB filename.
     """
@@ -260,6 +355,7 @@ def remailer_conf_walk(conn, url):
 
 
 def main():
+    make_dirs()
     parser = argparse.ArgumentParser(description='Mimix Client')
     cmds = parser.add_subparsers(help='Commands')
 
@@ -272,6 +368,18 @@ def main():
                             "sending it to the first hop."))
     send.add_argument('--chain', type=str, dest='chainstr',
                       help="Define the Chain a message should use.")
+    send.add_argument('--format', type=int, dest='format',
+                      help=("Packet format (1=CFB, 2=CTR).  Every remailer "
+                            "in the Chain must support it."))
+    send.add_argument('--workers', type=int, dest='workers', default=0,
+                      help=("Encode the chunks of large messages in this "
+                            "many processes."))
+    send.add_argument('--threads', type=int, dest='threads',
+                      help=("Post chunks to entry remailers using this many "
+                            "threads."))
+    send.add_argument('--retries', type=int, dest='retries',
+                      help=("Retry a chunk that can't be delivered over up "
+                            "to this many new chains."))
     send.add_argument('--recipient', type=str, dest='recipient',
                       help="Specify a recipient address (To:)")
     send.add_argument('--sender', type=str, dest='sender',
@@ -333,6 +441,16 @@ def main():
     servgroup.add_argument('--run', dest='run', action='store_true',
                            help="Start the server in a console")
 
+    coll = cmds.add_parser('collector', help="HTTP collector options")
+    coll.set_defaults(func=collector_mode)
+    collgroup = coll.add_mutually_exclusive_group(required=True)
+    collgroup.add_argument('--start', dest='start', action='store_true',
+                           help="Start the collector daemon")
+    collgroup.add_argument('--stop', dest='stop', action='store_true',
+                           help="Stop the collector daemon")
+    collgroup.add_argument('--run', dest='run', action='store_true',
+                           help="Start the collector in a console")
+
     args = parser.parse_args()
     args.func(args)
     #if args.fetch:
@@ -22,6 +22,8 @@
 import ConfigParser
 import os
 import sys
+from cStringIO import StringIO
+import timing
 
 
 WRITE_DEFAULT_CONFIG = False
@@ -38,6 +40,159 @@ def dir_exists(d):
         sys.stderr.write("WARNING: %s does not exist\n" % d)
 
 
+class ConfigError(Exception):
+    pass
+
+
+class Settings(object):
+    """
+    A typed snapshot of the options read on hot paths (for every packet or
+    every server loop), so they're parsed and validated once instead of on
+    each use.  Settings can't be modified; reload() creates a new snapshot
+    and replaces the old one in a single assignment.  Anything holding a
+    snapshot continues to see consistent values until it asks for the
+    current one.  ConfigError is raised if an option is invalid.
+    """
+    __slots__ = ('name', 'address', 'version', 'smtp', 'hopspy', 'formats',
+                 'chain', 'distance', 'format', 'x25519', 'compress',
+                 'uptime', 'maxlat', 'minlat', 'indummy', 'outdummy',
+                 'dummychain', 'posttimeout', 'loop', 'pinger')
+
+    def __init__(self, config):
+        def opt(section, option, get=config.get):
+            try:
+                return get(section, option)
+            except (ValueError, ConfigParser.Error), e:
+                raise ConfigError("[%s] %s: %s" % (section, option, e))
+
+        def optional(section, option):
+            if config.has_option(section, option):
+                return config.get(section, option)
+            return None
+
+        def dhms(section, option):
+            try:
+                return timing.dhms_secs(opt(section, option))
+            except (ValueError, IndexError):
+                raise ConfigError("[%s] %s: Invalid period"
+                                  % (section, option))
+
+        getint = config.getint
+        getbool = config.getboolean
+        values = {
+            'name': optional('general', 'name'),
+            'address': optional('general', 'address'),
+            'version': opt('general', 'version'),
+            'smtp': opt('general', 'smtp', getbool),
+            'hopspy': opt('general', 'hopspy', getbool),
+            'chain': opt('chain', 'chain'),
+            'distance': opt('chain', 'distance', getint),
+            'format': opt('chain', 'format', getint),
+            'x25519': opt('chain', 'x25519', getbool),
+            'compress': opt('chain', 'compress', getbool),
+            'uptime': opt('chain', 'uptime', getint),
+            'maxlat': opt('chain', 'maxlat', getint),
+            'minlat': opt('chain', 'minlat', getint),
+            'indummy': opt('pool', 'indummy', getint),
+            'outdummy': opt('pool', 'outdummy', getint),
+            'dummychain': opt('pool', 'dummychain'),
+            'posttimeout': opt('pool', 'posttimeout', getint),
+            'loop': dhms('pool', 'loop'),
+            'pinger': opt('pinger', 'enabled', getbool)}
+        try:
+            values['formats'] = tuple(
+                [int(f) for f in opt('general', 'formats').split(',')
+                 if f.strip()])
+        except ValueError, e:
+            raise ConfigError("[general] formats: %s" % e)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are read-only")
+
+    __delattr__ = __setattr__
+
+    def __getstate__(self):
+        # Settings are passed to worker processes along with their tasks.
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+
+def snapshot():
+    """Return the current Settings."""
+    return settings
+
+
+def read(configfile):
+    """
+    Return a new RawConfigParser containing the defaults, overridden by the
+    options in configfile (if it exists).
+    """
+    parser = ConfigParser.RawConfigParser()
+    parser.readfp(StringIO(defaults))
+    if os.path.isfile(configfile):
+        parser.read(configfile)
+    if parser.has_option('general', 'address'):
+        # Strip any trailing slash from the remailer address.
+        parser.set('general', 'address',
+                   parser.get('general', 'address').rstrip('/'))
+    return parser
+
+
+def reload():
+    """
+    Re-read the config file (on SIGHUP) and return the new Settings.  If
+    the file is invalid, ConfigError is raised and the current options
+    remain in force.  The raw config object is updated in place as modules
+    hold a reference to it.
+    """
+    global settings
+    parser = read(configfile)
+    new = Settings(parser)
+    for section in config.sections():
+        if not parser.has_section(section):
+            config.remove_section(section)
+    for section in parser.sections():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option in config.options(section):
+            if not parser.has_option(section, option):
+                config.remove_option(section, option)
+        for option, value in parser.items(section):
+            config.set(section, option, value)
+    settings = new
+    return settings
+
+
+def make_dirs():
+    """
+    Make the directories that are required.  If an address is set, the
+    assumption is made that this node will run as a server, so a config file
+    and the server's directories are required.
+    """
+    mkdir(basedir)
+    mkdir(config.get('database', 'path'))
+    if not config.has_option('general', 'address'):
+        return
+    if not os.path.isfile(configfile):
+        sys.stderr.write("No configuration file found.\nThe expected "
+                         "location is %s.\nThis can be overridden by defining "
+                         "the MIMIX environment variable.\n" % configfile)
+        sys.exit(1)
+    mkdir(config.get('general', 'piddir'))
+    mkdir(config.get('logging', 'dir'))
+    mkdir(config.get('pool', 'indir'))
+    mkdir(config.get('pool', 'outdir'))
+    if config.getboolean('cluster', 'enabled'):
+        mkdir(config.get('cluster', 'shareddir'))
+        mkdir(os.path.join(config.get('cluster', 'shareddir'), 'exits'))
+    dir_exists(config.get('http', 'wwwdir'))
+
+
 # Configure the Config Parser.
 config = ConfigParser.RawConfigParser()
 
@@ -54,13 +209,27 @@ config.set('general', 'pidfile', 'mimix.pid')
 config.set('general', 'idage', 28)
 config.set('general', 'version', '0.1-alpha1')
 config.set('general', 'keyvalid', 270)
+# The replacement for the current key is generated in the background this
+# many days before the current key stops being advertised.
+config.set('general', 'keyahead', 14)
 config.set('general', 'sender', 'Anonymous Remailer <anon@invalid>')
 config.set('general', 'hopspy', 'yes')
+config.set('general', 'smtphost', 'localhost')
+config.set('general', 'smtpport', 25)
+# Packet formats this remailer will accept and advertise.
+config.set('general', 'formats', '1,2')
+# Generate and advertise an X25519 key alongside the RSA key.
+config.set('general', 'x25519', 'yes')
+# Largest message (in bytes) a deflated payload may decompress to.
+config.set('general', 'inflatemax', 20 * 1024 * 1024)
 
 config.add_section('database')
 config.set('database', 'path', os.path.join(basedir, 'db'))
 config.set('database', 'directory', 'directory.db')
 config.set('database', 'chunks', 'chunks.db')
+# Pages freed by expired and assembled chunks are returned to the filesystem
+# this often.
+config.set('database', 'vacuum', '1h')
 
 config.add_section('chain')
 config.set('chain', 'chain', "*,*,*")
@@ -68,6 +237,17 @@ config.set('chain', 'uptime', 90)
 config.set('chain', 'maxlat', 120)
 config.set('chain', 'minlat', 0)
 config.set('chain', 'distance', 3)
+# Packet format used when sending.  See mix.py for details.
+config.set('chain', 'format', 1)
+# Use X25519 key agreement for hops that advertise an X25519 key.
+config.set('chain', 'x25519', 'yes')
+# Deflate messages when the exit remailer supports it.
+config.set('chain', 'compress', 'yes')
+# Chunks are posted by this many threads.  A chunk that can't be delivered
+# is retried over a new chain up to "retries" times.
+config.set('chain', 'sendthreads', 4)
+config.set('chain', 'retries', 2)
+config.set('chain', 'sendtimeout', 60)
 
 config.add_section('logging')
 config.set('logging', 'dir', os.path.join(basedir, 'log'))
@@ -77,6 +257,10 @@ config.set('logging', 'format',
            '%(asctime)s %(name)s %(levelname)s %(message)s')
 config.set('logging', 'datefmt', '%Y-%m-%d %H:%M:%S')
 config.set('logging', 'retain', 7)
+# Profiling of the server loop.  It can also be toggled with SIGUSR1.
+config.set('logging', 'profile', 'no')
+config.set('logging', 'profiledir', os.path.join(basedir, 'log', 'profile'))
+config.set('logging', 'profilekeep', 48)
 
 config.add_section('pool')
 config.set('pool', 'indir', os.path.join(basedir, 'inbound_pool'))
@@ -84,47 +268,88 @@ config.set('pool', 'outdir', os.path.join(basedir, 'outbound_pool'))
 config.set('pool', 'size', 45)
 config.set('pool', 'rate', 65)
 config.set('pool', 'interval', '15m')
+config.set('pool', 'algorithm', 'timed')
+# How long the server sleeps between processing runs.
+config.set('pool', 'loop', '1m')
+config.set('pool', 'inmax', 5000)
+config.set('pool', 'inbytes', 256 * 1024 * 1024)
 config.set('pool', 'expire', 7)
 config.set('pool', 'indummy', 10)
 config.set('pool', 'outdummy', 20)
 config.set('pool', 'dummychain', '*,*,*,*')
+# Failed deliveries to a next hop defer further attempts, starting at
+# "backoff" and doubling up to "maxbackoff".  After "breaker" consecutive
+# failures, only a single probe message is sent when a deferral expires.
+config.set('pool', 'posttimeout', 60)
+config.set('pool', 'backoff', '1m')
+config.set('pool', 'maxbackoff', '6h')
+config.set('pool', 'breaker', 3)
+# Passive remailer stats are gathered from outbound deliveries.  A delivery's
+# influence halves every statshalflife.  Stats are only used for a hop once
+# it has the equivalent of statsmin recent deliveries.
+config.set('pool', 'statshalflife', '6h')
+config.set('pool', 'statsmin', 3)
 
 config.add_section('http')
 config.set('http', 'wwwdir', os.path.join(homedir, 'apache', 'www'))
+config.set('http', 'listen', '127.0.0.1')
+config.set('http', 'port', 8080)
+# Admission control.  Rates are submissions per minute.  Reserve is the
+# percentage of capacity only known remailers may use.
+config.set('http', 'srcrate', 60)
+config.set('http', 'srcburst', 30)
+config.set('http', 'rate', 600)
+config.set('http', 'burst', 300)
+config.set('http', 'reserve', 20)
+
+config.add_section('pinger')
+# Every interval, a ping is sent through each known remailer.  Pings that
+# haven't returned after timeout are lost.  Stats are calculated from the
+# pings sent during the last window.
+config.set('pinger', 'enabled', 'yes')
+config.set('pinger', 'interval', '1h')
+config.set('pinger', 'timeout', '6h')
+config.set('pinger', 'window', '2d')
+config.set('pinger', 'threads', 4)
+
+config.add_section('metrics')
+# Metrics are served at http://listen:port/metrics.  A port of 0 disables
+# them.
+config.set('metrics', 'listen', '127.0.0.1')
+config.set('metrics', 'port', 0)
+
+config.add_section('cluster')
+# Several servers can share one remailer identity.  Node 0 is the primary; it
+# generates the keys and handles the exits.  The nodes share the inbound pool
+# and "shareddir".  Replay is the Packet ID store, "sqlite:<file>" or
+# "redis://host:port/db", by default a SQLite DB in shareddir.  A node takes
+# inbound messages belonging to other nodes once they're older than steal.
+config.set('cluster', 'enabled', 'no')
+config.set('cluster', 'node', 0)
+config.set('cluster', 'nodes', 1)
+config.set('cluster', 'shareddir', os.path.join(basedir, 'cluster'))
+config.set('cluster', 'replay', '')
+config.set('cluster', 'steal', '5m')
 
 if WRITE_DEFAULT_CONFIG:
     with open('sample.cfg', 'w') as c:
         config.write(c)
         sys.exit(0)
 
-# Try and process the .mimixrc file.  If it doesn't exist, we
-# bailout as some options are compulsory.
+# The defaults are kept so the config file can be re-read from scratch.
+defaults = StringIO()
+config.write(defaults)
+defaults = defaults.getvalue()
+
+# Process the .mimixrc file.  Servers require one (see make_dirs) as some
+# options are compulsory.
 if 'MIMIX' in os.environ:
     configfile = os.environ['MIMIX']
 else:
     configfile = os.path.join(homedir, '.mimixrc')
-if os.path.isfile(configfile):
-    config.read(configfile)
-
-# Make required directories
-mkdir(basedir)
-mkdir(config.get('database', 'path'))
-if config.has_option('general', 'address'):
-    # If an address is set, the assumption is made that this node will run as
-    # a server.
-    # Strip any trailing slash from the remailer address.
-    if config.get('general', 'address').endswith('/'):
-        config.set('general', 'address', config.get('general',
-                                                    'address').rstrip('/'))
-
-    if not os.path.isfile(configfile):
-        sys.stderr.write("No configuration file found.\nThe expected "
-                         "location is %s.\nThis can be overridden by defining "
-                         "the MIMIX environment variable.\n" % configfile)
-        sys.exit(1)
-
-    mkdir(config.get('general', 'piddir'))
-    mkdir(config.get('logging', 'dir'))
-    mkdir(config.get('pool', 'indir'))
-    mkdir(config.get('pool', 'outdir'))
-    dir_exists(config.get('http', 'wwwdir'))
+config = read(configfile)
+try:
+    settings = Settings(config)
+except ConfigError, e:
+    sys.stderr.write("Invalid configuration: %s\n" % e)
+    sys.exit(1)
@@ -22,17 +22,120 @@
 import sys
 import os.path
 import logging
+import math
 from types import *
 from Config import config
 from Crypto.Random import random
 from Crypto import Random
 import timing
+import armour
+
+
+# Binomial batch sizes are drawn from a normal approximation once the
+# variance of the distribution reaches this.
+NORMAL_VARIANCE = 25
+
+
+class PoolError(Exception):
+    pass
+
+
+def sample_indices(n, k, rng=random):
+    """Yield k unique, randomly ordered indices in the range 0 to n-1.  This
+    is a partial Fisher-Yates shuffle performed on a virtual index of the
+    population.  Only swapped positions are recorded so the cost is O(k),
+    regardless of how large n is.
+    """
+    assert 0 <= k <= n
+    swaps = {}
+    for i in xrange(k):
+        j = rng.randint(i, n - 1)
+        picked = swaps.get(j, j)
+        swaps[j] = swaps.get(i, i)
+        yield picked
+
+
+class TimedDynamicMix(object):
+    """
+    Every interval, send rate percent of the pool, providing the pool
+    contains at least size messages.  This is the original Mimix pool
+    behaviour.
+    """
+    def __init__(self, rate, size, rng=random):
+        self.rate = rate
+        self.size = size
+        self.rng = rng
+
+    def batch_size(self, numfiles):
+        if numfiles < self.size:
+            return 0
+        # Without adding the 0.5, a queue containing one message will never
+        # send that message.
+        return int(numfiles * float(self.rate) / 100 + 0.5)
+
+
+class BinomialMix(TimedDynamicMix):
+    """
+    Every interval, each message in the pool is independently sent with a
+    probability of rate percent, providing the pool contains at least size
+    messages.  The number sent is therefore binomially distributed which
+    denies an observer certainty about how many messages left the pool.
+    """
+    def batch_size(self, numfiles):
+        if numfiles < self.size:
+            return 0
+        p = float(self.rate) / 100
+        variance = numfiles * p * (1 - p)
+        if variance < NORMAL_VARIANCE:
+            # Small pools (or extreme rates) decide each message in turn.
+            num = 0
+            for n in xrange(numfiles):
+                if self.rng.randint(1, 100) <= self.rate:
+                    num += 1
+            return num
+        # Otherwise a single draw from the normal approximation, using the
+        # Box-Muller transform on two uniforms from the pool's RNG.
+        u1 = 1 - self.uniform()
+        u2 = self.uniform()
+        z = math.sqrt(-2 * math.log(u1)) * math.cos(2 * math.pi * u2)
+        num = int(round(numfiles * p + z * math.sqrt(variance)))
+        return max(0, min(numfiles, num))
+
+    def uniform(self):
+        """Return a float in the range [0, 1) with 53 bits of precision."""
+        return self.rng.randint(0, 2 ** 53 - 1) / float(2 ** 53)
+
+
+class ThresholdMix(TimedDynamicMix):
+    """
+    Every interval, if the pool contains at least size messages, flush all
+    of them.  Rate is ignored.
+    """
+    def batch_size(self, numfiles):
+        if numfiles < self.size:
+            return 0
+        return numfiles
+
+
+mixers = {'timed': TimedDynamicMix,
+          'binomial': BinomialMix,
+          'threshold': ThresholdMix}
+
+
+def mixer(algorithm, rate, size, rng=random):
+    """Return an instance of the named mixing algorithm."""
+    if algorithm not in mixers:
+        raise PoolError("%s: Unknown mixing algorithm" % algorithm)
+    return mixers[algorithm](rate, size, rng=rng)
 
 
 class Pool():
     def __init__(self, name, pooldir, interval='1m', rate=100, size=1,
-                 expire=7):
-        self.trigger_time = timing.future(mins=1)
+                 expire=7, algorithm='timed'):
+        # The first pool run happens after a minute, or sooner if the
+        # interval is shorter than that.
+        self.trigger_time = min(timing.future(mins=1),
+                                timing.dhms_future(interval))
         assert type(interval) == StringType
         assert type(rate) == IntType
         assert type(size) == IntType
@@ -42,6 +145,7 @@ class Pool():
         self.rate = rate
         self.size = size
         self.expire = expire
+        self.mixer = mixer(algorithm, rate, size)
         self.processed = 0
         self.log = logging.getLogger("mimix.%s" % name)
 
@@ -59,48 +163,65 @@ class Pool():
     def packet_write(self, mixmsg):
         expire = timing.date_future(days=self.expire)
         with open(self.filename(), 'w') as f:
-            f.write("Next-Hop: %s\n" % mixmsg.send_to_address)
-            f.write("Expire: %s\n\n" % timing.datestamp(expire))
+            armour.write_headers(f, (('Next-Hop', mixmsg.send_to_address),
+                                     ('Expire', timing.datestamp(expire))))
             f.write(mixmsg.text)
 
+    def headers(self, fqfn):
+        """Return a dict of the headers of the message fqfn.  Only the
+        headers are read, not the armoured packet.
+        """
+        with open(fqfn, 'r') as f:
+            return armour.read_headers(f)
+
+    def stream_write(self, packets):
+        """Write each packet from an iterable of encoded packets, such as
+        mix.encode_stream, to the pool.  Returns the number written.
+        """
+        count = 0
+        for mixmsg in packets:
+            self.packet_write(mixmsg)
+            count += 1
+        return count
+
+    def listdir(self):
+        """Return the names of all the messages in the pool.  Hidden files
+        are excluded as these are partially written messages.
+        """
+        return [f for f in os.listdir(self.pooldir) if not f.startswith('.')]
+
     def trigger(self):
         return timing.now() >= self.trigger_time
 
-    def select_subset(self):
+    def select_subset(self, held=None):
         """Pick a random subset of filenames in the Pool and return them as a
         list.  If the Pool isn't sufficiently large, return an empty list.
+        held is an optional function that's passed each fully-qualified
+        filename.  Files for which it returns True count towards the size
+        of the Pool but aren't selected.
         """
-        files = os.listdir(self.pooldir)
+        files = self.listdir()
         numfiles = len(files)
         if numfiles > 0:
             self.log.debug("Pool contains %s messages", numfiles)
-
-        if numfiles < self.size:
-            # The pool is too small to send messages.
-            self.log.debug("Pool is insufficiently populated to trigger "
-                           "sending.")
-            files = []
-            numfiles = 0
-        # Without adding the 0.5, a queue containing one message will never
-        # send that message.
-        process_num = int(numfiles * float(self.rate) / 100 + 0.5)
+        process_num = self.mixer.batch_size(numfiles)
+        if process_num > 0 and held is not None:
+            files = [f for f in files
+                     if not held(os.path.join(self.pooldir, f))]
+            if len(files) < numfiles:
+                self.log.debug("%s messages are held in the pool.",
+                               numfiles - len(files))
+            numfiles = len(files)
+            process_num = min(process_num, numfiles)
         if process_num > 0:
             self.log.debug("Attempting to send %s messages from the pool.",
                            process_num)
+        elif numfiles > 0:
+            self.log.debug("Pool is insufficiently populated to trigger "
+                           "sending.")
         assert process_num <= numfiles
-        # Shuffle the poolfiles into a random order
-        random.shuffle(files)
-        # Even though the list is shuffled, pick a random point in the list to
-        # slice from/to.  It does no harm, might do some good and doesn't cost
-        # a lot!
-        startmax = numfiles - process_num
-        if startmax == 0:
-            start = 0
-        else:
-            start = random.randint(0, startmax - 1)
-        end = start + process_num
-        for f in files[start:end]:
-            yield os.path.join(self.pooldir, f)
+        for i in sample_indices(numfiles, process_num):
+            yield os.path.join(self.pooldir, files[i])
         self.processed += process_num
         # Set the point in the future at which another outbound pool run will
         # occur.
@@ -119,7 +240,7 @@ class Pool():
             self.log.error("%s: File not found during msg deletion", fqfn)
 
     def select_all(self):
-        files = os.listdir(self.pooldir)
+        files = self.listdir()
         numfiles = len(files)
         if numfiles > 0:
             self.log.debug("Processing %s messages.", numfiles)
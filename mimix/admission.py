@@ -0,0 +1,236 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# admission.py - Admission control for inbound Mimix submissions
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import math
+import os
+import os.path
+import socket
+import sqlite3
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+import libmimix
+
+"""
+Admission control decides whether the collector should accept a submission
+before any work is done on it.  Three limits apply:-
+
+    [ Per-source token bucket                                  ]
+    [ Global token bucket shared by all sources                ]
+    [ Inbound pool quotas (number of messages and total bytes) ]
+
+A source is the client IP address.  Remailers identify themselves with a
+sender field but it's unauthenticated, so it's only believed if the host in
+the claimed address resolves to the client's IP address.  Verified remailers
+are given priority: a reserve percentage of the global bucket and of the
+pool quotas can only be consumed by them.  An unverified claim gains
+nothing; it's limited by a bucket of its own as well as the client's, so it
+can't drain the bucket of the remailer it claims to be.
+"""
+
+
+class AdmissionError(Exception):
+    """Raised when a submission is refused.  retry_after is a suggested
+    number of seconds the sender should wait before trying again.
+    """
+    def __init__(self, msg, retry_after=60):
+        Exception.__init__(self, msg)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    A bucket holding up to burst tokens, refilled at rate tokens per second.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.stamp = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, floor=0):
+        """
+        Take a token, providing doing so doesn't drain the bucket below
+        floor tokens.  Returns 0 on success or the number of seconds until a
+        token will be available.
+        """
+        self.refill()
+        if self.tokens - 1 >= floor:
+            self.tokens -= 1
+            return 0
+        if self.rate <= 0:
+            return 3600
+        return int(math.ceil((floor + 1 - self.tokens) / self.rate))
+
+
+class PoolGauge(object):
+    """
+    Counting the pool on every request would cost a directory read per
+    submission.  Instead, the count and size are refreshed once per interval
+    and incremented locally on each write in between.
+    """
+    def __init__(self, pooldir, interval=5):
+        self.pooldir = pooldir
+        self.interval = interval
+        self.stamp = 0
+        self.count = 0
+        self.bytes = 0
+
+    def refresh(self):
+        if time.time() - self.stamp <= self.interval:
+            return
+        count = 0
+        size = 0
+        for f in os.listdir(self.pooldir):
+            if f.startswith('.'):
+                continue
+            try:
+                size += os.path.getsize(os.path.join(self.pooldir, f))
+            except OSError:
+                # The file was processed while we were looking at it.
+                continue
+            count += 1
+        self.count = count
+        self.bytes = size
+        self.stamp = time.time()
+
+    def add(self, length):
+        self.count += 1
+        self.bytes += length
+
+
+class Admission(object):
+    def __init__(self, pooldir, srcrate=60, srcburst=30, rate=600, burst=300,
+                 poolmax=0, poolbytes=0, reserve=20, maxsources=10000):
+        # Rates are configured per minute but buckets work in seconds.
+        self.srcrate = srcrate / 60.0
+        self.srcburst = srcburst
+        self.bucket = TokenBucket(rate / 60.0, burst)
+        self.gauge = PoolGauge(pooldir)
+        self.poolmax = poolmax
+        self.poolbytes = poolbytes
+        self.reserve = reserve
+        self.maxsources = maxsources
+        # Least recently used first.
+        self.sources = OrderedDict()
+        # Known remailer addresses and the IP addresses their hosts
+        # resolve to.
+        self.known = {}
+        self.known_stamp = 0
+        self.lock = threading.Lock()
+
+    def known_remailers(self):
+        """Return a dict of known remailer addresses and the set of IP
+        addresses each resolves to, refreshed from the keyring once an hour.
+        """
+        if time.time() - self.known_stamp > 3600:
+            try:
+                with sqlite3.connect(libmimix.dbfn()) as conn:
+                    conn.text_factory = str
+                    known = libmimix.all_remailers_by_address(conn)
+                self.known = dict([(a, resolve(a)) for a in known])
+            except sqlite3.Error, e:
+                log.warn("Unable to read known remailers: %s", e)
+            self.known_stamp = time.time()
+        return self.known
+
+    def verified(self, addr, sender):
+        """True if sender is a known remailer whose host is addr."""
+        if sender is None:
+            return False
+        return addr in self.known_remailers().get(sender, ())
+
+    def source_bucket(self, source):
+        if source in self.sources:
+            bucket = self.sources.pop(source)
+        else:
+            if len(self.sources) >= self.maxsources:
+                self.sources.popitem(last=False)
+            bucket = TokenBucket(self.srcrate, self.srcburst)
+        self.sources[source] = bucket
+        return bucket
+
+    def limit(self, limit, known):
+        """Return the portion of limit available to a source."""
+        if known:
+            return limit
+        return limit * (100 - self.reserve) / 100
+
+    def admit(self, addr, sender=None):
+        """
+        Decide whether a submission from addr (claiming to be from sender)
+        should be accepted.  AdmissionError is raised if it should not.
+        """
+        with self.lock:
+            known = self.verified(addr, sender)
+            self.gauge.refresh()
+            if self.poolmax and (self.gauge.count >=
+                                 self.limit(self.poolmax, known)):
+                raise AdmissionError("Inbound pool message quota reached")
+            if self.poolbytes and (self.gauge.bytes >=
+                                   self.limit(self.poolbytes, known)):
+                raise AdmissionError("Inbound pool byte quota reached")
+            sources = [addr]
+            if sender is not None and not known:
+                sources.append('claimed:%s' % sender)
+            for source in sources:
+                wait = self.source_bucket(source).take()
+                if wait:
+                    raise AdmissionError("Rate limit exceeded for %s"
+                                         % source, retry_after=wait)
+            if known:
+                floor = 0
+            else:
+                floor = self.bucket.burst * self.reserve / 100
+            wait = self.bucket.take(floor=floor)
+            if wait:
+                raise AdmissionError("Global rate limit exceeded",
+                                     retry_after=wait)
+
+    def stored(self, length):
+        """Account for a message written to the pool."""
+        with self.lock:
+            self.gauge.add(length)
+
+
+def resolve(address):
+    """Return the set of IP addresses the host in a remailer address
+    resolves to.
+    """
+    host = urlparse.urlparse(address).hostname
+    if host is None:
+        return set()
+    try:
+        return set([a[4][0] for a in socket.getaddrinfo(host, None)])
+    except socket.error, e:
+        log.info("Unable to resolve %s: %s", host, e)
+        return set()
+
+
+log = logging.getLogger("mimix.%s" % __name__)
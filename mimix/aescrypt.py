@@ -0,0 +1,82 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# aescrypt.py - AES helpers for Mimix packet processing
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+"""
+Each hop of a Mimix packet uses a single AES key to process up to ten
+segments (nine headers and the payload), each with its own IV.  PacketKey
+wraps that key so Encode and Decode share one code path for every segment.
+
+Two modes are supported, corresponding to the packet formats in mix.py:-
+
+    [ CFB    Format 1   CFB with PyCrypto's default 8-bit segments ]
+    [ CTR    Format 2   CTR with the IV as the initial counter     ]
+
+CFB is self-synchronizing: every keystream block is derived from the previous
+ciphertext, so keystreams cannot be generated ahead of the data and PyCrypto
+provides no way to re-use an expanded key with a new IV.  The cost of a CFB
+operation is dominated by the 8-bit segment size (one AES block operation per
+byte), not by key setup.  CTR performs one block operation per 16 bytes.  See
+test/perf.py for the figures.
+
+In CTR mode, a keystream must never be reused.  An offset (in bytes, a
+multiple of 16) allows a segment to continue the keystream of another that
+shares the same IV.
+"""
+
+CFB = 1
+CTR = 2
+
+
+class PacketKey(object):
+    def __init__(self, key, mode=CFB):
+        assert len(key) == 32
+        assert mode in (CFB, CTR)
+        self.key = key
+        self.mode = mode
+
+    def new(self, iv, offset=0):
+        if self.mode == CTR:
+            assert offset % 16 == 0
+            initial = (int(iv.encode('hex'), 16) + offset / 16) % (1 << 128)
+            ctr = Counter.new(128, initial_value=initial,
+                              allow_wraparound=True)
+            return AES.new(self.key, AES.MODE_CTR, counter=ctr)
+        assert offset == 0
+        return AES.new(self.key, AES.MODE_CFB, iv)
+
+    def encrypt(self, iv, data, offset=0):
+        return self.new(iv, offset).encrypt(data)
+
+    def decrypt(self, iv, data, offset=0):
+        return self.new(iv, offset).decrypt(data)
+
+    def encrypt_segments(self, ivs, segments):
+        """Encrypt each segment with the corresponding IV."""
+        new = self.new
+        return [new(iv).encrypt(s) for iv, s in zip(ivs, segments)]
+
+    def decrypt_segments(self, ivs, segments):
+        """Decrypt each segment with the corresponding IV."""
+        new = self.new
+        return [new(iv).decrypt(s) for iv, s in zip(ivs, segments)]
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# armour.py - ASCII armour encoding and parsing of Mimix packets
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import binascii
+import logging
+
+"""
+Mimix packets are sent and pooled as ASCII armour:-
+
+    -----BEGIN MIMIX MESSAGE-----
+    Version: <software version>[/<packet format>]
+
+    <Base64 encoded packet, 76 characters per line>
+    -----END MIMIX MESSAGE-----
+
+In the pools, the armour may be preceded by "Key: value" headers (such as
+the Next-Hop and Expire of outbound messages) and a blank line.  These are
+instructions to the local remailer and are never transmitted.
+
+Armour is parsed in a single pass over its lines, so it can be read directly
+from a file object.  The Base64 lines are decoded by one binascii call.
+binascii silently skips characters outside the Base64 alphabet, so strict
+parsing checks each line first.  It also rejects text around the armour
+other than headers and blank lines.  Lenient parsing ignores surrounding
+text and whitespace, as might be found in a message pasted by a user.
+"""
+
+BEGIN = '-----BEGIN MIMIX MESSAGE-----'
+END = '-----END MIMIX MESSAGE-----'
+# Bytes of binary per line of Base64 (76 characters).
+LINE_BYTES = 57
+BASE64_CHARS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                '0123456789+/=')
+
+
+class ArmourError(Exception):
+    pass
+
+
+class Armoured(object):
+    def __init__(self, binary, version, headers=None):
+        self.binary = binary
+        self.version = version
+        # Any headers that preceded the armour, indexed by key.
+        if headers is None:
+            headers = {}
+        self.headers = headers
+
+
+def encode(binary, version):
+    """Return the armoured text of binary with the given Version."""
+    b2a = binascii.b2a_base64
+    parts = [BEGIN, '\nVersion: ', version, '\n\n']
+    parts.extend([b2a(binary[i:i + LINE_BYTES])
+                  for i in xrange(0, len(binary), LINE_BYTES)])
+    parts.append(END + '\n')
+    return ''.join(parts)
+
+
+def write_headers(f, headers):
+    """
+    Write headers, a sequence of (key, value) tuples, to the file object f.
+    They're followed by a blank line, ready for the armour to be written.
+    """
+    f.write(''.join(["%s: %s\n" % h for h in headers]) + '\n')
+
+
+def read_headers(f):
+    """
+    Return a dict of the headers at the start of the file object f.  Reading
+    stops at the blank line that ends them, so the armour isn't read.
+    """
+    headers = {}
+    for line in f:
+        line = line.rstrip('\r\n')
+        if not line or line == BEGIN:
+            break
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            headers[key] = value.strip()
+    return headers
+
+
+def read(lines, size=None, strict=True):
+    """
+    Parse armour from an iterable of lines, such as a file object, and
+    return an Armoured object.  If size is given, the decoded packet must be
+    exactly that many bytes.  ArmourError is raised if the armour is
+    invalid.
+    """
+    lines = iter(lines)
+    headers = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line == BEGIN or (not strict and line.strip() == BEGIN):
+            break
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            headers[key] = value.strip()
+        elif strict and line.strip():
+            raise ArmourError("Unexpected text before armour")
+    else:
+        raise ArmourError("Armour BEGIN line not found")
+    line = next(lines, '').strip()
+    if not line.startswith('Version: '):
+        raise ArmourError("Version header not found")
+    version = line[9:].strip()
+    if next(lines, 'EOF').strip():
+        raise ArmourError("No blank line after Version header")
+    body = []
+    for line in lines:
+        line = line.rstrip('\r\n') if strict else line.strip()
+        if line == END:
+            break
+        body.append(line)
+    else:
+        raise ArmourError("Armour END line not found")
+    data = ''.join(body)
+    if strict:
+        if data.translate(None, BASE64_CHARS):
+            raise ArmourError("Invalid Base64 content")
+        for line in lines:
+            if line.strip():
+                raise ArmourError("Unexpected text after armour")
+    try:
+        binary = binascii.a2b_base64(data)
+    except binascii.Error:
+        raise ArmourError("Invalid Base64 content")
+    if size is not None and len(binary) != size:
+        raise ArmourError("Incorrect packet size")
+    return Armoured(binary, version, headers)
+
+
+def decode(text, size=None, strict=True):
+    """Parse armoured text.  See read()."""
+    return read(text.split('\n'), size, strict)
+
+
+log = logging.getLogger("mimix.%s" % __name__)
@@ -25,10 +25,54 @@ import timing
 import sqlite3
 import sys
 import logging
+import zlib
 import sendmail
 from email.parser import Parser
 
+
+# Chunks are up to 10KB.  With 16KB pages, each is held in a single page
+# rather than spilling into overflow pages.
+PAGE_SIZE = 16384
+
+
+class ChunkerError(Exception):
+    pass
+
+
+def inflate(chunks, f, limit):
+    """
+    Decompress an iterable of zlib compressed chunks into the file f.  No
+    more than limit bytes will be written.  A ChunkerError is raised if the
+    output would exceed the limit or the compressed data is invalid.
+    """
+    d = zlib.decompressobj()
+    written = 0
+    try:
+        for data in chunks:
+            while data:
+                out = d.decompress(data, limit + 1 - written)
+                written += len(out)
+                if written > limit:
+                    raise ChunkerError("Decompressed size exceeds %s bytes"
+                                       % limit)
+                f.write(out)
+                data = d.unconsumed_tail
+        out = d.flush()
+    except zlib.error, e:
+        raise ChunkerError("Decompression failed: %s" % e)
+    written += len(out)
+    if written > limit:
+        raise ChunkerError("Decompressed size exceeds %s bytes" % limit)
+    f.write(out)
+    return written
+
+
 class Chunker(object):
+    """
+    Chunks are held in their own DB (database/chunks) so the churn of large
+    inserts and deletes doesn't contend with the directory DB.  Pages freed
+    by deleted chunks are returned to the filesystem by vacuum().
+    """
     def __init__(self, conn):
         conn.text_factory = str
         cursor = conn.cursor()
@@ -63,13 +107,66 @@ class Chunker(object):
         [ chunk         Text                           Message chunk ]
         """
         log.info('Creating DB table "chunker"')
+        # These only take effect when the DB is new.
+        self.exe('PRAGMA page_size = %s' % PAGE_SIZE)
+        self.exe('PRAGMA auto_vacuum = INCREMENTAL')
         self.exe('''CREATE TABLE chunker (msgid TEXT, inserted TEXT,
                                           chunknum INT, numchunks INT,
                                           chunk TEXT)''')
+        self.exe('CREATE INDEX chunker_msgid ON chunker (msgid, chunknum)')
+        self.conn.commit()
+
+    def migrate(self, conn):
+        """
+        Earlier versions kept the chunks in the directory DB.  Move any that
+        are there to this DB.  Returns the number of chunks moved.
+        """
+        cursor = conn.cursor()
+        cursor.execute("""SELECT name FROM sqlite_master
+                          WHERE type='table' AND name='chunker'""")
+        if cursor.fetchone() is None:
+            return 0
+        cursor.execute('''SELECT msgid, inserted, chunknum, numchunks, chunk
+                          FROM chunker''')
+        self.cursor.executemany('''INSERT INTO chunker (msgid, inserted,
+                                                        chunknum, numchunks,
+                                                        chunk)
+                                   VALUES (?,?,?,?,?)''', cursor)
+        moved = self.cursor.rowcount
         self.conn.commit()
+        cursor.execute('DROP TABLE chunker')
+        conn.commit()
+        log.info("Moved %s chunks from the directory DB", moved)
+        return moved
+
+    def vacuum(self):
+        """
+        Return the pages freed by deleted chunks to the filesystem.  Returns
+        the number of free pages there were.
+        """
+        self.exe('PRAGMA freelist_count')
+        free = self.cursor.fetchone()[0]
+        if free > 0:
+            self.exe('PRAGMA incremental_vacuum')
+            self.cursor.fetchall()
+            self.conn.commit()
+        return free
 
     def insert(self, exit_info):
-        insert = (exit_info.messageid.encode('hex'),
+        """
+        Store a chunk.  A client may send a chunk again if it can't confirm
+        the first copy was delivered, so a chunk that's already held is
+        ignored.  Returns the number of chunks stored (0 or 1).
+        """
+        msgid = exit_info.messageid.encode('hex')
+        self.exe('''SELECT COUNT(*) FROM chunker
+                    WHERE msgid = ? AND chunknum = ?''',
+                 (msgid, exit_info.chunknum))
+        if self.cursor.fetchone()[0] > 0:
+            log.debug("%s: Ignoring duplicate of chunk %s.", msgid,
+                      exit_info.chunknum)
+            return 0
+        insert = (msgid,
                   exit_info.chunknum,
                   exit_info.numchunks,
                   exit_info.payload,)
@@ -106,6 +203,12 @@ class Chunker(object):
         self.exe('SELECT COUNT(msgid) FROM chunker WHERE msgid = ?', criteria)
         return int(self.cursor.fetchone()[0])
 
+    def size(self):
+        """Return a tuple of (number of chunks, total bytes) in the DB."""
+        self.exe('SELECT COUNT(*), SUM(LENGTH(chunk)) FROM chunker')
+        count, size = self.cursor.fetchone()
+        return count, size or 0
+
     def chunk_check(self, msgid):
         criteria = (msgid,)
         self.exe('SELECT chunknum, numchunks FROM chunker WHERE msgid = ?',
@@ -132,16 +235,30 @@ class Chunker(object):
                 return False
         return True
 
-    def assemble(self, msgid, filename):
+    def assemble(self, msgid, filename, deflated=False):
+        """
+        Write the chunks of msgid to filename.  If the chunks are deflated,
+        they're decompressed to no more than the configured inflatemax
+        bytes.  If that fails, the message is discarded and ChunkerError is
+        raised.
+        """
         criteria = (msgid,)
         self.exe('''SELECT chunk, chunknum FROM chunker
                     WHERE msgid=?
                     ORDER BY chunknum''', criteria)
         d = self.cursor.fetchall()
-        msg = (''.join([e[0] for e in d]))
-        with open(filename, 'w') as f:
-            f.write(msg)
-        self.delete(msgid)
+        try:
+            with open(filename, 'w') as f:
+                if deflated:
+                    inflate([e[0] for e in d], f,
+                            config.getint('general', 'inflatemax'))
+                else:
+                    f.write(''.join([e[0] for e in d]))
+        except ChunkerError:
+            os.remove(filename)
+            raise
+        finally:
+            self.delete(msgid)
 
     def list_msgids(self):
         self.exe('SELECT DISTINCT msgid FROM chunker')
@@ -159,9 +276,9 @@ if (__name__ == "__main__"):
     handler.setFormatter(logging.Formatter(fmt=logfmt, datefmt=datefmt))
     log.addHandler(handler)
     
-    dbkeys = os.path.join(config.get('database', 'path'),
-                          config.get('database', 'directory'))
-    with sqlite3.connect(dbkeys) as conn:
+    dbchunks = os.path.join(config.get('database', 'path'),
+                            config.get('database', 'chunks'))
+    with sqlite3.connect(dbchunks) as conn:
         c = Chunker(conn)
         #c.delete_table()
         c.assemble()
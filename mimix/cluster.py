@@ -0,0 +1,327 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# cluster.py - Several servers sharing one remailer identity
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os.path
+import sqlite3
+import struct
+import time
+import zlib
+import libmimix
+import mix
+import timing
+from Config import config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+A cluster is a number of servers that share a remailer identity: the same
+address and secret keys.  The collectors of every node write to a single
+shared inbound pool and each message in it is decoded by exactly one node.
+
+A node claims a message by renaming it to a hidden name that includes its
+node number.  The rename is atomic, so when two nodes try to claim the same
+message only one succeeds.  Messages are partitioned between the nodes by a
+CRC of their filename.  A node only claims messages from another node's
+partition once they've waited longer than "steal", so a node that's down
+doesn't hold up its share of the pool.  A node that stops part way through a
+run releases its claims when it restarts.
+
+Packet IDs are recorded in a replay store that all the nodes share, in place
+of the local IDLog.  Recording an ID is a single atomic operation, so a
+packet that's replayed to two nodes at once is still only processed once.
+Two stores are provided:-
+
+    [ sqlite:<file>     A SQLite DB.  The file must be on a filesystem with
+                        working locks (so not NFS).  It's intended for
+                        nodes on a single host and for testing.           ]
+    [ redis://...       A Redis server.  This requires the redis module.  ]
+
+Node 0 is the primary.  It generates the keys and publishes the secret keys
+to keys.json in the shared directory, from where the other nodes import
+them.  Chunks are reassembled and pings are matched by the primary, so other
+nodes pass the exit packets they decode to it through the shared exits
+directory.
+"""
+
+# Chunk number, number of chunks, Message ID, exit type and payload length
+# of a forwarded exit packet.  The payload follows.
+EXIT_HEADER = '<BB16sBH'
+KEYRING_COLUMNS = ('keyid', 'name', 'address', 'pubkey', 'seckey', 'validfr',
+                   'validto', 'advertise', 'smtp', 'uptime', 'latency',
+                   'formats', 'xkeyid', 'xpubkey', 'xseckey', 'exittypes')
+
+
+class ClusterError(Exception):
+    pass
+
+
+def write_file(directory, data):
+    """Atomically write data to a new, uniquely named file in directory."""
+    while True:
+        name = 'x' + os.urandom(8).encode('hex')
+        fqfn = os.path.join(directory, name)
+        if not os.path.exists(fqfn):
+            break
+    tmpfn = os.path.join(directory, '.' + name)
+    with open(tmpfn, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpfn, fqfn)
+    return fqfn
+
+
+class SQLiteReplay(object):
+    """
+    A Packet ID store in a SQLite DB that's shared by the nodes.  It has the
+    same interface as keys.IDLog.
+    """
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.cursor = self.conn.cursor()
+        self.exe = self.cursor.execute
+        if 'replay' not in libmimix.list_tables(self.conn):
+            self.create()
+
+    def create(self):
+        """
+        Table Structure
+        [ pid           Text                              Message ID ]
+        [ date          Date                  Message processed date ]
+        """
+        log.info('Creating DB table "replay"')
+        self.exe('''CREATE TABLE IF NOT EXISTS replay (pid TEXT PRIMARY KEY,
+                                                       date DATE)''')
+        self.conn.commit()
+
+    def __getitem__(self, pid):
+        """Record pid.  Returns True if it was already recorded."""
+        self.exe('INSERT OR IGNORE INTO replay (pid, date) VALUES (?, ?)',
+                 (pid.encode('hex'), timing.today()))
+        self.conn.commit()
+        if self.cursor.rowcount == 0:
+            log.warn("Packet ID Collision detected")
+            return True
+        return False
+
+    def count(self):
+        self.exe('SELECT COUNT(pid) FROM replay')
+        return self.cursor.fetchone()[0]
+
+    def prune(self):
+        numdays = config.getint('general', 'idage')
+        criteria = (timing.date_past(days=numdays),)
+        self.exe('DELETE FROM replay WHERE date <= ?', criteria)
+        self.conn.commit()
+        return self.cursor.rowcount
+
+
+class RedisReplay(object):
+    """
+    A Packet ID store on a Redis server.  Each ID is a key that Redis
+    expires after general/idage days, so prune has nothing to do.
+    """
+    prefix = 'mimix:pid:'
+
+    def __init__(self, url):
+        if redis is None:
+            raise ClusterError("A Redis replay store requires the redis "
+                               "module")
+        self.redis = redis.StrictRedis.from_url(url)
+        self.ttl = config.getint('general', 'idage') * 86400
+
+    def __getitem__(self, pid):
+        """Record pid.  Returns True if it was already recorded."""
+        if self.redis.set(self.prefix + pid.encode('hex'), timing.today(),
+                          nx=True, ex=self.ttl):
+            return False
+        log.warn("Packet ID Collision detected")
+        return True
+
+    def count(self):
+        return sum(1 for k in self.redis.scan_iter(match=self.prefix + '*'))
+
+    def prune(self):
+        return 0
+
+
+def replay_store(url):
+    """Return the Packet ID store for a cluster/replay URL."""
+    if url.startswith('sqlite:'):
+        return SQLiteReplay(url[7:])
+    if url.startswith('redis://') or url.startswith('unix://'):
+        return RedisReplay(url)
+    raise ClusterError("Unknown replay store: %s" % url)
+
+
+class Cluster(object):
+    def __init__(self, shareddir, node, nodes, steal):
+        if not 0 <= node < nodes:
+            raise ClusterError("Node %s isn't in a cluster of %s nodes"
+                               % (node, nodes))
+        self.node = node
+        self.nodes = nodes
+        self.steal = steal
+        self.primary = node == 0
+        self.prefix = '.c%s-' % node
+        self.exitdir = os.path.join(shareddir, 'exits')
+        self.keyfile = os.path.join(shareddir, 'keys.json')
+        # The last keys published or imported, so unchanged keys are
+        # skipped.
+        self.published = None
+        self.imported = None
+
+    def owner(self, name):
+        """Return the node whose partition the pool file name is in."""
+        return (zlib.crc32(name) & 0xffffffff) % self.nodes
+
+    def claim(self, filename):
+        """
+        Claim the pool file filename for this node.  Returns the claimed
+        file's new name or None if it's not ours to take or another node
+        took it first.
+        """
+        head, tail = os.path.split(filename)
+        if self.owner(tail) != self.node:
+            try:
+                age = time.time() - os.path.getmtime(filename)
+            except OSError:
+                return None
+            if age < self.steal:
+                return None
+        claimed = os.path.join(head, self.prefix + tail)
+        try:
+            os.rename(filename, claimed)
+        except OSError:
+            return None
+        return claimed
+
+    def claimed(self, filenames):
+        """Generate the names of the files this node claims."""
+        for filename in filenames:
+            claimed = self.claim(filename)
+            if claimed is not None:
+                yield claimed
+
+    def release(self, pooldir):
+        """Return this node's claimed files to the pool."""
+        released = 0
+        for f in os.listdir(pooldir):
+            if f.startswith(self.prefix):
+                os.rename(os.path.join(pooldir, f),
+                          os.path.join(pooldir, f[len(self.prefix):]))
+                released += 1
+        if released > 0:
+            log.info("Released %s claimed messages", released)
+        return released
+
+    def forward(self, exit_info):
+        """Pass a decoded exit packet to the primary."""
+        header = struct.pack(EXIT_HEADER,
+                             exit_info.chunknum,
+                             exit_info.numchunks,
+                             exit_info.messageid,
+                             exit_info.exit_type,
+                             len(exit_info.payload))
+        write_file(self.exitdir, header + exit_info.payload)
+
+    def forwarded(self):
+        """
+        Generate the exit packets forwarded by the other nodes.  Each file is
+        removed once the packet has been processed.
+        """
+        size = struct.calcsize(EXIT_HEADER)
+        for f in os.listdir(self.exitdir):
+            if f.startswith('.'):
+                continue
+            fqfn = os.path.join(self.exitdir, f)
+            with open(fqfn, 'rb') as fh:
+                data = fh.read()
+            (chunknum, numchunks, messageid, exit_type,
+             length) = struct.unpack(EXIT_HEADER, data[:size])
+            payload = data[size:]
+            if len(payload) == length:
+                exit_info = mix.ExitEncode()
+                exit_info.set_chunks(messageid, chunknum, numchunks)
+                exit_info.set_exit_type(exit_type)
+                exit_info.set_payload(payload)
+                yield exit_info
+            else:
+                log.warn("%s: Truncated exit packet", f)
+            os.remove(fqfn)
+
+    def publish_keys(self, conn):
+        """Publish the primary's secret keys to the other nodes."""
+        cursor = conn.cursor()
+        cursor.execute('SELECT %s FROM keyring WHERE seckey IS NOT NULL '
+                       'AND name = ? ORDER BY keyid'
+                       % ','.join(KEYRING_COLUMNS),
+                       (config.get('general', 'name'),))
+        keyring = [dict(zip(KEYRING_COLUMNS, row))
+                   for row in cursor.fetchall()]
+        text = json.dumps(keyring, indent=1)
+        if text == self.published:
+            return 0
+        # The file is only ever readable by us, even while it's written.
+        tmpfn = os.path.join(os.path.dirname(self.keyfile), '.keys.json')
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        fd = os.open(tmpfn, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmpfn, self.keyfile)
+        self.published = text
+        log.info("Published %s secret keys to the cluster", len(keyring))
+        return len(keyring)
+
+    def import_keys(self, conn):
+        """
+        Import the secret keys published by the primary.  Returns the number
+        of keys imported, 0 if they're unchanged since the last import.
+        """
+        try:
+            with open(self.keyfile) as f:
+                text = f.read()
+        except IOError:
+            return 0
+        if text == self.imported:
+            return 0
+        keyring = json.loads(text)
+        # The primary's keyring may have columns this one predates.
+        libmimix.upgrade_keyring(conn)
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR REPLACE INTO keyring (%s) VALUES (%s)'
+                           % (','.join(KEYRING_COLUMNS),
+                              ','.join('?' * len(KEYRING_COLUMNS))),
+                           [[k[c] for c in KEYRING_COLUMNS]
+                            for k in keyring])
+        conn.commit()
+        self.imported = text
+        log.info("Imported %s secret keys from the cluster", len(keyring))
+        return len(keyring)
+
+
+log = logging.getLogger("mimix.%s" % __name__)
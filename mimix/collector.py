@@ -0,0 +1,323 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# collector.py - HTTP message collector for the Mimix Remailer
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import logging
+import os
+import os.path
+import sys
+import threading
+import urlparse
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from Config import config, make_dirs
+from daemon import Daemon
+import admission
+import armour
+
+"""
+The collector is the inbound side of a Mimix remailer.  It accepts HTTP POST
+submissions (a form with a single "base64" field, as sent by other remailers
+and by the client) at /collector.py/msg and writes them to the inbound pool.
+It holds no state beyond admission control counters and a cache of recently
+seen packets, so any number of collectors can feed the same pool.
+
+A Base64 encoded Mimix packet is 27308 characters, plus a newline every 76
+characters and the armour lines.  Form encoding can triple that in the worst
+case.
+"""
+
+MAX_POST = 128 * 1024
+MAX_MESSAGE = 32 * 1024
+
+
+class CollectorError(Exception):
+    pass
+
+
+def validate(text):
+    """
+    Parse a submitted message and return it as an armour.Armoured object.
+    A CollectorError is raised if the submission is not a plausible Mimix
+    message.  Only a single, complete packet is accepted; nothing may
+    surround the armour.
+    """
+    if len(text) > MAX_MESSAGE:
+        raise CollectorError("Message too large")
+    try:
+        armoured = armour.decode(text.strip(), size=20480)
+    except armour.ArmourError, e:
+        raise CollectorError(str(e))
+    if armoured.headers:
+        raise CollectorError("Unexpected headers")
+    return armoured
+
+
+def packet_check(armoured):
+    """
+    Perform the cheap, key-independent check that Decode would otherwise
+    only perform after the message had been written to disk.  The top
+    header must match its own SHA-512 digest.  The digest is returned so it
+    can be used to identify replays.  Expects a packet that has passed
+    validate().
+    """
+    packet = armoured.binary
+    digest = packet[960:1024]
+    if hashlib.sha512(packet[:960]).digest() != digest:
+        raise CollectorError("Digest mismatch")
+    return digest
+
+
+class SeenCache(object):
+    """
+    A bounded, in-memory record of recently seen top header digests.  Every
+    hop rewrites the top header so a repeated digest can only be a replay
+    (or a resend) of a packet already in the pool.  Once full, the oldest
+    digests are forgotten.  The IDLog remains the authoritative replay
+    defence; this just avoids storing duplicates.
+    """
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.digests = OrderedDict()
+
+    def seen(self, digest):
+        """Record digest and return True if it was already known."""
+        with self.lock:
+            if digest in self.digests:
+                return True
+            self.digests[digest] = True
+            if len(self.digests) > self.size:
+                self.digests.popitem(last=False)
+            return False
+
+    def forget(self, digest):
+        """Remove digest, so a packet that couldn't be stored isn't
+        treated as a duplicate when it's sent again.
+        """
+        with self.lock:
+            self.digests.pop(digest, None)
+
+
+def pool_write(pooldir, text):
+    """
+    Atomically write text to a new, uniquely named file in the pool.  The
+    content is written to a hidden temporary file which is then hard linked
+    to its final name.  The Pool ignores hidden files so a partially written
+    message is never processed.
+    """
+    tmpfn = os.path.join(pooldir, '.t' + os.urandom(8).encode('hex'))
+    with open(tmpfn, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        while True:
+            fn = os.path.join(pooldir, 'm' + os.urandom(4).encode('hex'))
+            try:
+                os.link(tmpfn, fn)
+                break
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+    finally:
+        os.unlink(tmpfn)
+    return fn
+
+
+class Collector(object):
+    """
+    The WSGI application.  Mimix messages are stored in the inbound pool
+    and, for the benefit of remailers running without Apache, the files in
+    wwwdir (such as remailer-conf.txt) are served on GET requests.
+    """
+    def __init__(self, pooldir, wwwdir=None, admit=None, seen=None):
+        self.pooldir = pooldir
+        self.wwwdir = wwwdir
+        self.admit = admit
+        if seen is None:
+            seen = SeenCache()
+        self.seen = seen
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = environ.get('PATH_INFO', '/')
+        if method == 'POST' and path == '/collector.py/msg':
+            status, headers, body = self.submit(environ)
+        elif method in ('GET', 'HEAD'):
+            status, headers, body = self.static(path)
+        else:
+            status, headers, body = ('405 Method Not Allowed', [],
+                                     "Method not allowed\n")
+        headers.append(('Content-Type', 'text/plain'))
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers)
+        if method == 'HEAD':
+            return []
+        return [body]
+
+    def submit(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return '411 Length Required', [], "Invalid submission\n"
+        if length > MAX_POST:
+            return ('413 Request Entity Too Large', [],
+                    "Invalid submission\n")
+        form = urlparse.parse_qs(environ['wsgi.input'].read(length))
+        if 'base64' not in form:
+            return '400 Bad Request', [], "Invalid submission\n"
+        if self.admit is not None:
+            # Remailers claim their address in a sender field.  The claim
+            # is checked against the client's IP address (see admission).
+            sender = form.get('sender', [None])[0]
+            try:
+                self.admit.admit(environ.get('REMOTE_ADDR'), sender)
+            except admission.AdmissionError, e:
+                log.info("Refused submission: %s", e)
+                return ('503 Service Unavailable',
+                        [('Retry-After', str(e.retry_after))],
+                        "Service unavailable\n")
+        try:
+            armoured = validate(form['base64'][0])
+            digest = packet_check(armoured)
+        except CollectorError, e:
+            log.debug("Rejected submission: %s", e)
+            return '400 Bad Request', [], "Invalid submission\n"
+        if self.seen.seen(digest):
+            # The sender gets a success response.  An honest remailer
+            # resending after a lost response would otherwise keep trying.
+            log.debug("Discarded duplicate submission")
+            return '200 OK', [], "Mimix message submitted\n"
+        # The armour is written afresh, so the pool only ever holds it in
+        # its canonical form.
+        text = armour.encode(armoured.binary, armoured.version)
+        try:
+            fn = pool_write(self.pooldir, text)
+        except (IOError, OSError):
+            self.seen.forget(digest)
+            raise
+        if self.admit is not None:
+            self.admit.stored(len(text))
+        log.debug("%s: Stored inbound message", os.path.basename(fn))
+        return '200 OK', [], "Mimix message submitted\n"
+
+    def static(self, path):
+        if self.wwwdir is None:
+            return '404 Not Found', [], "Not found\n"
+        name = os.path.basename(path)
+        fn = os.path.join(self.wwwdir, name)
+        if name.startswith('.') or not os.path.isfile(fn):
+            return '404 Not Found', [], "Not found\n"
+        with open(fn, 'r') as f:
+            return '200 OK', [], f.read()
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.client_address[0], format % args)
+
+
+class CollectorServer(Daemon):
+    def run(self, conlog=False):
+        logfmt = config.get('logging', 'format')
+        datefmt = config.get('logging', 'datefmt')
+        loglevels = {'debug': logging.DEBUG, 'info': logging.INFO,
+                     'warn': logging.WARN, 'error': logging.ERROR}
+        global log
+        log = logging.getLogger("mimix")
+        log.setLevel(loglevels[config.get('logging', 'level')])
+        if conlog:
+            handler = logging.StreamHandler()
+        else:
+            filename = os.path.join(config.get('logging', 'dir'),
+                                    'collector.log')
+            handler = logging.FileHandler(filename, mode='a')
+        handler.setFormatter(logging.Formatter(fmt=logfmt, datefmt=datefmt))
+        log.addHandler(handler)
+        admit = admission.Admission(config.get('pool', 'indir'),
+                                    srcrate=config.getint('http', 'srcrate'),
+                                    srcburst=config.getint('http',
+                                                           'srcburst'),
+                                    rate=config.getint('http', 'rate'),
+                                    burst=config.getint('http', 'burst'),
+                                    poolmax=config.getint('pool', 'inmax'),
+                                    poolbytes=config.getint('pool',
+                                                            'inbytes'),
+                                    reserve=config.getint('http', 'reserve'))
+        app = Collector(config.get('pool', 'indir'),
+                        wwwdir=config.get('http', 'wwwdir'),
+                        admit=admit)
+        httpd = make_server(config.get('http', 'listen'),
+                            config.getint('http', 'port'),
+                            app,
+                            server_class=ThreadingWSGIServer,
+                            handler_class=QuietHandler)
+        log.info("Collector listening on %s:%s",
+                 config.get('http', 'listen'), config.getint('http', 'port'))
+        httpd.serve_forever()
+
+
+def store(text):
+    """
+    Validate and store a single submission in the configured inbound pool.
+    This is intended for use by external handlers such as CGI or mod_python.
+    Duplicates are discarded and None is returned.
+    """
+    armoured = validate(text)
+    digest = packet_check(armoured)
+    if seen.seen(digest):
+        return None
+    try:
+        return pool_write(config.get('pool', 'indir'),
+                          armour.encode(armoured.binary, armoured.version))
+    except (IOError, OSError):
+        seen.forget(digest)
+        raise
+
+
+# Used by store().  Under mod_python this persists between requests.
+seen = SeenCache()
+
+
+log = logging.getLogger("mimix.%s" % __name__)
+if (__name__ == "__main__"):
+    make_dirs()
+    pidfile = os.path.join(config.get('general', 'piddir'), 'collector.pid')
+    errlog = os.path.join(config.get('logging', 'dir'), 'collector_err.log')
+    c = CollectorServer(pidfile, stderr=errlog)
+    if len(sys.argv) > 1:
+        cmd = sys.argv[1]
+        if cmd == "--start":
+            c.start()
+        elif cmd == "--stop":
+            c.stop()
+        elif cmd == "--run":
+            c.run(conlog=True)
@@ -0,0 +1,272 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# delivery.py - Delivery state of each next hop remailer
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+import libmimix
+import metrics
+
+"""
+Each failed delivery to a next hop defers further attempts to it for an
+exponentially increasing period (backoff, doubling up to maxbackoff).  A
+remote 503 with a Retry-After header defers it for at least that long.
+While a hop is deferred, messages for it stay in the outbound pool and
+aren't selected for sending.
+
+After threshold consecutive failures the hop's circuit is open.  When the
+deferral expires, the circuit is half-open and only a single message is
+sent as a probe.  If that succeeds, the circuit closes and the hop's other
+messages flow again.  If it fails, the hop is deferred for twice as long.  A
+probe that's never reported on (because the message couldn't be sent) is
+forgotten after probetimeout seconds so another can be sent.
+
+    [ closed      No recent failures; every message is attempted      ]
+    [ open        Deferred; messages are left in the pool             ]
+    [ half-open   Deferral expired; one probe message is attempted    ]
+
+A hop that's busy (a 503 with Retry-After) is deferred for that long without
+counting as a failure.
+
+Failures are counted in the hopstate table of the directory DB so deferrals
+survive a restart.  Hops without failures or deferrals have no entry.
+
+Separately, DeliveryStats keeps moving averages of each hop's success rate
+and response time.  The success rate feeds the uptime of remailers in the
+keyring (see keys.Pinger.update_stats) without generating any traffic.  The
+response time is only the post to the next hop, not a remailer's latency,
+so it's kept for information alone.
+"""
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class HopState(object):
+    def __init__(self, conn, threshold=3, backoff=60, maxbackoff=21600,
+                 probetimeout=60):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.exe = self.cursor.execute
+        self.threshold = threshold
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.probetimeout = probetimeout
+        if 'hopstate' not in libmimix.list_tables(conn):
+            self.create()
+        # Indexed by address, a list of [failures, retry time].
+        self.hops = {}
+        self.exe('SELECT address, failures, retry FROM hopstate')
+        for address, failures, retry in self.cursor.fetchall():
+            self.hops[address] = [failures, retry]
+            metrics.hop_failures.set(failures, next_hop=address)
+        # Hops in the half-open state that already have a probe underway,
+        # indexed by address, with the time the probe was allowed.
+        self.probing = {}
+
+    def create(self):
+        """
+        Table Structure
+        [ address       Text                        Next hop address ]
+        [ failures      Int                 Consecutive failed sends ]
+        [ retry         Real        Earliest next attempt (epoch secs) ]
+        """
+        log.info('Creating DB table "hopstate"')
+        self.exe('''CREATE TABLE hopstate (address TEXT PRIMARY KEY,
+                                           failures INT, retry REAL)''')
+        self.conn.commit()
+
+    def state(self, address, now=None):
+        if address not in self.hops:
+            return CLOSED
+        failures, retry = self.hops[address]
+        if now is None:
+            now = time.time()
+        if now < retry:
+            return OPEN
+        if failures >= self.threshold:
+            return HALF_OPEN
+        return CLOSED
+
+    def held(self, address):
+        """True if messages to address should be left in the pool.  This
+        has no side effects so it's safe to use during pool selection.
+        """
+        return self.state(address) == OPEN
+
+    def allow(self, address):
+        """Return True if a message may be sent to address now.  In the
+        half-open state only the first caller is allowed.
+        """
+        state = self.state(address)
+        if state == OPEN:
+            return False
+        if state == HALF_OPEN:
+            started = self.probing.get(address, 0)
+            if time.time() - started < self.probetimeout:
+                return False
+            log.info("%s: Circuit half-open, sending a probe message.",
+                     address)
+            self.probing[address] = time.time()
+        return True
+
+    def success(self, address):
+        self.probing.pop(address, None)
+        if address not in self.hops:
+            return
+        failures = self.hops.pop(address)[0]
+        if failures >= self.threshold:
+            log.info("%s: Circuit closed after %s failures.", address,
+                     failures)
+        self.exe('DELETE FROM hopstate WHERE address = ?', (address,))
+        self.conn.commit()
+        metrics.hop_failures.set(0, next_hop=address)
+
+    def failure(self, address, retry_after=0):
+        """Record a failed send to address and defer the next attempt.
+        Returns the number of seconds it's deferred for.
+        """
+        self.probing.pop(address, None)
+        failures = self.hops.get(address, [0, 0])[0] + 1
+        delay = min(self.backoff * 2 ** (failures - 1), self.maxbackoff)
+        delay = max(delay, retry_after)
+        retry = time.time() + delay
+        self.hops[address] = [failures, retry]
+        self.exe('INSERT OR REPLACE INTO hopstate (address, failures, retry) '
+                 'VALUES (?, ?, ?)', (address, failures, retry))
+        self.conn.commit()
+        metrics.hop_failures.set(failures, next_hop=address)
+        if failures == self.threshold:
+            log.warn("%s: Circuit open after %s consecutive failures.",
+                     address, failures)
+        return delay
+
+    def defer(self, address, delay):
+        """Defer the next attempt to a busy address by delay seconds
+        without counting a failure.
+        """
+        self.probing.pop(address, None)
+        failures = self.hops.get(address, [0, 0])[0]
+        retry = time.time() + delay
+        self.hops[address] = [failures, retry]
+        self.exe('INSERT OR REPLACE INTO hopstate (address, failures, retry) '
+                 'VALUES (?, ?, ?)', (address, failures, retry))
+        self.conn.commit()
+
+
+class DeliveryStats(object):
+    """
+    Passive reliability statistics for each next hop, gathered from the
+    outcome of every delivery attempt.  For each address, two decayed
+    moving averages are kept:-
+
+        [ success    Fraction of attempts that were accepted   ]
+        [ response   Seconds taken by accepted deliveries      ]
+
+    A sample's weight halves every halflife seconds, so recent outcomes
+    dominate.  Estimates are only given for hops whose samples had a total
+    weight of at least minweight (rounded) when the last was recorded.  The
+    averages are held in memory and written to the hopstats table of the
+    directory DB by flush().
+    """
+    def __init__(self, conn, halflife=21600, minweight=3):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.exe = self.cursor.execute
+        self.halflife = float(halflife)
+        self.minweight = minweight
+        if 'hopstats' not in libmimix.list_tables(conn):
+            self.create()
+        # Indexed by address, a list of [success, weight, response,
+        # response weight, time of the last sample].
+        self.hops = {}
+        self.exe('''SELECT address, success, weight, response, rweight,
+                           updated FROM hopstats''')
+        for row in self.cursor.fetchall():
+            self.hops[row[0]] = list(row[1:])
+        self.dirty = set()
+
+    def create(self):
+        """
+        Table Structure
+        [ address       Text                        Next hop address ]
+        [ success       Real          Decayed average of successes ]
+        [ weight        Real            Weight of success samples ]
+        [ response      Real     Decayed average response (secs) ]
+        [ rweight       Real           Weight of response samples ]
+        [ updated       Real       Time of last sample (epoch secs) ]
+        """
+        log.info('Creating DB table "hopstats"')
+        self.exe('''CREATE TABLE hopstats (address TEXT PRIMARY KEY,
+                                           success REAL, weight REAL,
+                                           response REAL, rweight REAL,
+                                           updated REAL)''')
+        self.conn.commit()
+
+    def decay(self, updated, now):
+        return 0.5 ** (max(0, now - updated) / self.halflife)
+
+    def record(self, address, ok, seconds=None):
+        """Record the outcome of a delivery attempt to address."""
+        now = time.time()
+        if address in self.hops:
+            success, weight, response, rweight, updated = self.hops[address]
+            decay = self.decay(updated, now)
+            weight *= decay
+            rweight *= decay
+        else:
+            success, weight, response, rweight = 0.0, 0.0, 0.0, 0.0
+        success = (success * weight + int(ok)) / (weight + 1)
+        weight += 1
+        if ok and seconds is not None:
+            response = (response * rweight + seconds) / (rweight + 1)
+            rweight += 1
+        self.hops[address] = [success, weight, response, rweight, now]
+        self.dirty.add(address)
+
+    def estimates(self):
+        """
+        Return a dict, indexed by address, of uptime percentages.
+        """
+        results = {}
+        for address, hop in self.hops.items():
+            success, weight, response, rweight, updated = hop
+            if round(weight) < self.minweight:
+                continue
+            results[address] = int(round(100 * success))
+        return results
+
+    def flush(self):
+        """Write the averages that have changed to the DB."""
+        if not self.dirty:
+            return 0
+        self.cursor.executemany('''INSERT OR REPLACE INTO hopstats
+                                   (address, success, weight, response,
+                                    rweight, updated)
+                                   VALUES (?, ?, ?, ?, ?, ?)''',
+                                [[a] + self.hops[a] for a in self.dirty])
+        self.conn.commit()
+        count = len(self.dirty)
+        self.dirty.clear()
+        return count
+
+
+log = logging.getLogger("mimix.%s" % __name__)
@@ -28,42 +28,127 @@ import sqlite3
 import sys
 import logging
 import requests
+import x25519
+import math
+import multiprocessing
+import time
 import libmimix
+import mix
+import Chain
+import sender
+from multiprocessing.pool import ThreadPool
+from Crypto import Random
 from Crypto.Random import random
 
 
+def new_rsa_key(keylen):
+    """
+    Generate an RSA key and return a tuple of (keyid, public PEM, secret
+    PEM).  This is a module level function so it can be run by a worker
+    process.
+    """
+    seckey = RSA.generate(keylen)
+    pubpem = seckey.publickey().exportKey(format='PEM')
+    return (hashlib.md5(pubpem).hexdigest(), pubpem,
+            seckey.exportKey(format='PEM'))
+
+
+class KeyFactory(object):
+    """
+    Generate an RSA key in a separate process so the server loop isn't
+    blocked.  At 4096 bits, generation can take minutes.  Only one key is
+    generated at a time.
+    """
+    def __init__(self):
+        self.pool = None
+        self.result = None
+
+    def busy(self):
+        return self.pool is not None
+
+    def start(self, keylen):
+        if self.busy():
+            return
+        # PyCrypto's RNG must be reinitialized in the worker after fork.
+        self.pool = multiprocessing.Pool(1, initializer=Random.atfork)
+        self.result = self.pool.apply_async(new_rsa_key, (keylen,))
+
+    def collect(self):
+        """Return the (keyid, public PEM, secret PEM) of a generated key if
+        it's finished, otherwise None.
+        """
+        if self.result is None or not self.result.ready():
+            return None
+        try:
+            return self.result.get()
+        except Exception, e:
+            # It'll be tried again during the next daily events.
+            log.error("Background key generation failed: %s", e)
+            return None
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.result = None
+
+
 class SecCache(object):
+    """
+    Secret keys are required to decrypt every received packet, so all the
+    valid secret keys in the keyring are loaded at startup.  This includes
+    a pre-generated key that's pending, so it's ready when it's promoted.
+
+    The cache is a dict of keyid (RSA or X25519) to key object that's never
+    modified after it's loaded.  load() builds a replacement and swaps it
+    in, so a lookup never sees a partly updated cache.  Keys that remain
+    valid are carried across without parsing their PEM again.  Only keys
+    that have expired or been deleted from the keyring are evicted.
+    load() must be called whenever the local secret keys change.
+    """
     def __init__(self, conn):
         self.conn = conn
         self.cursor = conn.cursor()
         self.exe = self.cursor.execute
         self.cache = {}
+        self.load()
 
     def __getitem__(self, keyid):
         """ Return the Secret Key object associated with the keyid provided.
-            If no key is found, return None.  This function also maintains
-            the Secret Key Cache.
+            If no key is found, return None.  The keyid may identify either
+            an RSA key or an X25519 key (an x25519.PrivateKey is returned).
         """
-        if keyid in self.cache:
-            log.debug("Seckey cache hit for %s", keyid)
-            return self.cache[keyid]
-        log.debug("Seckey cache miss for %s", keyid)
-        self.exe('''SELECT seckey FROM keyring
-                    WHERE keyid=? AND seckey IS NOT NULL''', (keyid,))
-        data = self.cursor.fetchone()
-        if data is None or data[0] is None:
-            return None
-        self.cache[keyid] = RSA.importKey(data[0])
-        log.info("%s: Got Secret Key from DB", keyid)
-        return self.cache[keyid]
+        return self.cache.get(keyid)
 
-    def reset(self):
+    def __len__(self):
+        return len(self.cache)
+
+    def load(self):
         """
-        Secret keys are cached when running as a remailer.  This is because
-        the key is required to decrypt every received message.  Clearing the
-        cache ensures it doesn't become stale with expired keys.
+        Replace the cache with the secret keys that are currently valid.
+        Returns the number of keys cached.
         """
-        self.cache = {}
+        self.exe('''SELECT keyid, seckey, xkeyid, xseckey FROM keyring
+                    WHERE seckey IS NOT NULL
+                    AND (validto IS NULL OR validto >= date("now"))''')
+        old = self.cache
+        cache = {}
+        for keyid, seckey, xkeyid, xseckey in self.cursor.fetchall():
+            if keyid in old:
+                cache[keyid] = old[keyid]
+            else:
+                cache[keyid] = RSA.importKey(seckey)
+                log.info("%s: Loaded Secret Key from DB", keyid)
+            if xkeyid is None or xseckey is None:
+                continue
+            if xkeyid in old:
+                cache[xkeyid] = old[xkeyid]
+            else:
+                cache[xkeyid] = x25519.PrivateKey(xseckey.decode('base64'))
+                log.info("%s: Loaded X25519 Secret Key from DB", xkeyid)
+        for keyid in set(old) - set(cache):
+            log.info("%s: Evicted expired Secret Key", keyid)
+        self.cache = cache
+        return len(cache)
 
 
 class IDLog(object):
@@ -112,11 +197,16 @@ class IDLog(object):
 
 class Server(object):
     """
+    keygen is False on cluster nodes other than the primary.  They only use
+    keys imported from the primary and never generate or promote their own.
     """
-    def __init__(self, conn):
+    def __init__(self, conn, keygen=True):
         self.conn = conn
         self.cursor = conn.cursor()
         self.exe = self.cursor.execute
+        self.keygen = keygen
+        self.factory = KeyFactory()
+        libmimix.upgrade_keyring(conn)
         self.daily_events()
 
     def unadvertise(self):
@@ -129,29 +219,103 @@ class Server(object):
 
     def generate(self):
         log.info("Generating new RSA keys")
-        seckey = RSA.generate(config.getint('general', 'keylen'))
-        pubkey = seckey.publickey()
-        pubpem = pubkey.exportKey(format='PEM')
-        keyid = hashlib.md5(pubpem).hexdigest()
+        keyid, pubpem, secpem = new_rsa_key(config.getint('general',
+                                                          'keylen'))
         expire = config.getint('general', 'keyvalid')
+        self.insert_key(keyid, pubpem, secpem, timing.today(),
+                        timing.date_future(days=expire), 1)
+        return (str(keyid), RSA.importKey(secpem))
 
+    def insert_key(self, keyid, pubpem, secpem, validfr, validto, advertise):
+        xkeyid, xpubkey, xseckey = self.generate_x25519()
         insert = (keyid,
                   config.get('general', 'name'),
                   config.get('general', 'address'),
                   pubpem,
-                  seckey.exportKey(format='PEM'),
-                  timing.today(),
-                  timing.date_future(days=expire),
-                  1,
+                  secpem,
+                  validfr,
+                  validto,
+                  advertise,
                   config.getboolean('general', 'smtp'),
                   100,
-                  0)
+                  0,
+                  config.get('general', 'formats'),
+                  xkeyid,
+                  xpubkey,
+                  xseckey)
         self.exe('''INSERT INTO keyring (keyid, name, address, pubkey, seckey,
                                          validfr, validto, advertise, smtp,
-                                         uptime, latency)
-                           VALUES (?,?,?,?,?,?,?,?,?,?,?)''', insert)
+                                         uptime, latency, formats, xkeyid,
+                                         xpubkey, xseckey)
+                           VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', insert)
         self.conn.commit()
-        return (str(keyid), seckey)
+
+    def pending_key(self):
+        """
+        Return a tuple of (keyid, seckey) for a key that was generated in
+        advance and hasn't been used yet, or None.  Pending keys have no
+        validity dates and aren't advertised.
+        """
+        self.exe('''SELECT keyid, seckey FROM keyring
+                    WHERE seckey IS NOT NULL AND validfr IS NULL
+                    AND name = ?''', (config.get('general', 'name'),))
+        return self.cursor.fetchone()
+
+    def promote(self):
+        """
+        Bring a pending key into use, valid from today.  Returns a tuple of
+        (keyid, seckey) or None if there's no pending key.
+        """
+        pending = self.pending_key()
+        if pending is None:
+            return None
+        expire = config.getint('general', 'keyvalid')
+        self.exe('''UPDATE keyring SET validfr = ?, validto = ?, advertise = 1
+                    WHERE keyid = ?''',
+                 (timing.today(), timing.date_future(days=expire),
+                  pending[0]))
+        self.conn.commit()
+        return (pending[0], RSA.importKey(pending[1]))
+
+    def prepare_key(self, keyid):
+        """
+        Start generating the replacement for keyid in the background once
+        it's within general/keyahead days of no longer being advertised.
+        """
+        if self.factory.busy() or self.pending_key() is not None:
+            return
+        self.exe("SELECT validto FROM keyring WHERE keyid = ?", (keyid,))
+        validto = timing.dateobj(self.cursor.fetchone()[0])
+        ahead = libmimix.UNADVERTISE_DAYS + config.getint('general',
+                                                          'keyahead')
+        if timing.date_future(days=ahead) >= validto:
+            log.info("Generating the replacement for KeyID %s in the "
+                     "background", keyid)
+            self.factory.start(config.getint('general', 'keylen'))
+
+    def collect_key(self):
+        """Store a key generated in the background, if one is ready.  This
+        is cheap enough to call on every iteration of the server loop.
+        """
+        key = self.factory.collect()
+        if key is None:
+            return None
+        self.insert_key(key[0], key[1], key[2], None, None, 0)
+        log.info("Stored pre-generated KeyID %s", key[0])
+        return key[0]
+
+    def generate_x25519(self):
+        """
+        Return a tuple of (xkeyid, xpubkey, xseckey) suitable for insertion
+        into the keyring.  If X25519 is disabled, all three are None.  The
+        X25519 key shares the validity of the RSA key it's stored with.
+        """
+        if not config.getboolean('general', 'x25519'):
+            return (None, None, None)
+        key = x25519.PrivateKey()
+        return (x25519.keyid(key.public),
+                key.public.encode('base64').strip(),
+                key.secret.encode('base64').strip())
 
     def test_load(self):
         for n in range(0, 10):
@@ -194,14 +358,27 @@ class Server(object):
         # If any seckeys expired, it's likely a new key will be needed.  Check
         # what key should be advertised and advertise it.
         keyinfo = libmimix.server_key(self.conn)
-        if keyinfo is None:
-            log.info("No valid secret key found.  Generating a new one.")
-            mykey = self.generate()
-            log.info("Advertising newly generated KeyID: %s", mykey[0])
+        if keyinfo is None and not self.keygen:
+            mykey = None
+            log.warn("No valid secret key found.  Waiting for the cluster "
+                     "primary to publish one.")
+        elif keyinfo is None:
+            mykey = self.promote()
+            if mykey is None:
+                log.info("No valid secret key found.  Generating a new one.")
+                mykey = self.generate()
+                log.info("Advertising newly generated KeyID: %s", mykey[0])
+            else:
+                log.info("Advertising pre-generated KeyID: %s", mykey[0])
         else:
             mykey = (keyinfo[0], RSA.importKey(keyinfo[1]))
             log.info("Advertising current KeyID: %s", mykey[0])
-        self.advertise(mykey)
+            if self.keygen:
+                self.add_x25519(mykey[0])
+        if mykey is not None:
+            self.advertise(mykey)
+            if self.keygen:
+                self.prepare_key(mykey[0])
         # This is a list of known remailer addresses.  It's referenced each
         # time this remailer functions as an Intermediate Hop.  The message
         # contains the address of the next_hop and this list confirms that
@@ -214,12 +391,30 @@ class Server(object):
         # requests being sent to dead or never there remailers.
         self.fetch_cache = []
 
+    def add_x25519(self, keyid):
+        """
+        Keys generated before X25519 support have no X25519 key.  Add one
+        so that remailers aren't restricted to RSA until the next key
+        rollover.
+        """
+        self.exe("SELECT xkeyid FROM keyring WHERE keyid=?", (keyid,))
+        if self.cursor.fetchone()[0] is not None:
+            return
+        xkeyid, xpubkey, xseckey = self.generate_x25519()
+        if xkeyid is None:
+            return
+        self.exe("""UPDATE keyring SET xkeyid = ?, xpubkey = ?, xseckey = ?
+                 WHERE keyid = ?""", (xkeyid, xpubkey, xseckey, keyid))
+        self.conn.commit()
+        log.info("Added X25519 KeyID %s to KeyID %s", xkeyid, keyid)
+
     def advertise(self, mykey):
         # mykey is a tuple of (Keyid, BinarySecretKey)
         criteria = (mykey[0],)
-        self.exe("""SELECT name,address,validfr,validto,smtp, pubkey
-                 FROM keyring WHERE keyid=?""", criteria)
-        name, address, fr, to, smtp, pub = self.cursor.fetchone()
+        self.exe("""SELECT name,address,validfr,validto,smtp,pubkey,xkeyid,
+                 xpubkey FROM keyring WHERE keyid=?""", criteria)
+        (name, address, fr, to, smtp, pub, xkeyid,
+         xpub) = self.cursor.fetchone()
         filename = os.path.join(config.get('http', 'wwwdir'),
                                 'remailer-conf.txt')
         with open(filename, 'w') as f:
@@ -229,6 +424,14 @@ class Server(object):
             f.write("Valid From: %s\n" % fr)
             f.write("Valid To: %s\n" % to)
             f.write("SMTP: %s\n" % libmimix.booltext(smtp))
+            f.write("Formats: %s\n" % config.get('general', 'formats'))
+            # Pings only ever exit at the remailer that sent them.
+            f.write("Exit Types: %s\n"
+                    % ",".join([str(t) for t in mix.EXIT_TYPES
+                                if t != mix.EXIT_PING]))
+            if xkeyid is not None:
+                f.write("X25519 KeyID: %s\n" % xkeyid)
+                f.write("X25519 Key: %s\n" % xpub)
             f.write("\n%s\n\n" % pub)
             # Only the addresses of known remailers are advertised. It's up to
             # the third party to gather further details directly from the
@@ -290,17 +493,172 @@ class Server(object):
 
 
 class Pinger(object):
-    def decrement_uptime(address, step):
-        criteria = (step, address)
-        exe("""UPDATE keyring SET uptime = uptime - ?
-               WHERE address = ? AND uptime > 0""", criteria)
-        con.commit()
+    """
+    Measure the uptime and latency of each known remailer.  A ping is a
+    two hop message, through the remailer being pinged and back to this
+    one, with Exit Type 3.  Its payload is a random Ping ID that's recorded
+    in the pings table along with the time it was sent.  When it returns,
+    its arrival time is recorded.
 
-    def increment_uptime(address, step):
-        criteria = (step, address)
-        exe("""UPDATE keyring SET uptime = uptime + ?
-               WHERE address = ? AND uptime < 100""", criteria)
-        con.commit()
+    A ping that hasn't returned within the pinger/timeout period, or that
+    couldn't be posted to the remailer, is a failure.  Over the last
+    pinger/window, a remailer's uptime is the percentage of its pings that
+    returned and its latency is the median time they took (in minutes).
+    """
+    def __init__(self, conn, passive=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.exe = self.cursor.execute
+        # Passive statistics (a delivery.DeliveryStats) to combine with
+        # the ping results.
+        self.passive = passive
+        if 'pings' not in libmimix.list_tables(conn):
+            self.create()
+        # As with the pools, the first run happens after five minutes, or
+        # sooner if the interval is shorter than that.
+        self.trigger_time = min(timing.future(mins=5),
+                                timing.dhms_future(config.get('pinger',
+                                                              'interval')))
+
+    def create(self):
+        """
+        Table Structure
+        [ pingid        Text                             Hex Ping ID ]
+        [ address       Text               Address of pinged remailer ]
+        [ sent          Real                     Time sent (epoch secs) ]
+        [ received      Real      Time received (NULL if not returned) ]
+        [ failed        Int                    True if the post failed ]
+        """
+        log.info('Creating DB table "pings"')
+        self.exe('''CREATE TABLE pings (pingid TEXT PRIMARY KEY, address TEXT,
+                                        sent REAL, received REAL,
+                                        failed INT)''')
+        self.conn.commit()
+
+    def trigger(self):
+        return timing.now() >= self.trigger_time
+
+    def targets(self):
+        """Return a list of (name, address) for every remailer to ping."""
+        myname = config.get('general', 'name')
+        self.exe("""SELECT name, address FROM keyring
+                    WHERE pubkey IS NOT NULL AND advertise AND name != ?""",
+                 (myname,))
+        return self.cursor.fetchall()
+
+    def encode(self, name):
+        """Return an encoded ping through the named remailer, and its ID."""
+        pingid = Random.new().read(16).encode('hex')
+        fmt = config.getint('chain', 'format')
+        if fmt not in libmimix.get_public(self.conn, name)[3]:
+            fmt = mix.FORMAT_CFB
+        chainstr = "%s,%s" % (name, config.get('general', 'name'))
+        m = mix.encode_stream(self.conn, pingid, chainstr, mix.EXIT_PING,
+                              fmt, compress=False).next()
+        return pingid, m
+
+    def ping_all(self):
+        """
+        Send a ping through every known remailer.  The pings are posted
+        concurrently and the remailer stats are then recalculated.
+        """
+        self.trigger_time = timing.dhms_future(config.get('pinger',
+                                                          'interval'))
+        pings = []
+        for name, address in self.targets():
+            try:
+                pingid, m = self.encode(name)
+            except (mix.PacketError, Chain.ChainError), e:
+                log.info("%s: Unable to create ping: %s", name, e)
+                continue
+            pings.append((pingid, address, m))
+        if not pings:
+            return 0
+        timeout = config.getint('pool', 'posttimeout')
+
+        def post(ping):
+            try:
+                sender.post(ping[2], timeout)
+                return False
+            except sender.SendError, e:
+                log.debug("Ping failed: %s", e)
+                return True
+
+        pool = ThreadPool(min(config.getint('pinger', 'threads'),
+                              len(pings)))
+        try:
+            sent = time.time()
+            results = pool.map(post, pings)
+        finally:
+            pool.close()
+        self.exe('''DELETE FROM pings WHERE sent < ?''',
+                 (time.time() - self.window(),))
+        self.cursor.executemany('''INSERT INTO pings (pingid, address, sent,
+                                                     failed)
+                                   VALUES (?, ?, ?, ?)''',
+                                [(p[0], p[1], sent, f)
+                                 for p, f in zip(pings, results)])
+        self.conn.commit()
+        log.info("Sent %s pings, %s failed to post.", len(pings),
+                 results.count(True))
+        self.update_stats()
+        return len(pings)
+
+    def received(self, payload):
+        """Record the return of a ping.  Returns False if it's unknown."""
+        pingid = payload.strip()
+        self.exe('''UPDATE pings SET received = ?
+                    WHERE pingid = ? AND received IS NULL AND NOT failed''',
+                 (time.time(), pingid))
+        self.conn.commit()
+        return self.cursor.rowcount > 0
+
+    def window(self):
+        return timing.dhms_secs(config.get('pinger', 'window'))
+
+    def update_stats(self):
+        """
+        Recalculate uptime and latency for every remailer with completed
+        pings or passive delivery statistics, and write them to the keyring
+        in a single transaction.  Where both exist, the lower uptime is
+        used.  Latency only comes from the pings; passive stats only time
+        the delivery to the next hop, not the whole round trip.  Remailers
+        with neither are left unchanged.
+        """
+        lost = time.time() - timing.dhms_secs(config.get('pinger',
+                                                         'timeout'))
+        self.exe('''SELECT address, received - sent FROM pings
+                    WHERE sent >= ? AND
+                    (received IS NOT NULL OR failed OR sent < ?)''',
+                 (time.time() - self.window(), lost))
+        results = {}
+        for address, latency in self.cursor.fetchall():
+            results.setdefault(address, []).append(latency)
+        estimates = {}
+        if self.passive is not None:
+            for address, uptime in self.passive.estimates().items():
+                estimates[address] = (uptime, None)
+        for address, latencies in results.items():
+            returned = sorted([l for l in latencies if l is not None])
+            uptime = 100 * len(returned) / len(latencies)
+            # With no returned pings there's no latency data.
+            latency = None
+            if returned:
+                latency = int(math.ceil(returned[len(returned) / 2] / 60))
+            if address in estimates:
+                uptime = min(uptime, estimates[address][0])
+            estimates[address] = (uptime, latency)
+        stats = [(uptime, latency, address)
+                 for address, (uptime, latency) in estimates.items()]
+        self.cursor.executemany('''UPDATE keyring
+                                   SET uptime = ?,
+                                       latency = COALESCE(?, latency)
+                                   WHERE address = ?''', stats)
+        self.conn.commit()
+        for uptime, latency, address in stats:
+            log.debug("%s: uptime=%s%%, latency=%s mins", address, uptime,
+                      latency)
+        return len(stats)
 
 
 log = logging.getLogger("mimix.%s" % __name__)
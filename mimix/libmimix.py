@@ -20,15 +20,18 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from Config import config
+import binascii
 import hashlib
 import os.path
 import timing
 import sqlite3
 import sys
-import requests
 import math
-from Crypto.Random import random
-from Crypto.PublicKey import RSA
+# requests, PyCrypto and x25519 take longer to import than most Client
+# commands take to run, so they're imported by the functions that use them.
+
+# Local secret keys stop being advertised this many days before they expire.
+UNADVERTISE_DAYS = 28
 
 
 class KeyImportError(Exception):
@@ -70,15 +73,73 @@ def create_keyring(conn):
     [ smtp          Boolean                   SMTP Exit (Yes/No) ]
     [ uptime        Int  (%)                  Uptime Reliability ]
     [ latency       Int  (Mins)                          Latency ]
+    [ formats       Text                 Supported Packet Formats ]
+    [ xkeyid        Text                        Hex X25519 Keyid ]
+    [ xpubkey       Text                X25519 Public Key (Base64) ]
+    [ xseckey       Text                X25519 Secret Key (Base64) ]
+    [ exittypes     Text               Supported Exit Types (CSV) ]
     """
     cursor = conn.cursor()
     cursor.execute('''CREATE TABLE keyring (keyid TEXT, name TEXT,
                    address TEXT, pubkey TEXT, seckey TEXT, validfr DATE,
                    validto DATE, advertise INT, smtp INT, uptime INT,
-                   latency INT, UNIQUE (keyid))''')
+                   latency INT, formats TEXT, xkeyid TEXT, xpubkey TEXT,
+                   xseckey TEXT, exittypes TEXT, UNIQUE (keyid))''')
+    conn.commit()
+
+
+# Columns added to the keyring since it was first defined, in the order they
+# were introduced.
+UPGRADE_COLUMNS = (('formats', 'TEXT'),
+                   ('xkeyid', 'TEXT'),
+                   ('xpubkey', 'TEXT'),
+                   ('xseckey', 'TEXT'),
+                   ('exittypes', 'TEXT'))
+
+
+def upgrade_keyring(conn):
+    """
+    Add columns introduced since the keyring was created.  Remailers in
+    keyrings that predate the formats column are assumed to support only
+    packet format 1.  Those without an X25519 key are only reachable via RSA.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(keyring)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if not columns:
+        return
+    for column, coltype in UPGRADE_COLUMNS:
+        if column not in columns:
+            cursor.execute("ALTER TABLE keyring ADD COLUMN %s %s"
+                           % (column, coltype))
     conn.commit()
 
 
+def formats(text, default=(1,)):
+    """
+    Convert a comma separated list of packet formats or exit types (as
+    stored in the keyring and advertised in a remailer-conf) to a list of
+    ints.
+    """
+    if not text:
+        return list(default)
+    return [int(f) for f in text.split(',') if f.strip()]
+
+
+def exit_types(conn, name):
+    """
+    Return the Exit Types supported by the named remailer.  Remailers that
+    don't advertise them are assumed to support SMTP (0) and Dummy (1).
+    """
+    cursor = conn.cursor()
+    cursor.execute("""SELECT exittypes FROM keyring
+                   WHERE name=? AND advertise""", (name,))
+    data = cursor.fetchone()
+    if data is None:
+        raise KeystoreError("%s: Unknown remailer name" % name)
+    return formats(data[0], default=(0, 1))
+
+
 def delete_expired(conn):
     """
     Delete remailer entries that are no longer valid.  This applies to both
@@ -109,15 +170,21 @@ def get_public(conn, name):
         and random hops).  Performance is not important so no caching is
         performed.  The KeyID is required as it's encoded in the message
         so the recipient remailer knows which key to use for decryption.
+        The X25519 KeyID and key are None if the remailer doesn't
+        advertise one.
     """
     cursor = conn.cursor()
-    cursor.execute("""SELECT keyid,address,pubkey FROM keyring
-                   WHERE name=? AND advertise""", (name,))
+    cursor.execute("""SELECT keyid,address,pubkey,formats,xkeyid,xpubkey
+                   FROM keyring WHERE name=? AND advertise""", (name,))
     data = cursor.fetchone()
     if data is None:
         raise KeystoreError("%s: Unknown remailer name" % name)
-    else:
-        return (data[0], data[1], RSA.importKey(data[2]))
+    from Crypto.PublicKey import RSA
+    xpubkey = None
+    if data[5]:
+        xpubkey = data[5].decode('base64')
+    return (data[0], data[1], RSA.importKey(data[2]), formats(data[3]),
+            data[4], xpubkey)
 
 
 def all_remailers_by_name(conn, smtp=False):
@@ -173,6 +240,8 @@ def fetch_remailer_conf(url):
     elements is performed and a KeyImportError raised if any validation test
     fails.
     """
+    import requests
+    import x25519
     r = requests.get("%s/remailer-conf.txt" % url)
     if r.text is None:
         raise KeyImportError("Could not fetch URL")
@@ -182,7 +251,7 @@ def fetch_remailer_conf(url):
         raise KeyImportError("Malformed remailer-conf")
     # keys will eventually be a dictionary of all remailer-conf elements but,
     # for now, it's initialized with just the SMTP default.
-    keys = {'smtp': False}
+    keys = {'smtp': False, 'formats': '1', 'exittypes': '0,1'}
     # The first section of the remailer-conf should be colon-spaced key/value
     # pairs.
     for line in sections[0].split("\n"):
@@ -207,6 +276,21 @@ def fetch_remailer_conf(url):
                 raise KeyImportError("Key has already expired")
         elif key == 'SMTP':
             val = textbool(val)
+        elif key == 'Formats':
+            try:
+                val = ",".join([str(f) for f in formats(val)])
+            except ValueError:
+                raise KeyImportError("Invalid packet formats")
+        elif key == 'Exit Types':
+            key = 'exittypes'
+            try:
+                val = ",".join([str(f) for f in formats(val)])
+            except ValueError:
+                raise KeyImportError("Invalid exit types")
+        elif key == 'X25519 KeyID':
+            key = 'xkeyid'
+        elif key == 'X25519 Key':
+            key = 'xpubkey'
         keys[key.lower()] = val
     # Second section is the Public Key
     if (sections[1].startswith("-----BEGIN PUBLIC KEY-----") and
@@ -216,6 +300,19 @@ def fetch_remailer_conf(url):
         raise KeyImportError("Public Key not found")
     if keys['keyid'] != hashlib.md5(keys['pubkey']).hexdigest():
         raise KeyImportError("Key digest error")
+    # The X25519 key is optional.  If it's advertised, it must be valid.
+    if 'xpubkey' in keys:
+        try:
+            xpub = keys['xpubkey'].decode('base64')
+        except binascii.Error:
+            raise KeyImportError("Invalid X25519 key")
+        if len(xpub) != x25519.KEYLEN:
+            raise KeyImportError("Invalid X25519 key length")
+        if keys.get('xkeyid') != x25519.keyid(xpub):
+            raise KeyImportError("X25519 key digest error")
+    else:
+        keys['xkeyid'] = None
+        keys['xpubkey'] = None
     # Third section is a list of other known remailers.  This section is
     # considered optional.
     if num_sections >= 3:
@@ -244,11 +341,17 @@ def insert_remailer_conf(conn, keys):
               keys['pubkey'],
               1,
               100,
-              0)
+              0,
+              keys['formats'],
+              keys['xkeyid'],
+              keys['xpubkey'],
+              keys['exittypes'])
     cursor.execute("""INSERT INTO keyring (name, address, keyid, validfr,
                                            validto, smtp, pubkey,
-                                           advertise, uptime, latency)
-                      VALUES (?,?,?,?,?,?,?,?,?,?)""", values)
+                                           advertise, uptime, latency,
+                                           formats, xkeyid, xpubkey,
+                                           exittypes)
+                      VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)""", values)
     conn.commit()
 
 
@@ -261,6 +364,10 @@ def update_remailer_conf(conn, keys):
               keys['smtp'],
               keys['pubkey'],
               1,
+              keys['formats'],
+              keys['xkeyid'],
+              keys['xpubkey'],
+              keys['exittypes'],
               keys['address'])
     cursor.execute("""UPDATE keyring SET name = ?,
                                          keyid = ?,
@@ -268,17 +375,22 @@ def update_remailer_conf(conn, keys):
                                          validto = ?,
                                          smtp = ?,
                                          pubkey = ?,
-                                         advertise = ?
+                                         advertise = ?,
+                                         formats = ?,
+                                         xkeyid = ?,
+                                         xpubkey = ?,
+                                         exittypes = ?
                       WHERE address = ?""", values)
     conn.commit()
 
 
-def contenders(conn, uptime=None, maxlat=None, minlat=None, smtp=False):
+def contenders(conn, uptime=None, maxlat=None, minlat=None, smtp=False,
+               fmt=None):
     """
     Find all the known Remailers that meet the selection criteria of
-    Uptime, Maximum Latency and Minimum Latency.  An additional criteria
-    of SMTP-only nodes can also be stipulated.  Only the remailer name
-    is returned.
+    Uptime, Maximum Latency and Minimum Latency.  Additional criteria
+    of SMTP-only nodes and support for a packet format can also be
+    stipulated.  Only the remailer name is returned.
     """
     cursor = conn.cursor()
     if uptime is None:
@@ -288,17 +400,17 @@ def contenders(conn, uptime=None, maxlat=None, minlat=None, smtp=False):
     if minlat is None:
         minlat = config.getint('chain', 'minlat')
     criteria = (uptime, maxlat, minlat, smtp)
-    cursor.execute("""SELECT name FROM keyring
+    cursor.execute("""SELECT name,formats FROM keyring
                    WHERE uptime>=? AND latency<=? AND latency>=? AND
                    pubkey IS NOT NULL AND (smtp or smtp=?)""", criteria)
     data = cursor.fetchall()
-    return [e[0] for e in data]
+    return [e[0] for e in data if fmt is None or fmt in formats(e[1])]
 
 
 def unadvertise(conn):
     cursor = conn.cursor()
     # Stop advertising keys that expire in the next 28 days.
-    criteria = (timing.date_future(days=28),)
+    criteria = (timing.date_future(days=UNADVERTISE_DAYS),)
     cursor.execute('''UPDATE keyring SET advertise = 0
                    WHERE (? > validto OR uptime <= 0)
                    AND advertise AND seckey IS NOT NULL''', criteria)
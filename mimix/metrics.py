@@ -0,0 +1,252 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# metrics.py - Counters, gauges and histograms for the Mimix Remailer
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+"""
+Metrics are registered at import time, updated by the server loop and
+rendered in the Prometheus text exposition format by a small HTTP server
+running in a background thread.  The server loop is the only writer so
+updates are not locked.
+"""
+
+# Histogram buckets (in seconds) suitable for anything from a digest
+# calculation to an HTTP delivery.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def labelstr(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, escape(v)) for k, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple([labels[k] for k in self.labels])
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for key, value in sorted(self.values.items()):
+            lines.append("%s%s %s" % (self.name,
+                                      labelstr(self.labels, key),
+                                      number(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+        return False
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            # [count per bucket, sum, count]
+            self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        data = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+                break
+        data[1] += value
+        data[2] += 1
+
+    def time(self, **labels):
+        """Return a context manager that observes the time spent in it."""
+        return Timer(self, labels)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.doc),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append("%s_bucket%s %s" % (
+                    self.name,
+                    labelstr(self.labels, key, ('le', number(bound))),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name,
+                                          labelstr(self.labels, key),
+                                          number(total)))
+            lines.append("%s_count%s %s" % (self.name,
+                                            labelstr(self.labels, key),
+                                            count))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+decode_seconds = registry.histogram(
+    'mimix_decode_seconds',
+    "Time spent decoding packets, by stage (rsa, x25519, aes, digest).",
+    labels=('stage',))
+idlog_seconds = registry.histogram(
+    'mimix_idlog_lookup_seconds',
+    "Time spent checking and recording Packet IDs.")
+packets = registry.counter(
+    'mimix_packets_total',
+    "Packets processed, by pool and result.",
+    labels=('pool', 'result'))
+pool_depth = registry.gauge(
+    'mimix_pool_depth',
+    "Number of messages in each pool.",
+    labels=('pool',))
+delivery_seconds = registry.histogram(
+    'mimix_delivery_seconds',
+    "Time taken to deliver a message to each next hop.",
+    labels=('next_hop',))
+deliveries = registry.counter(
+    'mimix_deliveries_total',
+    "Delivery attempts to each next hop, by result.",
+    labels=('next_hop', 'result'))
+hop_failures = registry.gauge(
+    'mimix_next_hop_failures',
+    "Consecutive failed deliveries to each next hop.",
+    labels=('next_hop',))
+emails = registry.counter(
+    'mimix_email_total',
+    "SMTP deliveries, by result.",
+    labels=('result',))
+chunks = registry.gauge(
+    'mimix_chunks',
+    "Number of chunks held in the Chunk DB.")
+chunk_bytes = registry.gauge(
+    'mimix_chunk_bytes',
+    "Size in bytes of the chunks held in the Chunk DB.")
+dummies = registry.counter(
+    'mimix_dummies_injected_total',
+    "Dummy messages injected into each pool.",
+    labels=('pool',))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host, port):
+    """Expose the registry at http://host:port/metrics from a background
+    thread.
+    """
+    httpd = HTTPServer((host, port), MetricsHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    log.info("Metrics available at http://%s:%s/metrics", host, port)
+    return httpd
+
+
+log = logging.getLogger("mimix.%s" % __name__)
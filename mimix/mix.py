@@ -26,10 +26,17 @@ import logging
 import os.path
 import sys
 import math
+import multiprocessing
+import tempfile
+import zlib
 import libmimix
 import Chain
-from Config import config
-from Crypto.Cipher import AES
+import metrics
+import aescrypt
+import armour
+import x25519
+from Config import config, snapshot
+from cStringIO import StringIO
 from Crypto.Cipher import PKCS1_OAEP
 from Crypto import Random
 
@@ -61,6 +68,10 @@ Each 1024 Byte header contains the following, fixed length components:-
     [ Padding                       30 bytes ]
     [ Message digest                64 bytes ]
 
+If the recipient remailer advertises an X25519 key, the RSA-encrypted session
+key may be replaced by an X25519 ephemeral public key (see x25519.py).  The
+Public key ID is then the X25519 KeyID and the length field is 32.
+
 The 384 Byte Encrypted Header (aka Inner Header), once decrypted, contains
 the following components:-
 
@@ -92,21 +103,74 @@ content comprises:-
     [ Payload (chunk) digest        32 bytes ]
     [ Padding                      187 bytes ]
 
-Currently, only two Exit-Types are understood:-
+Currently, four Exit-Types are understood:-
+
+    [ Exit Type 0                  SMTP to Recipient ]
+    [ Exit Type 1            Dummy Message (discard) ]
+    [ Exit Type 2    Deflated SMTP to Recipient      ]
+    [ Exit Type 3    Ping returning to its sender    ]
 
-    [ Exit Type 0          SMTP to Recipient ]
-    [ Exit Type 1    Dummy Message (discard) ]
+For Exit Type 2, the chunks of the message are concatenated into a zlib
+stream that the exit remailer decompresses.  Exit remailers advertise the
+Exit-Types they understand in their remailer-conf.  Exit Type 3 is only
+ever sent to the remailer that created it (see keys.Pinger) so it isn't
+advertised.
 
 Note, the Payload lenth defines how much of the Payload is real message (up to
 a maximum of 10240 Bytes) and how much is padding that can be stripped.  In a
 multi-chunk message, only the final chunk should ever be less than 10240 Bytes.
+
+Two packet formats are defined.  They share the layout above and differ only
+in how the AES components are encrypted:-
+
+    [ Format 1    AES-CFB (8-bit segments)                    ]
+    [ Format 2    AES-CTR, the IV being the initial counter   ]
+
+The format is declared on the armour "Version:" line.  Format 1 packets carry
+the bare software version, format 2 packets append "/2".  Every hop in a chain
+must support the format of the packet; remailers advertise the formats they
+accept in their remailer-conf.  In format 2, header 9 and the payload share an
+IV so the payload continues the keystream of header 9 (starting at an offset
+of 1024 Bytes), rather than reusing it.
 """
 
+FORMAT_CFB = aescrypt.CFB
+FORMAT_CTR = aescrypt.CTR
+FORMATS = (FORMAT_CFB, FORMAT_CTR)
+# Offset into the keystream of the final IV at which the payload starts.
+PAYLOAD_OFFSET = {FORMAT_CFB: 0, FORMAT_CTR: 1024}
+
+EXIT_SMTP = 0
+EXIT_DUMMY = 1
+EXIT_DEFLATE = 2
+EXIT_PING = 3
+EXIT_TYPES = (EXIT_SMTP, EXIT_DUMMY, EXIT_DEFLATE, EXIT_PING)
+
 
 class PacketError(Exception):
     pass
 
 
+def version_string(fmt, settings=None):
+    """Return the content of the armour Version line for a given format."""
+    if settings is None:
+        settings = snapshot()
+    version = settings.version
+    if fmt == FORMAT_CFB:
+        return version
+    return "%s/%s" % (version, fmt)
+
+
+def format_from_version(version):
+    """Return the packet format declared by an armour Version line."""
+    if '/' not in version:
+        return FORMAT_CFB
+    fmt = version.rsplit('/', 1)[1]
+    if not fmt.isdigit() or int(fmt) not in FORMATS:
+        raise PacketError("Unknown packet format: %s" % fmt)
+    return int(fmt)
+
+
 class IntermediateEncode(object):
     """
     Packet type 0 (intermediate hop):
@@ -169,6 +233,8 @@ class ExitEncode(object):
         """
         [ SMTP message          0 ]
         [ Dummy message         1 ]
+        [ Deflated SMTP message 2 ]
+        [ Ping                  3 ]
         """
         self.exit_type = exit_type
 
@@ -273,6 +339,33 @@ class InnerDecode():
         self.packet_info = packet_info
 
 
+class PublicKeys(object):
+    """
+    A cache of the public key information returned by libmimix.get_public,
+    indexed by remailer name.  RSA ciphers are also cached so their setup is
+    only performed once per remailer.  When pickled (to pass to a worker
+    process), the DB connection and ciphers are dropped; only names already
+    in the cache can then be looked up.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cache = {}
+        self.ciphers = {}
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            self.cache[name] = libmimix.get_public(self.conn, name)
+        return self.cache[name]
+
+    def cipher(self, name):
+        if name not in self.ciphers:
+            self.ciphers[name] = PKCS1_OAEP.new(self[name][2])
+        return self.ciphers[name]
+
+    def __getstate__(self):
+        return {'conn': None, 'cache': self.cache, 'ciphers': {}}
+
+
 class Encode():
     """
     Headers:
@@ -289,10 +382,42 @@ class Encode():
     [ Content                    10238 bytes ]
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, fmt=FORMAT_CFB, keys=None, settings=None):
         # Encode and decode operations require the keystore so scoping it
         # in the Class kind of makes sense.
         self.conn = conn
+        if keys is None:
+            keys = PublicKeys(conn)
+        self.keys = keys
+        if fmt not in FORMATS:
+            raise PacketError("Unknown packet format: %s" % fmt)
+        self.format = fmt
+        if settings is None:
+            settings = snapshot()
+        self.use_x25519 = settings.x25519
+        self.version = version_string(fmt, settings)
+
+    def __getstate__(self):
+        # Encoded packets are returned from worker processes.  The keystore
+        # connection can't be pickled and isn't needed after encoding.
+        state = self.__dict__.copy()
+        del state['conn']
+        del state['keys']
+        return state
+
+    def session_key(self, name):
+        """
+        Return a tuple of (keyid, session key data, AES key) for a hop.
+        X25519 is used if the hop advertises a key for it, RSA otherwise.
+        """
+        rem_info = self.keys[name]
+        if self.use_x25519 and rem_info[5] is not None:
+            ephemeral, aes = x25519.encapsulate(rem_info[5])
+            return rem_info[4], ephemeral, aes
+        # This is the AES key that will be RSA Encrypted.  It's used to
+        # encrypt the 384 Byte inner header part.
+        aes = Random.new().read(32)
+        return rem_info[0], self.keys.cipher(name).encrypt(aes), aes
 
     def encode(self, exit, chain):
         headers = []
@@ -304,31 +429,26 @@ class Encode():
         # 1) A new header is created.
         # 2) Existing headers are encrypted using keys from Step.1.
         # 3) The payload is encrypted using keys from Step.1.
-        for h in range(len(chain)):
+        for this_hop_name in reversed(chain):
             inner = InnerEncode(next_hop)
             # If next_hop is None, this is an Exit message.  This is only True
             # during the first iteration, after which next_hop contains the
             # address of the next hop.
+            key = aescrypt.PacketKey(inner.aes, self.format)
             if next_hop is None:
                 inner.packet_info = exit
-                cipher = AES.new(inner.aes,
-                                 AES.MODE_CFB,
-                                 inner.packet_info.iv)
-                msg = cipher.encrypt(inner.packet_info.payload)
+                msg = key.encrypt(inner.packet_info.iv,
+                                  inner.packet_info.payload)
                 enclen = len(msg)
                 if enclen < 10240:
                     pad_bytes = 10240 - enclen
                     msg += Random.new().read(pad_bytes)
                 assert len(msg) == 10240
             else:
-                for e in range(len(headers)):
-                    cipher = AES.new(inner.aes, AES.MODE_CFB,
-                                     inner.packet_info.ivs[e])
-                    headers[e] = cipher.encrypt(headers[e])
+                headers = key.encrypt_segments(inner.packet_info.ivs, headers)
                 # The payload always gets encrypted with the final IV
-                cipher = AES.new(inner.aes, AES.MODE_CFB,
-                                 inner.packet_info.ivs[8])
-                msg = cipher.encrypt(msg)
+                msg = key.encrypt(inner.packet_info.ivs[8], msg,
+                                  PAYLOAD_OFFSET[self.format])
                 antitag = hashlib.sha256()
                 antitag.update(headers[0])
                 antitag.update(msg)
@@ -336,15 +456,14 @@ class Encode():
 
             # That's it for old header and payload encoding.  The following
             # section handles the header for this specific step.
-            this_hop_name = chain.pop()
-            # This is the AES key that will be RSA Encrypted.  It's used to
-            # encrypt the 384 Byte inner header part.
-            aes = Random.new().read(32)
             iv = Random.new().read(16)
-            # get_public() returns a Tuple of (keyid, address, pubkey)
-            rem_info = libmimix.get_public(self.conn, this_hop_name)
-            cipher = PKCS1_OAEP.new(rem_info[2])
-            rsa_data = cipher.encrypt(aes)
+            # get_public() returns a Tuple of (keyid, address, pubkey,
+            # formats, xkeyid, xpubkey)
+            rem_info = self.keys[this_hop_name]
+            if self.format not in rem_info[3]:
+                raise PacketError("%s does not support packet format %s"
+                                  % (this_hop_name, self.format))
+            keyid, rsa_data, aes = self.session_key(this_hop_name)
             len_rsa = len(rsa_data)
             # The RSA data size is dependent on the RSA key size.  The packet
             # format can accommodate 512 Bytes which results from a 4096 bit
@@ -352,13 +471,14 @@ class Encode():
             assert len_rsa <= 512
             # Pad RSA data
             rsa_data += Random.new().read(512 - len_rsa)
-            cipher = AES.new(aes, AES.MODE_CFB, iv)
+            enc_inner = aescrypt.PacketKey(aes, self.format).encrypt(
+                iv, inner.packetize())
             newhead = struct.pack('<16sH512s16s384s30s',
-                                  rem_info[0].decode('hex'),
+                                  keyid.decode('hex'),
                                   len_rsa,
                                   rsa_data,
                                   iv,
-                                  cipher.encrypt(inner.packetize()),
+                                  enc_inner,
                                   Random.new().read(30))
             digest = hashlib.sha512(newhead).digest()
             newhead += digest
@@ -369,22 +489,22 @@ class Encode():
         binary = (''.join(headers) +
                   Random.new().read((10 - len(headers)) * 1024) +
                   msg)
-        text = "-----BEGIN MIMIX MESSAGE-----\n"
-        text += "Version: %s\n\n" % config.get('general', 'version')
-        text += binary.encode('base64')
-        text += "-----END MIMIX MESSAGE-----\n"
-        self.text = text
+        self.text = armour.encode(binary, self.version)
         # Record the entry point into the chain.  This will be the address of
         # the remailer that the message is finally encrypted to.
         self.send_to_address = next_hop
 
 
 class Decode():
-    def __init__(self, seckey, idlog):
+    def __init__(self, seckey, idlog, settings=None):
         # Encode and decode operations require the keystore so scoping it
         # in the Class kind of makes sense.
         self.seckey = seckey
         self.idlog = idlog
+        if settings is None:
+            settings = snapshot()
+        self.settings = settings
+        self.format = FORMAT_CFB
 
     def decode(self):
         assert len(self.packet) == 20480
@@ -393,7 +513,10 @@ class Decode():
         headers = [self.packet[i:i+1024] for i in range(0, 10240, 1024)]
         # The first header gets processed and removed at this hop.
         tophead = headers.pop(0)
-        if hashlib.sha512(tophead[:960]).digest() != tophead[960:]:
+        timer = metrics.decode_seconds.time
+        with timer(stage='digest'):
+            digest = hashlib.sha512(tophead[:960]).digest()
+        if digest != tophead[960:]:
             log.warn("Digest mismatch checking current header")
             raise PacketError("Digest mismatch")
         # Extract the keyid required to decrypt the message.
@@ -401,16 +524,29 @@ class Decode():
         secret_key = self.seckey[keyid]
         if secret_key is None:
             raise PacketError("Unknown recipient secret key")
-        cipher = PKCS1_OAEP.new(secret_key)
         len_rsa = struct.unpack('<H', tophead[16:18])[0]
         # Extract the AES key for the inner header.
-        aes = cipher.decrypt(tophead[18:18 + len_rsa])
+        if isinstance(secret_key, x25519.PrivateKey):
+            with timer(stage='x25519'):
+                try:
+                    aes = secret_key.decapsulate(tophead[18:18 + len_rsa])
+                except x25519.X25519Error, e:
+                    raise PacketError(str(e))
+        else:
+            with timer(stage='rsa'):
+                cipher = PKCS1_OAEP.new(secret_key)
+                aes = cipher.decrypt(tophead[18:18 + len_rsa])
         assert len(aes) == 32
         iv = tophead[530:546]
         # Now the inner header can be decrypted.
-        cipher = AES.new(aes, AES.MODE_CFB, iv)
-        inner = InnerDecode(cipher.decrypt(tophead[546:546 + 384]))
-        if self.idlog[inner.packet_id]:
+        with timer(stage='aes'):
+            inner_text = aescrypt.PacketKey(aes, self.format).decrypt(
+                iv, tophead[546:546 + 384])
+        with timer(stage='digest'):
+            inner = InnerDecode(inner_text)
+        with metrics.idlog_seconds.time():
+            collision = self.idlog[inner.packet_id]
+        if collision:
             raise PacketError("Packet ID collision")
         # If this is an intermediate message, the remaining 9 header sections
         # need to be decrypted using the AES key from the inner header and the
@@ -418,35 +554,39 @@ class Decode():
         if inner.pkt_type == "0":
             # First, compare the Anti-Tagging Hash stored in the Packet-Info
             # against one calculated at this time.
-            antitag = hashlib.sha256()
-            antitag.update(headers[0])
-            antitag.update(self.packet[10240:])
-            if antitag.digest() != inner.packet_info.antitag:
+            with timer(stage='digest'):
+                antitag = hashlib.sha256()
+                antitag.update(headers[0])
+                antitag.update(self.packet[10240:])
+                antitag = antitag.digest()
+            if antitag != inner.packet_info.antitag:
                 log.warn("Anti-tag digest failure.  This message might have "
                          "been tampered with.")
                 raise PacketError("Anti-tag digest mismatch")
-            for h in range(9):
-                cipher = AES.new(inner.aes, AES.MODE_CFB,
-                                 inner.packet_info.ivs[h])
-                headers[h] = cipher.decrypt(headers[h])
-            # Use the final IV to decrypt the payload
-            cipher = AES.new(inner.aes, AES.MODE_CFB,
-                             inner.packet_info.ivs[8])
+            with timer(stage='aes'):
+                # The final IV is used for both the last header and the
+                # payload.
+                ivs = inner.packet_info.ivs
+                key = aescrypt.PacketKey(inner.aes, self.format)
+                headers = key.decrypt_segments(ivs, headers)
+                payload = key.decrypt(ivs[8], self.packet[10240:20480],
+                                      PAYLOAD_OFFSET[self.format])
             binary = (''.join(headers) +
                       Random.new().read(1024) +
-                      cipher.decrypt(self.packet[10240:20480]))
-            text = "-----BEGIN MIMIX MESSAGE-----\n"
-            text += "Version: %s\n\n" % config.get('general', 'version')
-            text += binary.encode('base64')
-            text += "-----END MIMIX MESSAGE-----\n"
-            self.text = text
+                      payload)
+            # The packet is passed on in the format it arrived in.
+            self.text = armour.encode(binary,
+                                      version_string(self.format,
+                                                     self.settings))
             self.send_to_address = inner.packet_info.next_hop
             self.is_exit = False
 
         elif inner.pkt_type == "1":
-            cipher = AES.new(inner.aes, AES.MODE_CFB, inner.packet_info.iv)
-            inner.packet_info.set_payload(
-                cipher.decrypt(self.packet[10240:20480]))
+            with timer(stage='aes'):
+                payload = aescrypt.PacketKey(inner.aes, self.format).decrypt(
+                    inner.packet_info.iv, self.packet[10240:20480])
+            with timer(stage='digest'):
+                inner.packet_info.set_payload(payload)
             self.is_exit = True
         self.packet_info = inner.packet_info
 
@@ -455,33 +595,16 @@ class Decode():
 
     def file_to_packet(self, filename):
         with open(filename, 'r') as f:
-            packet = ""
-            packet_pos = 0
-            for line in f:
-                if (packet_pos == 0 and
-                        line == '-----BEGIN MIMIX MESSAGE-----\n'):
-                    packet_pos = 1
-                    continue
-                if packet_pos == 1 and line.startswith('Version: '):
-                    version = line.split(': ')[1].strip()
-                    packet_pos = 2
-                if packet_pos == 2:
-                    if len(line) < 70:
-                        continue
-                    else:
-                        packet_pos = 3
-                if packet_pos == 3:
-                    if line.rstrip() == '-----END MIMIX MESSAGE-----':
-                        packet_pos = 4
-                        break
-                    else:
-                        packet += line
-            if packet_pos != 4:
-                raise PacketError("Invalid Mimix file:%s" % packet_pos)
-            self.packet = packet.decode('base64')
-            if len(self.packet) != 20480:
-                raise PacketError("Incorrect packet size")
-            self.version = version
+            try:
+                armoured = armour.read(f, size=20480)
+            except armour.ArmourError, e:
+                raise PacketError("Invalid Mimix file: %s" % e)
+        self.packet = armoured.binary
+        self.version = armoured.version
+        self.format = format_from_version(armoured.version)
+        if self.format not in self.settings.formats:
+            raise PacketError("Packet format %s is not accepted"
+                              % self.format)
 
     def packet_import(self, filename):
         """
@@ -492,55 +615,175 @@ class Decode():
         just provide instructions to the sending remailer.
         """
         with open(filename, 'r') as f:
-            payload = f.read()
+            try:
+                armoured = armour.read(f, size=20480)
+            except armour.ArmourError, e:
+                raise PacketError("Invalid Mimix file: %s" % e)
         data = {}
-        packet_start = payload.index('-----BEGIN MIMIX MESSAGE-----\n')
-        base64_end = payload.index('\n-----END MIMIX MESSAGE-----')
-        packet_end = base64_end + 28
-        double_nl = payload.index('\n\n', packet_start, packet_end)
-        base64_start = double_nl + 2
-        for line in payload[:packet_start].split('\n'):
-            if ': ' in line:
-                k, v = self._colonspace(line)
-                data[k] = v
-        version = payload[packet_start:packet_end].split("\n", 2)[1]
-        if not version.startswith('Version: '):
-            raise ValueError('Version header not found')
-        k, v = self._colonspace(version)
-        data[k] = v
-        data['packet'] = payload[packet_start:packet_end]
-        data['binary'] = payload[base64_start:base64_end].decode('base64')
-        assert len(data['binary']) == 20480
+        for k, v in armoured.headers.items():
+            data[k.strip().lower().replace(' ', '_')] = v
+        data['version'] = armoured.version
+        data['packet'] = armour.encode(armoured.binary, armoured.version)
+        data['binary'] = armoured.binary
         return data
 
-    def _colonspace(self, data):
-        key, value = data.split(': ', 1)
-        key = key.strip().lower().replace(' ', '_')
-        return key, value.strip()
 
+def chunk_count(size):
+    return max(1, int(math.ceil(size / 10240.0)))
 
-def send(conn, payload, chainstr, ptype):
-    chain = Chain.Chain(conn)
-    chain.create()
-    msgid = Random.new().read(16)
-    size = len(payload)
-    numchunks = int(math.ceil(size / 10240.0))
-    for chunk in range(0, numchunks):
-        if chunk > 1:
-            # After each chunk the chain needs to be recreated using the same
-            # exit header as the previous pass.
-            chain.create(chainstr=chain.exitstr)
-        startbyte = chunk * 10240
-        endbyte = (chunk + 1) * 10240
-        exit = ExitEncode()
-        exit.set_chunks(msgid, chunk + 1, numchunks)
-        exit.set_exit_type(ptype)
-        exit.set_payload(payload[startbyte:endbyte])
-        m = Encode(conn)
-        m.encode(exit, chain.chain)
+
+def encode_chunk(task):
+    """Encode a single chunk.  task is a tuple of (exit, chain, exitstr, fmt,
+    keys, settings).  This is a module level function so it can be run by
+    worker processes.  The exit packet info and the chain string are kept
+    with the encoded packet so it can be encoded again by reencode().
+    """
+    exit, chain, exitstr, fmt, keys, settings = task
+    m = Encode(None, fmt, keys, settings)
+    m.encode(exit, chain)
+    m.exit_info = exit
+    m.chain = chain
+    m.exitstr = exitstr
     return m
 
 
+def reencode(conn, m, avoid=(), keys=None, settings=None):
+    """
+    Encode the chunk carried by m over a fresh chain to the same exit
+    remailer, for when the original packet couldn't be delivered.  The
+    entry remailer is selected from those not in avoid, where possible.
+    """
+    chain = Chain.Chain(conn, settings)
+    chain.create(chainstr=m.exitstr, fmt=m.format, avoid=avoid)
+    if keys is None:
+        keys = PublicKeys(conn)
+    return encode_chunk((m.exit_info, chain.chain, chain.exitstr, m.format,
+                         keys, chain.settings))
+
+
+def deflate(payload, size):
+    """
+    Compress size bytes from the file-like payload into a temporary file.
+    Returns a tuple of (file, compressed size).  The payload is compressed
+    a chunk at a time so memory use doesn't depend on its size.
+    """
+    compressor = zlib.compressobj(9)
+    f = tempfile.TemporaryFile()
+    remaining = size
+    while remaining > 0:
+        data = payload.read(min(remaining, 10240))
+        if not data:
+            break
+        remaining -= len(data)
+        f.write(compressor.compress(data))
+    f.write(compressor.flush())
+    compressed = f.tell()
+    f.seek(0)
+    return f, compressed
+
+
+def encode_stream(conn, payload, chainstr, ptype, fmt=None, workers=0,
+                  size=None, compress=None, settings=None):
+    """
+    Split a payload into 10240 Byte chunks and yield an encoded packet (an
+    Encode object) for each, in chunk order.  Chunks can only be reassembled
+    at the exit so every chunk shares the exit remailer of the first.  The
+    remaining links are selected afresh for each chunk, as before.  Where
+    possible, each chunk enters the network through a different remailer so
+    a single slow entry doesn't hold up the whole message.  Public keys are
+    looked up (and RSA ciphers initialized) once per remailer.
+
+    The payload is either a string or a file-like object.  The number of
+    chunks is encoded in every packet so, for a file, size must give the
+    number of bytes that will be read from it.  Files are read one chunk at
+    a time so memory use doesn't depend on the size of the message.
+
+    If compress is True (the default is set by the chain/compress option),
+    an SMTP payload is deflated and sent as Exit Type 2, provided the exit
+    remailer supports it and the result needs fewer chunks.  In that case
+    the payload must support seek(0) so it can be re-read if compression
+    doesn't help.
+
+    If workers is greater than 1, multi-chunk payloads are encoded by that
+    many worker processes.  Chains and keys are resolved in this process as
+    the DB connection can't be shared with the workers.  Chunks are handed
+    out in batches of two per worker.
+    """
+    if settings is None:
+        settings = snapshot()
+    if fmt is None:
+        fmt = settings.format
+    if compress is None:
+        compress = settings.compress
+    if size is None:
+        size = len(payload)
+    if not hasattr(payload, 'read'):
+        payload = StringIO(payload)
+    chain = Chain.Chain(conn, settings)
+    chain.create(chainstr=chainstr, fmt=fmt)
+    if (compress and ptype == EXIT_SMTP and
+            EXIT_DEFLATE in libmimix.exit_types(conn, chain.exit)):
+        deflated, deflated_size = deflate(payload, size)
+        if chunk_count(deflated_size) < chunk_count(size):
+            payload, size, ptype = deflated, deflated_size, EXIT_DEFLATE
+        else:
+            deflated.close()
+            payload.seek(0)
+    keys = PublicKeys(conn)
+    msgid = Random.new().read(16)
+    numchunks = chunk_count(size)
+    # The number of chunks is a single byte in the Packet Info.
+    if numchunks > 255:
+        raise PacketError("Message too large: %s chunks" % numchunks)
+
+    def tasks():
+        entries = set()
+        for chunk in range(0, numchunks):
+            if chunk > 0:
+                # After each chunk the chain needs to be recreated using the
+                # same exit remailer as the previous pass.
+                previous = chain.entry
+                chain.create(chainstr=chain.exitstr, fmt=fmt, avoid=entries)
+                if chain.entry in entries:
+                    # Every available entry has been used; start again,
+                    # avoiding only the entry of the previous chunk.
+                    entries.clear()
+                    chain.create(chainstr=chain.exitstr, fmt=fmt,
+                                 avoid=[previous])
+            entries.add(chain.entry)
+            for name in chain.chain:
+                keys[name]
+            data = payload.read(10240)
+            if chunk < numchunks - 1 and len(data) < 10240:
+                raise PacketError("Payload shorter than its declared size")
+            exit = ExitEncode()
+            exit.set_chunks(msgid, chunk + 1, numchunks)
+            exit.set_exit_type(ptype)
+            exit.set_payload(data)
+            yield exit, chain.chain, chain.exitstr, fmt, keys, settings
+
+    if workers > 1 and numchunks > 1:
+        # PyCrypto's RNG must be reinitialized in each worker after fork.
+        pool = multiprocessing.Pool(min(workers, numchunks),
+                                    initializer=Random.atfork)
+        try:
+            batch = []
+            for task in tasks():
+                batch.append(task)
+                if len(batch) == workers * 2:
+                    for m in pool.imap(encode_chunk, batch):
+                        yield m
+                    batch = []
+            for m in pool.imap(encode_chunk, batch):
+                yield m
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for task in tasks():
+            yield encode_chunk(task)
+
+
 log = logging.getLogger("mimix.%s" % __name__)
 if (__name__ == "__main__"):
     logfmt = config.get('logging', 'format')
@@ -561,4 +804,5 @@ Subject: Testing
 Hello World!
 """
     with sqlite3.connect(libmimix.dbfn()) as conn:
-        send(conn, text)
+        for m in encode_stream(conn, text, None, 0):
+            sys.stdout.write(m.text)
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# mixsim.py - Pool mixing algorithm simulator for Mimix
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import random
+import sys
+import Pool
+import timing
+
+
+def percentile(values, pct):
+    """Return the pct percentile of a sorted list of values."""
+    if not values:
+        return 0
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def simulate(algorithm, arrivals, interval, rate, size, hours, warmup=0,
+             seed=None):
+    """
+    Simulate an outbound pool fed by a Poisson process of arrivals (messages
+    per hour) and drained every interval by the named mixing algorithm.  The
+    simulation runs for the given number of hours.  Messages sent during the
+    warmup hours are not included in the results.
+
+    A dictionary of results is returned.  Latencies are in seconds.  The
+    anonymity set of a message is taken to be the number of messages in the
+    pool at the moment it was sent.
+    """
+    rng = random.Random(seed)
+    mix = Pool.mixer(algorithm, rate, size, rng=rng)
+    step = timing.dhms_secs(interval)
+    end = hours * 3600
+    start = warmup * 3600
+    # Arrival times of messages currently sitting in the pool.
+    pool = []
+    latencies = []
+    anonsets = []
+    batches = 0
+    if arrivals > 0:
+        next_arrival = rng.expovariate(arrivals / 3600.0)
+    else:
+        next_arrival = end + 1
+    tick = step
+    while tick <= end:
+        while next_arrival <= tick:
+            pool.append(next_arrival)
+            next_arrival += rng.expovariate(arrivals / 3600.0)
+        numfiles = len(pool)
+        process_num = mix.batch_size(numfiles)
+        if process_num > 0:
+            sent = set(Pool.sample_indices(numfiles, process_num, rng=rng))
+            if tick > start:
+                batches += 1
+                for i in sent:
+                    latencies.append(tick - pool[i])
+                    anonsets.append(numfiles)
+            pool = [t for i, t in enumerate(pool) if i not in sent]
+        tick += step
+    latencies.sort()
+    anonsets.sort()
+    sent = len(latencies)
+    measured = float(max(end - start, 1))
+    results = {'sent': sent,
+               'queued': len(pool),
+               'batches': batches,
+               'throughput': sent / measured * 3600,
+               'lat_mean': sum(latencies) / float(max(sent, 1)),
+               'lat_p50': percentile(latencies, 50),
+               'lat_p90': percentile(latencies, 90),
+               'lat_p99': percentile(latencies, 99),
+               'lat_max': percentile(latencies, 100),
+               'anon_mean': sum(anonsets) / float(max(sent, 1)),
+               'anon_min': percentile(anonsets, 0),
+               'anon_p50': percentile(anonsets, 50)}
+    return results
+
+
+def report(results):
+    sys.stdout.write("Messages sent: %(sent)s in %(batches)s batches, "
+                     "%(queued)s still queued\n" % results)
+    sys.stdout.write("Throughput: %(throughput).1f msgs/hour\n" % results)
+    sys.stdout.write("Latency (mins): mean=%.1f p50=%.1f p90=%.1f p99=%.1f "
+                     "max=%.1f\n" % (results['lat_mean'] / 60,
+                                     results['lat_p50'] / 60,
+                                     results['lat_p90'] / 60,
+                                     results['lat_p99'] / 60,
+                                     results['lat_max'] / 60))
+    sys.stdout.write("Anonymity set: mean=%(anon_mean).1f "
+                     "min=%(anon_min)s p50=%(anon_p50)s\n" % results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mimix Pool Simulator')
+    parser.add_argument('--algorithm', type=str, default='timed',
+                        choices=sorted(Pool.mixers.keys()),
+                        help="Mixing algorithm to simulate")
+    parser.add_argument('--arrivals', type=float, default=60,
+                        help="Mean arrival rate in messages per hour")
+    parser.add_argument('--interval', type=str, default='15m',
+                        help="Pool trigger interval (e.g. 15m)")
+    parser.add_argument('--rate', type=int, default=65,
+                        help="Pool rate (percent)")
+    parser.add_argument('--size', type=int, default=45,
+                        help="Minimum pool size")
+    parser.add_argument('--hours', type=int, default=168,
+                        help="Duration of the simulation in hours")
+    parser.add_argument('--warmup', type=int, default=24,
+                        help="Hours to run before collecting results")
+    parser.add_argument('--seed', type=int, default=None,
+                        help="Seed the simulation for repeatable results")
+    args = parser.parse_args()
+    report(simulate(args.algorithm, args.arrivals, args.interval, args.rate,
+                    args.size, args.hours, warmup=args.warmup,
+                    seed=args.seed))
+
+
+if (__name__ == "__main__"):
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# profiling.py - Opt-in profiling of the Mimix server loop
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import cProfile
+import logging
+import os
+import os.path
+import time
+import timing
+
+"""
+When enabled, each iteration of the server loop runs under cProfile and the
+stats are dumped to a file in the profile directory.  Only the most recent
+dumps are kept; if none are to be kept, only the stage times are logged.  The wall-clock time spent in each named stage is logged at
+the end of every iteration.  Stages may nest, in which case the outer stage's
+time includes the inner one.
+
+Profiling can be toggled at run time (the server does this on SIGUSR1).  The
+change takes effect at the start of the next iteration.  When disabled, a
+stage costs one attribute lookup and the return of a shared no-op context.
+"""
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.append((self.name, time.time() - self.start))
+        return False
+
+
+class Profiler(object):
+    def __init__(self, dumpdir, keep=48, enabled=False):
+        if keep < 0:
+            raise ValueError("Number of profiles to keep can't be negative")
+        self.dumpdir = dumpdir
+        self.keep = keep
+        self.enabled = False
+        self.wanted = enabled
+        self.profile = None
+        self.iterations = 0
+
+    def toggle(self, *args):
+        """Request profiling be switched on or off.  The arguments allow this
+        to be used directly as a signal handler.
+        """
+        self.wanted = not self.wanted
+
+    def start_iteration(self):
+        if self.wanted != self.enabled:
+            self.enabled = self.wanted
+            if self.enabled:
+                if not os.path.isdir(self.dumpdir):
+                    os.mkdir(self.dumpdir, 0700)
+                log.info("Profiling enabled.  Dumps written to %s",
+                         self.dumpdir)
+            else:
+                log.info("Profiling disabled")
+        if not self.enabled:
+            return
+        self.timings = []
+        self.iteration_start = time.time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self.timings, name)
+
+    def end_iteration(self):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        elapsed = time.time() - self.iteration_start
+        self.iterations += 1
+        if self.keep > 0:
+            filename = os.path.join(self.dumpdir, 'mimix-%s-%06d.prof'
+                                    % (timing.msgidstamp(), self.iterations))
+            self.profile.dump_stats(filename)
+        self.profile = None
+        self.rotate()
+        breakdown = ["%s=%.3fs" % t for t in self.timings]
+        log.info("Profile: %s total=%.3fs", " ".join(breakdown), elapsed)
+
+    def rotate(self):
+        dumps = sorted([f for f in os.listdir(self.dumpdir)
+                        if f.startswith('mimix-') and f.endswith('.prof')])
+        for f in dumps[:len(dumps) - self.keep]:
+            os.remove(os.path.join(self.dumpdir, f))
+
+
+log = logging.getLogger("mimix.%s" % __name__)
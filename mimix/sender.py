@@ -0,0 +1,198 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# sender.py - Concurrent delivery of a message's chunks to entry remailers
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import Queue
+import requests
+import mix
+import Chain
+from Config import config
+
+"""
+The chunks of a message are posted to their entry remailers by a number of
+threads while the next chunks are being encoded.  Each chunk normally has a
+different entry remailer (see mix.encode_stream), so one slow or dead entry
+only delays the chunks sent through it.
+
+A chunk whose delivery fails is encoded again over a fresh chain to the same
+exit (the exit holds the other chunks) and retried, avoiding the entry
+remailers that have already failed it.  The state of each chunk is recorded
+in a ChunkStatus:-
+
+    [ pending   Encoded and waiting to be posted, or being retried ]
+    [ sent      Accepted by an entry remailer                      ]
+    [ failed    Retries exhausted or no alternative chain          ]
+
+A post that times out may still have been accepted, in which case the exit
+receives the chunk twice.  The Chunker ignores duplicate chunks.
+
+Only a bounded number of encoded packets (two per thread) are held waiting
+for a thread, so memory use doesn't depend on the size of the message.
+"""
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class SendError(Exception):
+    pass
+
+
+class ChunkStatus(object):
+    def __init__(self, chunknum, numchunks):
+        self.chunknum = chunknum
+        self.numchunks = numchunks
+        self.state = PENDING
+        self.attempts = 0
+        # Names of the entry remailers this chunk has been posted to.
+        self.entries = []
+        self.error = None
+
+
+def post(m, timeout=None):
+    """Post the encoded packet m to its entry remailer."""
+    url = '%s/collector.py/msg' % m.send_to_address
+    try:
+        r = requests.post(url, data={'base64': m.text}, timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise SendError("Timed out posting to %s" % m.send_to_address)
+    except requests.exceptions.RequestException:
+        raise SendError("Unable to connect to %s" % m.send_to_address)
+    if r.status_code != requests.codes.ok:
+        raise SendError("Delivery to %s failed with status code: %s"
+                        % (url, r.status_code))
+
+
+class ParallelSender(object):
+    """
+    Post the packets of a single message.  progress, if given, is called
+    each time a delivery attempt completes with the chunk's ChunkStatus and
+    the number of chunks sent so far.  The DB
+    connection is only used by the calling thread, to create new chains
+    for retries.
+    """
+    def __init__(self, conn, threads=None, retries=None, timeout=None,
+                 progress=None):
+        if threads is None:
+            threads = config.getint('chain', 'sendthreads')
+        if retries is None:
+            retries = config.getint('chain', 'retries')
+        if timeout is None:
+            timeout = config.getint('chain', 'sendtimeout')
+        self.conn = conn
+        self.threads = max(1, threads)
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.keys = mix.PublicKeys(conn)
+        self.status = {}
+        self.sent = 0
+
+    def worker(self, outbox, results):
+        while True:
+            m = outbox.get()
+            if m is None:
+                break
+            try:
+                post(m, self.timeout)
+                results.put((m, None))
+            except SendError, e:
+                results.put((m, e))
+
+    def submit(self, m, outbox):
+        chunknum = m.exit_info.chunknum
+        if chunknum not in self.status:
+            self.status[chunknum] = ChunkStatus(chunknum,
+                                                m.exit_info.numchunks)
+        status = self.status[chunknum]
+        status.state = PENDING
+        status.attempts += 1
+        status.entries.append(m.chain[0])
+        outbox.put(m)
+
+    def collect(self, result, outbox):
+        """
+        Record the outcome of a delivery attempt.  Returns True if the
+        chunk has been resubmitted.
+        """
+        m, error = result
+        status = self.status[m.exit_info.chunknum]
+        resubmitted = False
+        if error is None:
+            status.state = SENT
+            status.error = None
+            self.sent += 1
+        else:
+            status.error = str(error)
+            log.info("Chunk %s/%s: %s", status.chunknum, status.numchunks,
+                     error)
+            if status.attempts <= self.retries:
+                try:
+                    m = mix.reencode(self.conn, m, status.entries,
+                                     self.keys)
+                except Chain.ChainError, e:
+                    status.error = "%s; no retry chain: %s" % (error, e)
+                else:
+                    resubmitted = True
+            if not resubmitted:
+                status.state = FAILED
+        if self.progress is not None:
+            self.progress(status, self.sent)
+        if resubmitted:
+            self.submit(m, outbox)
+        return resubmitted
+
+    def send(self, packets):
+        """
+        Post each of the encoded packets (typically from mix.encode_stream)
+        and wait until every chunk has been sent or has failed.  Returns a
+        list of ChunkStatus objects in chunk order.
+        """
+        outbox = Queue.Queue()
+        results = Queue.Queue()
+        workers = []
+        for n in range(self.threads):
+            t = threading.Thread(target=self.worker, args=(outbox, results))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        inflight = 0
+        try:
+            for m in packets:
+                self.submit(m, outbox)
+                inflight += 1
+                while inflight >= self.threads * 2:
+                    if not self.collect(results.get(), outbox):
+                        inflight -= 1
+            while inflight > 0:
+                if not self.collect(results.get(), outbox):
+                    inflight -= 1
+        finally:
+            for t in workers:
+                outbox.put(None)
+            for t in workers:
+                t.join()
+        return [self.status[n] for n in sorted(self.status)]
+
+
+log = logging.getLogger("mimix.%s" % __name__)
@@ -29,7 +29,8 @@ from email.mime.text import MIMEText
 
 def sendmsg(msg):
     if msg['From'] and msg['To']:
-        s = smtplib.SMTP('localhost')
+        s = smtplib.SMTP(config.get('general', 'smtphost'),
+                         config.getint('general', 'smtpport'))
         log.debug("Delivering message to: %s", msg['To'])
         try:
             s.sendmail(msg['From'], msg['To'], msg.as_string())
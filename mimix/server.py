@@ -27,13 +27,19 @@ import sqlite3
 import requests
 from email.parser import Parser
 from Config import config
+import Config
 import mix
 import Pool
 import timing
 import keys
 import Chain
 import chunker
+import cluster
+import delivery
 import sendmail
+import metrics
+import profiling
+import signal
 from daemon import Daemon
 from Crypto import Random
 from Crypto.Random import random
@@ -68,7 +74,8 @@ class Server(Daemon):
                              pooldir=config.get('pool', 'outdir'),
                              interval=config.get('pool', 'interval'),
                              rate=config.getint('pool', 'rate'),
-                             size=config.getint('pool', 'size'))
+                             size=config.getint('pool', 'size'),
+                             algorithm=config.get('pool', 'algorithm'))
         Random.atfork()
         self.in_pool = in_pool
         self.out_pool = out_pool
@@ -77,14 +84,78 @@ class Server(Daemon):
         self.count_dummies = 0
         self.count_email_success = 0
         self.count_email_failed = 0
+        if config.getint('metrics', 'port'):
+            metrics.serve(config.get('metrics', 'listen'),
+                          config.getint('metrics', 'port'))
+        # Profiling is toggled on and off by sending the server a SIGUSR1.
+        prof = profiling.Profiler(config.get('logging', 'profiledir'),
+                                  keep=config.getint('logging', 'profilekeep'),
+                                  enabled=config.getboolean('logging',
+                                                            'profile'))
+        signal.signal(signal.SIGUSR1, prof.toggle)
+        self.prof = prof
+        # Options used while processing messages come from a snapshot that
+        # SIGHUP replaces.  The reload happens at the start of the next
+        # iteration, never part way through a pool run.
+        self.settings = Config.snapshot()
+        self.reload_pending = False
+        signal.signal(signal.SIGHUP, self.request_reload)
+        # Clustered nodes share the inbound pool and the Packet ID store.
+        # Only the primary generates keys and handles exit messages.
+        self.cluster = None
+        self.primary = True
+        if config.getboolean('cluster', 'enabled'):
+            self.cluster = cluster.Cluster(
+                config.get('cluster', 'shareddir'),
+                config.getint('cluster', 'node'),
+                config.getint('cluster', 'nodes'),
+                timing.dhms_secs(config.get('cluster', 'steal')))
+            self.primary = self.cluster.primary
+            self.cluster.release(in_pool.pooldir)
+            replay = config.get('cluster', 'replay')
+            if not replay:
+                replay = 'sqlite:%s' % os.path.join(
+                    config.get('cluster', 'shareddir'), 'replay.db')
+            try:
+                idlog = cluster.replay_store(replay)
+            except cluster.ClusterError, e:
+                log.error("Unable to open the replay store: %s", e)
+                sys.exit(1)
 
         dbkeys = os.path.join(config.get('database', 'path'),
                               config.get('database', 'directory'))
+        dbchunks = os.path.join(config.get('database', 'path'),
+                                config.get('database', 'chunks'))
+        vacuum = timing.dhms_secs(config.get('database', 'vacuum'))
+        vacuum_time = timing.future(secs=vacuum)
         with sqlite3.connect(dbkeys) as conn:
-            keyserv = keys.Server(conn)
+            conn.text_factory = str
+            if not self.primary:
+                self.cluster.import_keys(conn)
+            keyserv = keys.Server(conn, keygen=self.primary)
             seckey = keys.SecCache(conn)
-            idlog = keys.IDLog(conn)
-            chunks = chunker.Chunker(conn)
+            if self.cluster is None:
+                idlog = keys.IDLog(conn)
+            # Passive stats from outbound deliveries are combined with the
+            # pinger's when remailer stats are updated.
+            stats = delivery.DeliveryStats(
+                conn,
+                halflife=timing.dhms_secs(config.get('pool',
+                                                     'statshalflife')),
+                minweight=config.getint('pool', 'statsmin'))
+            pinger = keys.Pinger(conn, passive=stats)
+            self.stats = stats
+            self.pinger = pinger
+            # Chunks have a DB and connection of their own.
+            chunks = chunker.Chunker(sqlite3.connect(dbchunks))
+            chunks.migrate(conn)
+            self.hops = delivery.HopState(
+                conn, threshold=config.getint('pool', 'breaker'),
+                backoff=timing.dhms_secs(config.get('pool', 'backoff')),
+                maxbackoff=timing.dhms_secs(config.get('pool', 'maxbackoff')),
+                probetimeout=config.getint('pool', 'posttimeout'))
+            # Next-Hop headers of outbound messages, indexed by filename.
+            self.next_hops = {}
             self.seckey = seckey
             self.idlog = idlog
             self.keyserv = keyserv
@@ -92,14 +163,33 @@ class Server(Daemon):
             self.conn = conn
             # Loop until a SIGTERM or Ctrl-C is received.
             while True:
+                if self.reload_pending:
+                    self.reload()
+                prof.start_iteration()
                 # Every loop, check if it's time to perform hourly/daily
                 # housekeeping actions.
                 if event.daily_trigger():
-                    keyserv.daily_events()
+                    with prof.stage('daily'):
+                        keyserv.daily_events()
+                        # Keys may have been promoted, generated or deleted.
+                        seckey.load()
                     expired = chunks.expire()
                     if expired > 0:
                         log.info("Expired %s chunks from the Chunk DB",
                                  expired)
+                if timing.now() >= vacuum_time:
+                    vacuum_time = timing.future(secs=vacuum)
+                    with prof.stage('vacuum'):
+                        pages = chunks.vacuum()
+                    if pages > 0:
+                        log.debug("Vacuumed %s pages from the Chunk DB",
+                                  pages)
+                # Store a key that's been generated in the background and
+                # preload it, ready for when it's promoted.
+                if keyserv.collect_key() is not None:
+                    seckey.load()
+                if self.cluster is not None:
+                    self.sync_keys()
                 if event.hourly_trigger():
                     log.info("Stats: inbound=%s, outbound=%s, email_sent=%s, "
                              "email_fail=%s, dummies=%s",
@@ -108,6 +198,10 @@ class Server(Daemon):
                              self.count_email_success,
                              self.count_email_failed,
                              self.count_dummies)
+                    # Save the passive delivery stats and apply them to the
+                    # keyring.
+                    stats.flush()
+                    pinger.update_stats()
                 if event.midnight_trigger():
                     log.info("Day Stats: inbound=%s, outbound=%s, "
                              "email_sent=%s, email_fail=%s, dummies=%s",
@@ -124,20 +218,58 @@ class Server(Daemon):
                     if n > 0:
                         log.info("Pruning ID Log removed %s Packet IDs.", n)
                         log.info("After pruning, Packet ID Log contains %s "
-                                 "entries.", idlog.idcount())
-                    # Empty the Secret Key cache
-                    seckey.reset()
+                                 "entries.", idlog.count())
+                    # Evict keys that expired at midnight from the Secret
+                    # Key cache.
+                    seckey.load()
 
                 # Process outbound messages first.  This ensures that no
                 # message is received, processed and sent during the same
                 # iteration.  Not sure if doing so would be a bad thing for
                 # anonymity but not doing is it very unlikely to be bad.
                 if out_pool.trigger():
-                    self.process_outbound()
-                self.process_inbound()
+                    with prof.stage('outbound'):
+                        self.process_outbound()
+                if (self.settings.pinger and self.primary and
+                        pinger.trigger()):
+                    with prof.stage('ping'):
+                        pinger.ping_all()
+                with prof.stage('inbound'):
+                    self.process_inbound()
+                self.update_gauges()
+                prof.end_iteration()
                 # Some consideration should probably given to pool trigger
                 # times rather than stubbornly looping every minute.
-                timing.sleep(60)
+                timing.sleep(self.settings.loop)
+
+    def request_reload(self, signum, frame):
+        self.reload_pending = True
+
+    def reload(self):
+        """Re-read the config file and replace the Settings snapshot."""
+        self.reload_pending = False
+        try:
+            self.settings = Config.reload()
+        except Config.ConfigError, e:
+            log.error("Configuration not reloaded: %s", e)
+            return
+        log.info("Configuration reloaded from %s", Config.configfile)
+
+    def sync_keys(self):
+        """The primary publishes its secret keys and the other nodes of
+        the cluster import them.
+        """
+        if self.primary:
+            self.cluster.publish_keys(self.conn)
+        elif self.cluster.import_keys(self.conn):
+            self.seckey.load()
+
+    def update_gauges(self):
+        metrics.pool_depth.set(len(self.in_pool.listdir()), pool='inbound')
+        metrics.pool_depth.set(len(self.out_pool.listdir()), pool='outbound')
+        count, size = self.chunks.size()
+        metrics.chunks.set(count)
+        metrics.chunk_bytes.set(size)
 
     def process_inbound(self):
         """
@@ -147,10 +279,18 @@ class Server(Daemon):
         chain.  In this instance the message is delivered and not outbound
         queued.
         """
-        self.inject_dummy(config.getint('pool', 'indummy'))
+        self.inject_dummy(self.settings.indummy, 'inbound')
         generator = self.in_pool.select_all()
+        if self.cluster is not None:
+            if self.primary:
+                for exit_info in self.cluster.forwarded():
+                    self.process_exit(exit_info, 'forwarded')
+            if len(self.seckey) == 0:
+                # Leave the messages for nodes that have keys.
+                return
+            generator = self.cluster.claimed(generator)
         for filename in generator:
-            m = mix.Decode(self.seckey, self.idlog)
+            m = mix.Decode(self.seckey, self.idlog, self.settings)
             try:
                 m.file_to_packet(filename)
             except mix.PacketError, e:
@@ -158,6 +298,7 @@ class Server(Daemon):
                 # compliant with the specification.  These messages are
                 # deleted without further consideration.
                 log.debug("Mimix packet read failed with: %s", e)
+                metrics.packets.inc(pool='inbound', result='invalid')
                 self.in_pool.delete(filename)
                 continue
             # Process the Base64 component of the message.
@@ -165,55 +306,82 @@ class Server(Daemon):
                 m.decode()
             except mix.PacketError, e:
                 log.info("Decoding failed with: %s", e)
+                metrics.packets.inc(pool='inbound', result='failed')
                 self.in_pool.delete(filename)
                 continue
             if m.is_exit and m.packet_info.exit_type == 1:
                 # It's a dummy
+                metrics.packets.inc(pool='inbound', result='dummy')
                 self.count_dummies += 1
-                self.in_pool.delete(filename)
-                continue
-            if m.is_exit:
-                log.debug("Exit Message: File=%s, MessageID=%s, ChunkNum=%s,"
-                          " NumChunks=%s, ExitType=%s",
-                          os.path.basename(filename),
-                          m.packet_info.messageid.encode('hex'),
-                          m.packet_info.chunknum,
-                          m.packet_info.numchunks,
-                          m.packet_info.exit_type)
-                if not config.getboolean('general', 'smtp'):
-                    # This Remailer doesn't support SMTP.  The message needs
-                    # to be rand-hopped.
-                    log.debug("Message requires SMTP capable Remailer. "
-                              "Rand-hopping it to an exit node.")
-                    if m.packet_info.numchunks == 1:
-                        self.randhop(m.packet_info)
-                    else:
-                        log.warn("Oh dear, we currently can't randhop "
-                                 "multipart messages.")
-                    self.in_pool.delete(filename)
-                    continue
-                # Exit and SMTP type: Write it to the outbound_pool for
-                # subsequent delivery.
-                if (m.packet_info.chunknum == 1 and
-                        m.packet_info.numchunks == 1):
-                    with open(self.out_pool.filename(), 'w') as f:
-                        f.write(m.packet_info.payload)
-                    self.in_pool.delete(filename)
-                    continue
-                else:
-                    log.debug("Multipart message. Doing chunk processing.")
-                    self.chunks.insert(m.packet_info)
-                    msgid = m.packet_info.messageid.encode('hex')
-                    if self.chunks.chunk_check(msgid):
-                        self.chunks.assemble(msgid, self.out_pool.filename())
-                    self.in_pool.delete(filename)
-                    continue
+            elif m.is_exit and not self.primary:
+                # The primary holds the chunks and knows our pings.
+                metrics.packets.inc(pool='inbound', result='forwarded')
+                self.cluster.forward(m.packet_info)
+            elif m.is_exit:
+                self.process_exit(m.packet_info, os.path.basename(filename))
             else:
                 # Not an exit, write it to the outbound pool.
-                if config.getboolean('general', 'hopspy'):
+                metrics.packets.inc(pool='inbound', result='intermediate')
+                if self.settings.hopspy:
                     self.keyserv.middle_spy(m.packet_info.next_hop)
                 self.out_pool.packet_write(m)
-                self.in_pool.delete(filename)
+            self.in_pool.delete(filename)
+
+    def process_exit(self, packet_info, name):
+        """
+        Handle a decoded exit packet.  name identifies where it came from
+        for logging.
+        """
+        if packet_info.exit_type == mix.EXIT_PING:
+            # One of our pings has returned.
+            if self.pinger.received(packet_info.payload):
+                metrics.packets.inc(pool='inbound', result='ping')
+            else:
+                log.info("Discarding unknown ping")
+                metrics.packets.inc(pool='inbound', result='failed')
+            return
+        if packet_info.exit_type not in mix.EXIT_TYPES:
+            log.info("Unknown Exit Type: %s", packet_info.exit_type)
+            metrics.packets.inc(pool='inbound', result='failed')
+            return
+        metrics.packets.inc(pool='inbound', result='exit')
+        log.debug("Exit Message: File=%s, MessageID=%s, ChunkNum=%s,"
+                  " NumChunks=%s, ExitType=%s",
+                  name,
+                  packet_info.messageid.encode('hex'),
+                  packet_info.chunknum,
+                  packet_info.numchunks,
+                  packet_info.exit_type)
+        if not self.settings.smtp:
+            # This Remailer doesn't support SMTP.  The message needs
+            # to be rand-hopped.
+            log.debug("Message requires SMTP capable Remailer. "
+                      "Rand-hopping it to an exit node.")
+            if packet_info.numchunks == 1:
+                self.randhop(packet_info)
+            else:
+                log.warn("Oh dear, we currently can't randhop "
+                         "multipart messages.")
+            return
+        # Exit and SMTP type: Write it to the outbound_pool for
+        # subsequent delivery.  Deflated messages always go via the
+        # Chunker, which decompresses them.
+        deflated = packet_info.exit_type == mix.EXIT_DEFLATE
+        if (packet_info.chunknum == 1 and
+                packet_info.numchunks == 1 and not deflated):
+            with open(self.out_pool.filename(), 'w') as f:
+                f.write(packet_info.payload)
+        else:
+            log.debug("Multipart message. Doing chunk processing.")
+            self.chunks.insert(packet_info)
+            msgid = packet_info.messageid.encode('hex')
+            if self.chunks.chunk_check(msgid):
+                try:
+                    self.chunks.assemble(msgid,
+                                         self.out_pool.filename(),
+                                         deflated)
+                except chunker.ChunkerError, e:
+                    log.warn("%s: Discarding message: %s", msgid, e)
 
     def process_outbound(self):
         """
@@ -223,8 +391,14 @@ class Server(Daemon):
         to be done prior to transmission.  This happens as part of the inbound
         queue processing.
         """
-        generator = self.out_pool.select_subset()
-        self.inject_dummy(config.getint('pool', 'outdummy'))
+        # Forget the Next-Hop of messages that have left the pool.
+        files = set([os.path.join(self.out_pool.pooldir, f)
+                     for f in self.out_pool.listdir()])
+        for filename in self.next_hops.keys():
+            if filename not in files:
+                del self.next_hops[filename]
+        generator = self.out_pool.select_subset(held=self.held)
+        self.inject_dummy(self.settings.outdummy, 'outbound')
         for filename in generator:
             #m = mix.Decode(self.seckey, self.idlog)
             with open(filename, 'r') as f:
@@ -232,7 +406,12 @@ class Server(Daemon):
             if 'To' in msg:
                 log.debug("Outbound message to %s", msg['To'])
                 if sendmail.sendmsg(msg):
+                    self.count_email_success += 1
+                    metrics.emails.inc(result='success')
                     self.out_pool.delete(filename)
+                else:
+                    self.count_email_failed += 1
+                    metrics.emails.inc(result='failed')
                 continue
             if 'Next-Hop' in msg:
                 log.debug("Outbound message to Next Hop Remailer: %s",
@@ -255,30 +434,77 @@ class Server(Daemon):
                 # message is lost but messages can't be queued forever.
                 log.warn("Giving up on sending msg to %s.",
                          msg['Next-Hop'])
-                #TODO Statistically mark down this remailer.
                 self.out_pool.delete(filename)
                 continue
 
             # That's all the packet valdation completed.  From here on, it's
             # about trying to send the message.
-            payload = {'base64': msg.get_payload()}
+            next_hop = msg['Next-Hop']
+            if not self.hops.allow(next_hop):
+                # The hop is deferred or a probe has already been sent.
+                log.debug("Deferring delivery of %s to %s",
+                          os.path.basename(filename), next_hop)
+                continue
+            payload = {'base64': msg.get_payload(),
+                       'sender': self.settings.address}
             try:
                 # Actually try to send the message to the next_hop.  There are
                 # probably a lot of failure conditions to handle at this point.
-                recipient = '%s/collector.py/msg' % msg['Next-Hop']
+                recipient = '%s/collector.py/msg' % next_hop
                 log.debug("Attempting delivery of %s to %s",
-                          os.path.basename(filename), msg['Next-Hop'])
-                r = requests.post(recipient, data=payload)
+                          os.path.basename(filename), next_hop)
+                with metrics.delivery_seconds.time(next_hop=next_hop):
+                    r = requests.post(recipient, data=payload,
+                                      timeout=self.settings.posttimeout)
+                metrics.deliveries.inc(next_hop=next_hop,
+                                       result=str(r.status_code))
+                try:
+                    retry_after = int(r.headers.get('Retry-After', 0))
+                except ValueError:
+                    retry_after = 0
                 if r.status_code == requests.codes.ok:
+                    self.stats.record(next_hop, True,
+                                      r.elapsed.total_seconds())
+                    self.hops.success(next_hop)
                     self.out_pool.delete(filename)
+                elif (r.status_code == requests.codes.unavailable and
+                        retry_after > 0):
+                    # The hop is up but busy.  That's not a failure.
+                    self.hops.defer(next_hop, retry_after)
+                    log.info("Delivery of %s to %s deferred by a busy hop.  "
+                             "Will retry in %s seconds.",
+                             filename, recipient, retry_after)
+                elif r.status_code >= 500:
+                    self.stats.record(next_hop, False)
+                    delay = self.hops.failure(next_hop, retry_after)
+                    log.info("Delivery of %s to %s failed with status code: "
+                             "%s.  Will retry in %s seconds.",
+                             filename, recipient, r.status_code, delay)
                 else:
+                    # The hop is up but rejected this message.
+                    self.stats.record(next_hop, True,
+                                      r.elapsed.total_seconds())
+                    self.hops.success(next_hop)
                     log.info("Delivery of %s to %s failed with status code: "
                              "%s.  Will keep trying to deliver it.",
                              filename, recipient, r.status_code)
-            except requests.exceptions.ConnectionError:
-                #TODO Mark down remailer statistics.
-                log.info("Unable to connect to %s.  Will keep trying.",
-                         recipient)
+            except requests.exceptions.RequestException:
+                metrics.deliveries.inc(next_hop=next_hop,
+                                       result='unreachable')
+                self.stats.record(next_hop, False)
+                delay = self.hops.failure(next_hop)
+                log.info("Unable to connect to %s.  Will retry in %s "
+                         "seconds.", recipient, delay)
+
+    def held(self, filename):
+        """Pool selection filter.  True if filename is a message for a next
+        hop whose deliveries are currently deferred.
+        """
+        if filename not in self.next_hops:
+            headers = self.out_pool.headers(filename)
+            self.next_hops[filename] = headers.get('Next-Hop')
+        next_hop = self.next_hops[filename]
+        return next_hop is not None and self.hops.held(next_hop)
 
     def validity_check(self):
         if not config.has_option('general', 'name'):
@@ -289,20 +515,36 @@ class Server(Daemon):
             sys.stderr.write("Unable to start server: Remailer address is "
                              "not defined.\n")
             return False
+        if config.getint('logging', 'profilekeep') < 0:
+            sys.stderr.write("Unable to start server: profilekeep can't be "
+                             "negative.\n")
+            return False
+        if (config.getboolean('cluster', 'enabled') and
+                not 0 <= config.getint('cluster', 'node') <
+                config.getint('cluster', 'nodes')):
+            sys.stderr.write("Unable to start server: Cluster node must be "
+                             "less than the number of nodes.\n")
+            return False
         return True
 
-    def inject_dummy(self, odds):
+    def inject_dummy(self, odds, pool):
         if random.randint(1, 100) <= odds:
+            metrics.dummies.inc(pool=pool)
             payload = "From: dummy@dummy\nTo: dummy@dummy\n\npayload"
-            m = mix.send(self.conn,
-                        payload,
-                        config.get('pool', 'dummychain'),
-                        1)
-            self.out_pool.packet_write(m)
+            with self.prof.stage('dummy'):
+                self.out_pool.stream_write(
+                    mix.encode_stream(self.conn,
+                                      payload,
+                                      self.settings.dummychain,
+                                      1,
+                                      settings=self.settings))
 
     def randhop(self, packet_info):
-        m = mix.send(self.conn, packet_info.payload, "*,*", 0)
-        self.out_pool.packet_write(m)
+        # The payload is passed on as it arrived, deflated or not.
+        self.out_pool.stream_write(
+            mix.encode_stream(self.conn, packet_info.payload, "*,*",
+                              packet_info.exit_type, compress=False,
+                              settings=self.settings))
 
 
 class EventTimer(object):
@@ -332,6 +574,7 @@ class EventTimer(object):
         return False
 
 if (__name__ == "__main__"):
+    Config.make_dirs()
     pidfile = os.path.join(config.get('general', 'piddir'),
                            config.get('general', 'pidfile'))
     errlog = os.path.join(config.get('logging', 'dir'), 'err.log')
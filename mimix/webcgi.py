@@ -22,8 +22,7 @@
 import cgi
 import cgitb
 import sys
-import os
-from Crypto import Random
+import collector
 
 cgitb.enable()
 print "Content-type:text/html\r\n\r\n"
@@ -33,11 +32,7 @@ form = cgi.FieldStorage()
 content = form.getvalue('mimix')
 if content is None:
     sys.exit(0)
-if '-----BEGIN MIMIX MESSAGE-----' in content:
-    while True:
-        fn = os.path.join('/home/crooks/mimix/inbound_pool',
-                          'm' + Random.new().read(4).encode('hex'))
-        if not os.path.isfile(fn):
-            break
-    with open(fn, 'w') as f:
-        f.write(content)
+try:
+    collector.store(content)
+except collector.CollectorError:
+    sys.exit(0)
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# x25519.py - X25519 key agreement for Mimix headers
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+from Crypto import Random
+
+try:
+    from nacl.bindings import crypto_scalarmult, crypto_scalarmult_base
+except ImportError:
+    crypto_scalarmult = None
+
+"""
+A header's 32 Byte AES key can be delivered in one of two ways, depending on
+the type of key the recipient remailer advertises:-
+
+    [ RSA       The AES key is encrypted with PKCS1_OAEP              ]
+    [ X25519    The AES key is derived from an ephemeral key agreement ]
+
+In the X25519 case, the RSA-encrypted data slot in the header contains the
+sender's 32 Byte ephemeral public key and the length field is set to 32.  The
+AES key is the SHA256 digest of a context string, the shared secret, the
+ephemeral public key and the recipient's public key.  A fresh ephemeral key
+is generated for every header so no two headers share an AES key.
+
+PyNaCl is used if it's installed.  Otherwise a pure Python implementation of
+RFC 7748 is used.  It produces identical results but is much slower; install
+PyNaCl on busy remailers.
+"""
+
+KEYLEN = 32
+CONTEXT = "mimix-x25519-v1"
+
+P = 2 ** 255 - 19
+A24 = 121665
+
+
+class X25519Error(Exception):
+    pass
+
+
+def clamp(k):
+    k = [ord(c) for c in k]
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    return sum([b << (8 * i) for i, b in enumerate(k)])
+
+
+def decode_u(u):
+    u = [ord(c) for c in u]
+    u[31] &= 127
+    return sum([b << (8 * i) for i, b in enumerate(u)])
+
+
+def encode_u(u):
+    return ''.join([chr((u >> (8 * i)) & 0xff) for i in range(32)])
+
+
+def py_scalarmult(k, u):
+    """The Montgomery ladder from RFC 7748, section 5."""
+    k = clamp(k)
+    x1 = decode_u(u)
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in reversed(range(255)):
+        kt = (k >> t) & 1
+        swap ^= kt
+        if swap:
+            x2, x3 = x3, x2
+            z2, z3 = z3, z2
+        swap = kt
+        a = x2 + z2
+        aa = a * a % P
+        b = x2 - z2
+        bb = b * b % P
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % P
+        cb = c * b % P
+        x3 = (da + cb) ** 2 % P
+        z3 = x1 * (da - cb) ** 2 % P
+        x2 = aa * bb % P
+        z2 = e * (aa + A24 * e) % P
+    if swap:
+        x2, x3 = x3, x2
+        z2, z3 = z3, z2
+    return encode_u(x2 * pow(z2, P - 2, P) % P)
+
+
+def scalarmult(k, u):
+    if crypto_scalarmult is None:
+        shared = py_scalarmult(k, u)
+    else:
+        try:
+            shared = crypto_scalarmult(k, u)
+        except Exception:
+            # libsodium refuses to return an all-zero result.
+            raise X25519Error("Invalid X25519 public key")
+    if shared == '\x00' * KEYLEN:
+        raise X25519Error("Invalid X25519 public key")
+    return shared
+
+
+def public_key(secret):
+    if crypto_scalarmult is None:
+        return py_scalarmult(secret, encode_u(9))
+    return crypto_scalarmult_base(secret)
+
+
+def session_key(shared, ephemeral, public):
+    return hashlib.sha256(CONTEXT + shared + ephemeral + public).digest()
+
+
+def keyid(public):
+    """X25519 KeyIDs are derived in the same way as RSA ones; an MD5 digest
+    of the advertised public key.
+    """
+    return hashlib.md5(public.encode('base64').strip()).hexdigest()
+
+
+def encapsulate(public):
+    """Return a tuple of (ephemeral public key, AES key) for a recipient."""
+    assert len(public) == KEYLEN
+    ephemeral = Random.new().read(KEYLEN)
+    ephemeral_public = public_key(ephemeral)
+    shared = scalarmult(ephemeral, public)
+    return ephemeral_public, session_key(shared, ephemeral_public, public)
+
+
+class PrivateKey(object):
+    def __init__(self, secret=None):
+        if secret is None:
+            secret = Random.new().read(KEYLEN)
+        assert len(secret) == KEYLEN
+        self.secret = secret
+        self.public = public_key(secret)
+
+    def decapsulate(self, ephemeral):
+        """Return the AES key a sender derived with encapsulate()."""
+        if len(ephemeral) != KEYLEN:
+            raise X25519Error("Invalid X25519 ephemeral key length")
+        shared = scalarmult(self.secret, ephemeral)
+        return session_key(shared, ephemeral, self.public)
+
+
+log = logging.getLogger("mimix.%s" % __name__)
@@ -0,0 +1,355 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# loadtest.py - Local Mimix mixnet load generator
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Build a mixnet of N remailers on localhost and feed it synthetic traffic.
+
+Mimix configuration is global to a process so each node runs as a pair of
+subprocesses (server and collector), each with its own HOME, config file,
+keyring and pools.  Every node is an exit and delivers by SMTP to a sink run
+by this script, which is how arrivals are timed.  This script is also the
+client: it has its own keyring, built by fetching each node's remailer-conf.
+
+Two kinds of message are sent:-
+
+    [ Traffic     Random chains of --hops remailers at --rate msgs/sec ]
+    [ Probes      Single hop messages through each node in turn        ]
+
+Probes measure the latency added by each node (the per-hop latency) and
+traffic measures the end-to-end latency of a full chain.
+"""
+
+import argparse
+import asyncore
+import json
+import os
+import os.path
+import shutil
+import smtpd
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+MIMIXDIR = os.path.join(os.path.dirname(TESTDIR), 'mimix')
+CLIENT = os.path.join(MIMIXDIR, 'Client.py')
+
+NODE_CONFIG = """[general]
+name = %(name)s
+address = http://127.0.0.1:%(port)s
+keylen = %(keylen)s
+smtp = yes
+smtphost = 127.0.0.1
+smtpport = %(smtpport)s
+
+[pool]
+size = %(size)s
+rate = %(rate)s
+interval = %(interval)s
+algorithm = %(algorithm)s
+loop = 1s
+indummy = 0
+outdummy = 0
+
+[http]
+wwwdir = %(home)s/www
+listen = 127.0.0.1
+port = %(port)s
+
+[logging]
+level = info
+"""
+
+BODY_LINE = "The quick brown fox jumps over the lazy dog.\n"
+
+CLIENT_CONFIG = """[chain]
+chain = %(chain)s
+distance = %(distance)s
+"""
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def summary(values):
+    return {'count': len(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': percentile(values, 100)}
+
+
+class Sink(smtpd.SMTPServer):
+    """An SMTP server that records when each tagged message arrives."""
+    def __init__(self, port):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', port), None)
+        self.arrived = {}
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        for line in data.split('\n'):
+            if line.startswith('Subject: mimixload '):
+                self.arrived[line.split()[2]] = time.time()
+                break
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class Node(object):
+    def __init__(self, basedir, n, args, smtpport):
+        self.name = "node%s" % n
+        self.home = os.path.join(basedir, self.name)
+        self.port = free_port()
+        self.address = "http://127.0.0.1:%s" % self.port
+        os.makedirs(os.path.join(self.home, 'www'))
+        self.rcfile = os.path.join(self.home, '.mimixrc')
+        with open(self.rcfile, 'w') as f:
+            f.write(NODE_CONFIG % {'name': self.name,
+                                   'port': self.port,
+                                   'home': self.home,
+                                   'keylen': args.keylen,
+                                   'smtpport': smtpport,
+                                   'size': args.size,
+                                   'rate': args.poolrate,
+                                   'interval': args.interval,
+                                   'algorithm': args.algorithm})
+        self.env = dict(os.environ, HOME=self.home, MIMIX=self.rcfile)
+        self.procs = []
+
+    def mimix(self, *cmd):
+        return subprocess.Popen([sys.executable, CLIENT] + list(cmd),
+                                env=self.env,
+                                stdout=open(os.devnull, 'w'),
+                                stderr=open(os.path.join(self.home,
+                                                         '%s.err' % cmd[0]),
+                                            'a'))
+
+    def start(self):
+        # The server expects a keyring table to exist.
+        self.mimix('update').wait()
+        self.procs.append(self.mimix('collector', '--run'))
+        self.procs.append(self.mimix('server', '--run'))
+
+    def stop(self):
+        for p in self.procs:
+            if p.poll() is None:
+                p.terminate()
+                p.wait()
+
+
+def wait_for_conf(nodes, timeout):
+    pending = list(nodes)
+    stop = time.time() + timeout
+    while pending and time.time() < stop:
+        for node in list(pending):
+            try:
+                r = requests.get("%s/remailer-conf.txt" % node.address)
+                if r.status_code == requests.codes.ok:
+                    pending.remove(node)
+            except requests.exceptions.ConnectionError:
+                pass
+        time.sleep(0.5)
+    if pending:
+        raise RuntimeError("Nodes failed to start: %s"
+                           % ", ".join([n.name for n in pending]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mimix Load Generator')
+    parser.add_argument('--nodes', type=int, default=4,
+                        help="Number of remailer nodes")
+    parser.add_argument('--hops', type=int, default=3,
+                        help="Chain length of traffic messages")
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help="Traffic messages sent per second")
+    parser.add_argument('--duration', type=int, default=60,
+                        help="Seconds to send traffic for")
+    parser.add_argument('--drain', type=int, default=120,
+                        help="Seconds to wait for messages to arrive")
+    parser.add_argument('--probe', type=int, default=10,
+                        help="Seconds between single hop probes")
+    parser.add_argument('--keylen', type=int, default=1024,
+                        help="RSA key length for the nodes")
+    parser.add_argument('--size', type=int, default=0,
+                        help="Pool size on each node")
+    parser.add_argument('--poolrate', type=int, default=100,
+                        help="Pool rate on each node (percent)")
+    parser.add_argument('--interval', type=str, default='5s',
+                        help="Pool interval on each node")
+    parser.add_argument('--algorithm', type=str, default='timed',
+                        help="Pool mixing algorithm on each node")
+    parser.add_argument('--format', type=int, default=1,
+                        help="Packet format used for traffic and probes")
+    parser.add_argument('--msgsize', type=int, default=0,
+                        help="Pad messages with text to this many bytes")
+    parser.add_argument('--no-compress', dest='compress',
+                        action='store_false',
+                        help="Don't deflate multi-chunk messages")
+    parser.add_argument('--output', type=str,
+                        help="Write JSON results to a file")
+    parser.add_argument('--keep', action='store_true',
+                        help="Don't delete the node directories")
+    args = parser.parse_args()
+
+    basedir = tempfile.mkdtemp(prefix='mimixload')
+    # Mimix reads its configuration at import time, so this process must
+    # become a client in its own directory before importing anything.
+    client_home = os.path.join(basedir, 'client')
+    os.makedirs(client_home)
+    client_rc = os.path.join(client_home, '.mimixrc')
+    with open(client_rc, 'w') as f:
+        f.write(CLIENT_CONFIG % {'chain': ",".join(["*"] * args.hops),
+                                 'distance': min(args.hops, args.nodes) - 1})
+    os.environ['HOME'] = client_home
+    os.environ['MIMIX'] = client_rc
+    sys.path.insert(0, MIMIXDIR)
+    import sqlite3
+    import libmimix
+    import mix
+    from Config import make_dirs
+    make_dirs()
+
+    smtpport = free_port()
+    sink = Sink(smtpport)
+    t = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.5})
+    t.daemon = True
+    t.start()
+
+    nodes = [Node(basedir, n, args, smtpport) for n in range(args.nodes)]
+    try:
+        for node in nodes:
+            node.start()
+        sys.stderr.write("Waiting for %s nodes to start\n" % len(nodes))
+        wait_for_conf(nodes, 60 + args.keylen / 32)
+        # Every node, and the client, learns about every other node.
+        for node in nodes:
+            for peer in nodes:
+                if peer is not node:
+                    node.mimix('update', '--fetch', peer.address).wait()
+        conn = sqlite3.connect(libmimix.dbfn())
+        conn.text_factory = str
+        libmimix.create_keyring(conn)
+        for node in nodes:
+            libmimix.insert_remailer_conf(
+                conn, libmimix.fetch_remailer_conf(node.address))
+
+        sent = {}
+        probes = {}
+        errors = 0
+        packets = 0
+        start = time.time()
+        next_probe = start
+        probe_node = 0
+        n = 0
+        while time.time() - start < args.duration:
+            tag = "t%s" % n
+            chainstr = None
+            if time.time() >= next_probe:
+                tag = "p%s" % n
+                chainstr = nodes[probe_node].name
+                probes[tag] = nodes[probe_node].name
+                probe_node = (probe_node + 1) % len(nodes)
+                next_probe += args.probe
+            msg = ("From: load@mimix.invalid\nTo: load@mimix.invalid\n"
+                   "Subject: mimixload %s\n\nLoad test message %s\n"
+                   % (tag, tag))
+            msg += BODY_LINE * max(0, (args.msgsize - len(msg))
+                                   / len(BODY_LINE))
+            sent[tag] = time.time()
+            for m in mix.encode_stream(conn, msg, chainstr, 0, args.format,
+                                       compress=args.compress):
+                packets += 1
+                try:
+                    r = requests.post('%s/collector.py/msg'
+                                      % m.send_to_address,
+                                      data={'base64': m.text})
+                    if r.status_code != requests.codes.ok:
+                        errors += 1
+                except requests.exceptions.ConnectionError:
+                    errors += 1
+            n += 1
+            # Pace the traffic to the requested rate.
+            delay = start + n / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        elapsed = time.time() - start
+
+        sys.stderr.write("Sent %s messages.  Draining.\n" % len(sent))
+        stop = time.time() + args.drain
+        while time.time() < stop and len(sink.arrived) < len(sent):
+            time.sleep(1)
+
+        e2e = []
+        perhop = {}
+        for tag, stamp in sent.items():
+            if tag not in sink.arrived:
+                continue
+            latency = sink.arrived[tag] - stamp
+            if tag in probes:
+                perhop.setdefault(probes[tag], []).append(latency)
+            else:
+                e2e.append(latency)
+        traffic = len([t for t in sent if t not in probes])
+        last = max(sink.arrived.values() + [start + elapsed])
+        lost = len([t for t in sent if t not in sink.arrived])
+        results = {'nodes': args.nodes,
+                   'hops': args.hops,
+                   'format': args.format,
+                   'sent': len(sent),
+                   'received': len(sink.arrived),
+                   'post_errors': errors,
+                   'packets': packets,
+                   'lost': lost,
+                   'loss_pct': 100.0 * lost / max(len(sent), 1),
+                   'offered_rate': traffic / elapsed,
+                   'throughput': len(e2e) / (last - start),
+                   'end_to_end': summary(e2e),
+                   'per_hop': dict([(k, summary(v))
+                                    for k, v in perhop.items()])}
+        text = json.dumps(results, indent=2, sort_keys=True) + "\n"
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text)
+        sys.stdout.write(text)
+    finally:
+        for node in nodes:
+            node.stop()
+        if args.keep:
+            sys.stderr.write("Node directories kept in %s\n" % basedir)
+        else:
+            shutil.rmtree(basedir)
+
+
+if (__name__ == "__main__"):
+    main()
@@ -1,27 +1,383 @@
 #!/usr/bin/python
 #
 # vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# perf.py - Benchmarks for the Mimix encode/decode hot paths
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import mix
-import datetime
+"""
+Benchmarks run entirely offline against a throwaway, in-memory keyring.
+Generating 4096 bit keys is slow so a single key is generated for each key
+length and shared by ten remailer entries, each given a distinct KeyID.
 
-def perf():
-    message = mix.Message()
-    plain_text = "Nobody inspects the spammish repetition"
+Startup benchmarks run the Client (and imports of the main modules) in a new
+interpreter, as monitoring scripts do.  Startup.python is the interpreter on
+its own, for comparison.
 
+Results are written as JSON.  If a baseline file exists, each benchmark's
+mean is compared against it and the script exits non-zero if any benchmark
+is slower than the baseline by more than the threshold.
+"""
 
-    start = datetime.datetime.now()
-    for x in range(50):
-        message.text = None
-        chain = ['no.onion', 'no.onion']
-        message.encode(plain_text, chain)
-        while message.text is None:
-            message.decode(message.packet)
-    end = datetime.datetime.now()
-    print message.text
-    print end - start
+import argparse
+import hashlib
+import json
+import os
+import os.path
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
 
-if (__name__ == "__main__"):
-    perf()
+from Crypto.PublicKey import RSA
+from Crypto import Random
+import Crypto
+from mimix import mix
+from mimix import keys
+from mimix import chunker
+from mimix import libmimix
+from mimix import timing
+from mimix import aescrypt
+from mimix import x25519
+from Crypto.Cipher import AES
+from Crypto.Cipher import PKCS1_OAEP
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'perf_baseline.json')
+MIMIXDIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'mimix')
+NUM_REMAILERS = 10
+PAYLOAD = ("From: bench@mimix.invalid\nTo: bench@mimix.invalid\n"
+           "Subject: Benchmark\n\n" + "Nobody inspects the spammish "
+           "repetition.\n" * 200)
+BIG_PAYLOAD = PAYLOAD + Random.new().read(10240 * 10 - len(PAYLOAD))
+
+
+def keyring(keylen):
+    """Return an in-memory DB containing a keyring of NUM_REMAILERS exit
+    remailers, all sharing a single secret key of keylen bits and a single
+    X25519 key.
+    """
+    conn = sqlite3.connect(':memory:')
+    conn.text_factory = str
+    libmimix.create_keyring(conn)
+    seckey = RSA.generate(keylen)
+    pubpem = seckey.publickey().exportKey(format='PEM')
+    secpem = seckey.exportKey(format='PEM')
+    xkey = x25519.PrivateKey()
+    xpub = xkey.public.encode('base64').strip()
+    xsec = xkey.secret.encode('base64').strip()
+    for n in range(NUM_REMAILERS):
+        name = "bench%s" % n
+        keyid = hashlib.md5(pubpem + name).hexdigest()
+        xkeyid = hashlib.md5(xpub + name).hexdigest()
+        insert = (keyid, name, "http://%s.invalid" % name, pubpem, secpem,
+                  timing.today(), timing.date_future(days=30), 1, 1, 100, 0,
+                  '1,2', xkeyid, xpub, xsec)
+        conn.execute('''INSERT INTO keyring (keyid, name, address, pubkey,
+                                             seckey, validfr, validto,
+                                             advertise, smtp, uptime,
+                                             latency, formats, xkeyid,
+                                             xpubkey, xseckey)
+                        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''', insert)
+    conn.commit()
+    return conn
+
+
+def chain(length):
+    return ["bench%s" % (n % NUM_REMAILERS) for n in range(length)]
+
+
+def exit_info(payload=PAYLOAD):
+    exit = mix.ExitEncode()
+    exit.set_chunks(Random.new().read(16), 1, 1)
+    exit.set_exit_type(0)
+    exit.set_payload(payload)
+    return exit
+
+
+def encode(conn, length, fmt=mix.FORMAT_CFB, use_x25519=False):
+    m = mix.Encode(conn, fmt)
+    m.use_x25519 = use_x25519
+    m.encode(exit_info(), chain(length))
+    return m
+
+
+class Bench(object):
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, fn, setup=None, repeat=None):
+        """Time fn repeat times.  If setup is given, its return value is
+        passed to fn and the time it takes is excluded.
+        """
+        if repeat is None:
+            repeat = self.repeat
+        times = []
+        for n in range(repeat):
+            if setup is None:
+                start = time.time()
+                fn()
+            else:
+                arg = setup()
+                start = time.time()
+                fn(arg)
+            times.append((time.time() - start) * 1000)
+        times.sort()
+        self.results[name] = {'n': repeat,
+                              'mean_ms': sum(times) / len(times),
+                              'min_ms': times[0],
+                              'median_ms': times[len(times) / 2]}
+        sys.stderr.write("%-36s %10.3f ms\n" % (name,
+                                                self.results[name]['mean_ms']))
+
+
+def bench_keylen(b, keylen, tmpdir):
+    sys.stderr.write("Generating %s bit key\n" % keylen)
+    conn = keyring(keylen)
+    seckey = keys.SecCache(conn)
+    idlog = keys.IDLog(conn)
+    tag = "%s." % keylen
+
+    b.run(tag + "mix.encode_stream",
+          lambda: list(mix.encode_stream(conn, PAYLOAD, None, 0)))
+    # A 100KB message is ten chunks.
+    b.run(tag + "mix.encode_stream.chunks10",
+          lambda: list(mix.encode_stream(conn, BIG_PAYLOAD, None, 0)))
+    b.run(tag + "mix.encode_stream.chunks10.workers4",
+          lambda: list(mix.encode_stream(conn, BIG_PAYLOAD, None, 0,
+                                         workers=4)))
+    filename = os.path.join(tmpdir, 'packet%s' % keylen)
+    # Format 1 RSA benchmarks keep their original names so existing
+    # baselines remain comparable.
+    for fmt, use_x25519, fmttag in ((mix.FORMAT_CFB, False, ""),
+                                    (mix.FORMAT_CTR, False, "ctr."),
+                                    (mix.FORMAT_CFB, True, "x25519."),
+                                    (mix.FORMAT_CTR, True, "ctr.x25519.")):
+        for length in (1, 3, 5, 10):
+            b.run(tag + fmttag + "Encode.encode.chain%s" % length,
+                  lambda: encode(conn, length, fmt, use_x25519))
+
+        # Every decode needs a fresh packet or the IDLog rejects it as a
+        # replay.  The packets are decoded at the entry hop, so the
+        # symmetric crypto for nine headers and the payload is included.
+        packets = [encode(conn, 2, fmt, use_x25519)
+                   for n in range(b.repeat)]
+
+        def decode_setup():
+            d = mix.Decode(seckey, idlog)
+            with open(filename, 'w') as f:
+                f.write(packets.pop().text)
+            d.file_to_packet(filename)
+            return d
+        b.run(tag + fmttag + "Decode.decode", lambda d: d.decode(),
+              setup=decode_setup)
+
+    with open(filename, 'w') as f:
+        f.write("Next-Hop: http://bench0.invalid\nExpire: 2099-01-01\n\n")
+        f.write(encode(conn, 2).text)
+    d = mix.Decode(seckey, idlog)
+    b.run(tag + "Decode.file_to_packet", lambda: d.file_to_packet(filename))
+    b.run(tag + "Decode.packet_import", lambda: d.packet_import(filename))
 
+    keyid = libmimix.get_public(conn, 'bench0')[0]
+    b.run(tag + "SecCache.hit", lambda: seckey[keyid], repeat=b.repeat * 100)
+
+    # Cold load, as at startup.  Warm reloads reuse the parsed keys.
+    def seckey_load():
+        seckey.cache = {}
+        seckey.load()
+    b.run(tag + "SecCache.load", seckey_load)
+    b.run(tag + "SecCache.reload", seckey.load)
+
+    # The per-packet private key operation on its own.
+    pubkey = seckey[keyid].publickey()
+    session = PKCS1_OAEP.new(pubkey).encrypt(Random.new().read(32))
+    cipher = PKCS1_OAEP.new(seckey[keyid])
+    b.run(tag + "RSA.decrypt", lambda: cipher.decrypt(session))
+    conn.close()
+
+
+def bench_x25519(b):
+    key = x25519.PrivateKey()
+    ephemeral, aes = x25519.encapsulate(key.public)
+    b.run("X25519.encapsulate", lambda: x25519.encapsulate(key.public),
+          repeat=b.repeat * 10)
+    b.run("X25519.decapsulate", lambda: key.decapsulate(ephemeral),
+          repeat=b.repeat * 10)
+
+
+def bench_aes(b):
+    """Symmetric crypto for one intermediate hop: nine headers and the
+    payload, in each packet format.  Key setup is measured on its own for
+    comparison.
+    """
+    key = Random.new().read(32)
+    ivs = [Random.new().read(16) for n in range(10)]
+    segments = [Random.new().read(1024) for n in range(9)]
+    segments.append(Random.new().read(10240))
+    pk = aescrypt.PacketKey(key)
+    b.run("AES.key_setup", lambda: AES.new(key, AES.MODE_CFB, ivs[0]),
+          repeat=b.repeat * 100)
+    b.run("AES.hop_segments", lambda: pk.decrypt_segments(ivs, segments),
+          repeat=b.repeat * 10)
+    ctr = aescrypt.PacketKey(key, aescrypt.CTR)
+    b.run("AES.ctr.hop_segments", lambda: ctr.decrypt_segments(ivs, segments),
+          repeat=b.repeat * 10)
+
+
+def bench_common(b):
+    conn = sqlite3.connect(':memory:')
+    conn.text_factory = str
+    idlog = keys.IDLog(conn)
+    b.run("IDLog.lookup", lambda pid: idlog[pid],
+          setup=lambda: Random.new().read(16), repeat=b.repeat * 10)
+    b.run("IDLog.prune", idlog.prune)
+
+    c = chunker.Chunker(conn)
+    tmpfn = tempfile.mktemp()
+
+    def chunks_setup():
+        msgid = Random.new().read(16)
+        for n in range(1, 6):
+            e = mix.ExitEncode()
+            e.set_chunks(msgid, n, 5)
+            e.set_payload(Random.new().read(10240))
+            c.insert(e)
+        return msgid.encode('hex')
+
+    def insert_setup():
+        e = mix.ExitEncode()
+        e.set_chunks(Random.new().read(16), 1, 5)
+        e.set_payload(Random.new().read(10240))
+        return e
+    b.run("Chunker.insert", c.insert, setup=insert_setup)
+    b.run("Chunker.chunk_check", c.chunk_check, setup=chunks_setup)
+
+    def assemble(msgid):
+        c.assemble(msgid, tmpfn)
+    b.run("Chunker.assemble", assemble, setup=chunks_setup)
+    os.remove(tmpfn)
+    conn.close()
+
+
+def bench_startup(b, tmpdir):
+    """Time Client commands and module imports in a new interpreter.  They
+    run with an empty keyring in a throwaway HOME.
+    """
+    home = os.path.join(tmpdir, 'startup')
+    dbdir = os.path.join(home, 'mimix', 'db')
+    os.makedirs(dbdir)
+    conn = sqlite3.connect(os.path.join(dbdir, 'directory.db'))
+    libmimix.create_keyring(conn)
+    conn.close()
+    env = dict(os.environ, HOME=home)
+    env.pop('MIMIX', None)
+    client = os.path.join(MIMIXDIR, 'Client.py')
+    devnull = open(os.devnull, 'w')
+
+    def run(*cmd):
+        subprocess.check_call((sys.executable,) + cmd, env=env,
+                              cwd=MIMIXDIR, stdout=devnull)
+    b.run("Startup.python", lambda: run('-c', 'pass'))
+    b.run("Startup.Client.help", lambda: run(client, '--help'))
+    b.run("Startup.Client.info", lambda: run(client, 'info', '--keys'))
+    for module in ('libmimix', 'mix', 'server'):
+        b.run("Startup.import.%s" % module,
+              lambda: run('-c', 'import %s' % module))
+    devnull.close()
+
+
+def compare(results, baseline, threshold):
+    """Compare results against baseline.  Returns a list of regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['mean_ms'] / baseline[name]['mean_ms']
+        results[name]['baseline_ratio'] = ratio
+        if ratio > 1 + threshold / 100.0:
+            regressions.append(name)
+            sys.stderr.write("REGRESSION: %s is %.0f%% slower than baseline\n"
+                             % (name, (ratio - 1) * 100))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mimix Benchmarks')
+    parser.add_argument('--keylens', type=str, default='1024,2048,4096',
+                        help="Comma separated list of RSA key lengths")
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="Number of times to repeat each benchmark")
+    parser.add_argument('--output', type=str, dest='output',
+                        help="Write JSON results to a file instead of stdout")
+    parser.add_argument('--baseline', type=str, default=DEFAULT_BASELINE,
+                        help="Baseline JSON to compare results against")
+    parser.add_argument('--save-baseline', dest='save', action='store_true',
+                        help="Store these results as the new baseline")
+    parser.add_argument('--threshold', type=int, default=10,
+                        help="Percentage slowdown reported as a regression")
+    args = parser.parse_args()
+
+    b = Bench(args.repeat)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for keylen in [int(k) for k in args.keylens.split(',')]:
+            bench_keylen(b, keylen, tmpdir)
+        bench_x25519(b)
+        bench_aes(b)
+        bench_common(b)
+        bench_startup(b, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    regressions = []
+    if not args.save and os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(b.results, baseline, args.threshold)
+    report = {'python': platform.python_version(),
+              'pycrypto': Crypto.__version__,
+              'platform': platform.platform(),
+              'date': timing.nowstamp(),
+              'repeat': args.repeat,
+              'results': b.results,
+              'regressions': regressions}
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            f.write(text)
+        sys.stderr.write("Baseline written to %s\n" % args.baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    if regressions:
+        sys.exit(1)
+
+
+if (__name__ == "__main__"):
+    main()
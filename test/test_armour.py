@@ -0,0 +1,175 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# test_armour.py - Tests of the Mimix ASCII armour codec
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run with "python -m unittest discover -s test -p 'test_*.py'" from the
+top of the tree.
+"""
+
+import logging
+import os.path
+import sys
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from Crypto import Random
+from mimix import armour
+
+logging.getLogger('mimix').addHandler(logging.NullHandler())
+
+SIZE = 20480
+
+
+class EncodeTest(unittest.TestCase):
+    def setUp(self):
+        self.binary = Random.new().read(SIZE)
+        self.text = armour.encode(self.binary, '2.0/2')
+
+    def test_layout(self):
+        lines = self.text.split('\n')
+        self.assertEqual(lines[0], armour.BEGIN)
+        self.assertEqual(lines[1], 'Version: 2.0/2')
+        self.assertEqual(lines[2], '')
+        self.assertEqual(lines[-2], armour.END)
+        self.assertEqual(lines[-1], '')
+        body = lines[3:-2]
+        self.assertTrue(all([len(line) == 76 for line in body[:-1]]))
+        self.assertTrue(0 < len(body[-1]) <= 76)
+
+    def test_round_trip(self):
+        a = armour.decode(self.text, SIZE)
+        self.assertEqual(a.binary, self.binary)
+        self.assertEqual(a.version, '2.0/2')
+        self.assertEqual(a.headers, {})
+
+    def test_read_file(self):
+        a = armour.read(StringIO(self.text), SIZE)
+        self.assertEqual(a.binary, self.binary)
+
+
+class StrictTest(unittest.TestCase):
+    def setUp(self):
+        self.binary = Random.new().read(SIZE)
+        self.lines = armour.encode(self.binary, '2.0').split('\n')
+
+    def assertInvalid(self, lines, size=SIZE):
+        self.assertRaises(armour.ArmourError, armour.decode,
+                          '\n'.join(lines), size)
+
+    def test_out_of_alphabet(self):
+        # binascii would silently skip these.
+        for char in ('!', '*', '-', '\t', '\x00', '\xff'):
+            lines = list(self.lines)
+            lines[5] = lines[5][:10] + char + lines[5][10:]
+            self.assertInvalid(lines)
+
+    def test_text_before(self):
+        self.assertInvalid(['Some text'] + self.lines)
+
+    def test_text_after(self):
+        self.assertInvalid(self.lines + ['Some text'])
+
+    def test_blank_lines_around(self):
+        a = armour.decode('\n'.join([''] + self.lines + ['', '']), SIZE)
+        self.assertEqual(a.binary, self.binary)
+
+    def test_no_blank_after_version(self):
+        self.assertInvalid(self.lines[:2] + self.lines[3:])
+
+    def test_no_version(self):
+        self.assertInvalid(self.lines[:1] + self.lines[2:])
+
+    def test_no_begin(self):
+        self.assertInvalid(self.lines[1:])
+
+    def test_no_end(self):
+        self.assertInvalid(self.lines[:-2])
+
+    def test_truncated(self):
+        self.assertInvalid(self.lines[:10] + self.lines[-2:])
+
+    def test_wrong_size(self):
+        self.assertInvalid(self.lines, SIZE + 1)
+        self.assertInvalid(self.lines, SIZE - 1)
+
+    def test_any_size(self):
+        a = armour.decode('\n'.join(self.lines))
+        self.assertEqual(len(a.binary), SIZE)
+
+    def test_indented(self):
+        self.assertInvalid([' ' + line for line in self.lines])
+
+
+class LenientTest(unittest.TestCase):
+    def setUp(self):
+        self.binary = Random.new().read(SIZE)
+        self.lines = armour.encode(self.binary, '2.0').split('\n')
+
+    def decode(self, lines):
+        return armour.decode('\n'.join(lines), SIZE, strict=False)
+
+    def test_pasted(self):
+        lines = ['Here it is:', ''] + ['  %s  ' % line for line in self.lines]
+        lines += ['', 'Thanks']
+        self.assertEqual(self.decode(lines).binary, self.binary)
+
+    def test_crlf(self):
+        lines = [line + '\r' for line in self.lines]
+        self.assertEqual(self.decode(lines).binary, self.binary)
+
+    def test_wrong_size(self):
+        self.assertRaises(armour.ArmourError, armour.decode,
+                          '\n'.join(self.lines), SIZE + 1, False)
+
+
+class HeaderTest(unittest.TestCase):
+    def setUp(self):
+        self.binary = Random.new().read(SIZE)
+        f = StringIO()
+        armour.write_headers(f, (('Next-Hop', 'http://hop.invalid'),
+                                 ('Expire', '2014-01-01')))
+        f.write(armour.encode(self.binary, '2.0'))
+        self.text = f.getvalue()
+
+    def test_read(self):
+        a = armour.read(StringIO(self.text), SIZE)
+        self.assertEqual(a.binary, self.binary)
+        self.assertEqual(a.headers, {'Next-Hop': 'http://hop.invalid',
+                                     'Expire': '2014-01-01'})
+
+    def test_read_headers(self):
+        f = StringIO(self.text)
+        self.assertEqual(armour.read_headers(f),
+                         {'Next-Hop': 'http://hop.invalid',
+                          'Expire': '2014-01-01'})
+        # Reading stops before the armour.
+        self.assertEqual(f.readline().rstrip('\n'), armour.BEGIN)
+
+    def test_no_headers(self):
+        f = StringIO(armour.encode(self.binary, '2.0'))
+        self.assertEqual(armour.read_headers(f), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
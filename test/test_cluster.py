@@ -0,0 +1,251 @@
+#!/usr/bin/python
+#
+# vim: tabstop=4 expandtab shiftwidth=4 noautoindent
+#
+# test_cluster.py - Tests of the cluster claim, replay and exit handoff
+#
+# Copyright (C) 2014 Steve Crook <steve@mixmin.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run with "python -m unittest discover -s test -p 'test_*.py'" from the
+top of the tree.
+"""
+
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from Crypto import Random
+from mimix import cluster
+from mimix import mix
+
+logging.getLogger('mimix').addHandler(logging.NullHandler())
+
+STEAL = 300
+
+
+class ClusterTest(unittest.TestCase):
+    def setUp(self):
+        self.shareddir = tempfile.mkdtemp(prefix='mimixcluster')
+        self.pooldir = os.path.join(self.shareddir, 'pool')
+        os.mkdir(self.pooldir)
+        os.mkdir(os.path.join(self.shareddir, 'exits'))
+        self.nodes = [cluster.Cluster(self.shareddir, n, 2, STEAL)
+                      for n in range(2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.shareddir)
+
+    def write_pool(self, count, age=0):
+        names = []
+        for n in range(count):
+            name = 'm' + Random.new().read(4).encode('hex')
+            fqfn = os.path.join(self.pooldir, name)
+            with open(fqfn, 'w') as f:
+                f.write(name)
+            if age:
+                stamp = time.time() - age
+                os.utime(fqfn, (stamp, stamp))
+            names.append(name)
+        return names
+
+    def visible(self):
+        return sorted([f for f in os.listdir(self.pooldir)
+                       if not f.startswith('.')])
+
+    def select(self):
+        return [os.path.join(self.pooldir, f) for f in self.visible()]
+
+    def contents(self, filenames):
+        contents = []
+        for fqfn in filenames:
+            with open(fqfn) as f:
+                contents.append(f.read())
+        return contents
+
+    def test_bad_node(self):
+        self.assertRaises(cluster.ClusterError, cluster.Cluster,
+                          self.shareddir, 2, 2, STEAL)
+
+    def test_partition(self):
+        names = self.write_pool(200)
+        owners = [self.nodes[0].owner(name) for name in names]
+        self.assertEqual(set(owners), set([0, 1]))
+        # Each node agrees on who owns each file.
+        self.assertEqual(owners, [self.nodes[1].owner(name)
+                                  for name in names])
+
+    def test_claim_once(self):
+        names = self.write_pool(100, age=STEAL * 2)
+        # Both nodes are offered every file; they're old enough that
+        # either may take any of them.
+        selected = self.select()
+        first = list(self.nodes[0].claimed(selected))
+        second = list(self.nodes[1].claimed(selected))
+        claimed = self.contents(first) + self.contents(second)
+        self.assertEqual(sorted(claimed), sorted(names))
+        self.assertEqual(self.visible(), [])
+        # The first node took them all, so nothing was left for the second.
+        self.assertEqual(len(first), 100)
+        self.assertEqual(second, [])
+
+    def test_claim_own_partition(self):
+        names = self.write_pool(100)
+        selected = self.select()
+        for node in self.nodes:
+            claimed = self.contents(node.claimed(selected))
+            self.assertEqual(sorted(claimed),
+                             sorted([n for n in names
+                                     if node.owner(n) == node.node]))
+        self.assertEqual(self.visible(), [])
+
+    def test_claim_interleaved(self):
+        names = self.write_pool(100, age=STEAL * 2)
+        selected = self.select()
+        claims = [self.nodes[0].claimed(selected),
+                  self.nodes[1].claimed(selected)]
+        claimed = []
+        # Alternate between the nodes as if they were running at once.
+        for n in range(len(selected)):
+            for generator in claims:
+                fqfn = next(generator, None)
+                if fqfn is not None:
+                    claimed.extend(self.contents([fqfn]))
+        self.assertEqual(sorted(claimed), sorted(names))
+
+    def test_steal(self):
+        self.write_pool(100)
+        theirs = [f for f in self.select()
+                  if self.nodes[0].owner(os.path.basename(f)) == 1]
+        self.assertTrue(theirs)
+        self.assertEqual(list(self.nodes[0].claimed(theirs)), [])
+        self.assertEqual(len(self.visible()), 100)
+        stamp = time.time() - STEAL - 1
+        for fqfn in theirs:
+            os.utime(fqfn, (stamp, stamp))
+        self.assertEqual(len(list(self.nodes[0].claimed(theirs))),
+                         len(theirs))
+
+    def test_claim_vanished(self):
+        self.write_pool(1)
+        selected = self.select()
+        os.remove(selected[0])
+        self.assertEqual(list(self.nodes[0].claimed(selected)), [])
+        self.assertEqual(list(self.nodes[1].claimed(selected)), [])
+
+    def test_release(self):
+        names = self.write_pool(50)
+        selected = self.select()
+        mine = list(self.nodes[0].claimed(selected))
+        theirs = list(self.nodes[1].claimed(selected))
+        self.assertTrue(mine and theirs)
+        self.assertEqual(self.nodes[0].release(self.pooldir), len(mine))
+        # Only node 0's claims are returned, under their original names.
+        self.assertEqual(self.visible(),
+                         sorted([n for n in names
+                                 if self.nodes[0].owner(n) == 0]))
+        self.assertTrue(all([os.path.exists(f) for f in theirs]))
+        self.assertEqual(self.nodes[0].release(self.pooldir), 0)
+
+    def exit_info(self, payload, chunknum=2, numchunks=3,
+                  exit_type=mix.EXIT_DEFLATE):
+        e = mix.ExitEncode()
+        e.set_chunks(Random.new().read(16), chunknum, numchunks)
+        e.set_exit_type(exit_type)
+        e.set_payload(payload)
+        return e
+
+    def test_forward(self):
+        exitdir = os.path.join(self.shareddir, 'exits')
+        sent = [self.exit_info(Random.new().read(10240)),
+                self.exit_info('', 1, 1, mix.EXIT_PING)]
+        for e in sent:
+            self.nodes[1].forward(e)
+        received = list(self.nodes[0].forwarded())
+        fields = lambda e: (e.chunknum, e.numchunks, e.messageid,
+                            e.exit_type, e.payload)
+        self.assertEqual(sorted([fields(e) for e in received]),
+                         sorted([fields(e) for e in sent]))
+        self.assertEqual(os.listdir(exitdir), [])
+
+    def test_forward_interrupted(self):
+        # A file is only removed once its packet has been processed.
+        self.nodes[1].forward(self.exit_info('payload'))
+        generator = self.nodes[0].forwarded()
+        next(generator)
+        generator.close()
+        self.assertEqual(len(list(self.nodes[0].forwarded())), 1)
+
+    def test_forward_truncated(self):
+        self.nodes[1].forward(self.exit_info('payload'))
+        exitdir = os.path.join(self.shareddir, 'exits')
+        fqfn = os.path.join(exitdir, os.listdir(exitdir)[0])
+        with open(fqfn) as f:
+            data = f.read()
+        with open(fqfn, 'w') as f:
+            f.write(data[:-1])
+        self.assertEqual(list(self.nodes[0].forwarded()), [])
+        self.assertEqual(os.listdir(exitdir), [])
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='mimixreplay')
+        self.url = 'sqlite:%s' % os.path.join(self.tmpdir, 'replay.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_repeat(self):
+        store = cluster.replay_store(self.url)
+        pid = Random.new().read(16)
+        self.assertFalse(store[pid])
+        self.assertTrue(store[pid])
+        self.assertFalse(store[Random.new().read(16)])
+        self.assertEqual(store.count(), 2)
+
+    def test_shared(self):
+        # Each node has its own connection to the store.
+        stores = [cluster.replay_store(self.url) for n in range(2)]
+        pids = [Random.new().read(16) for n in range(20)]
+        results = [stores[n % 2][pid] for n, pid in enumerate(pids)]
+        self.assertEqual(results, [False] * 20)
+        results = [stores[(n + 1) % 2][pid] for n, pid in enumerate(pids)]
+        self.assertEqual(results, [True] * 20)
+
+    def test_prune(self):
+        store = cluster.replay_store(self.url)
+        store[Random.new().read(16)]
+        store.exe("UPDATE replay SET date = '2000-01-01'")
+        store.conn.commit()
+        self.assertEqual(store.prune(), 1)
+        self.assertEqual(store.count(), 0)
+
+    def test_unknown(self):
+        self.assertRaises(cluster.ClusterError, cluster.replay_store,
+                          'memcache://localhost')
+
+
+if __name__ == '__main__':
+    unittest.main()